@@ -1,15 +1,149 @@
 import requests
-from bs4 import BeautifulSoup # type: ignore
+from bs4 import SoupStrainer # type: ignore
 import json
 import html
 import re
 
+from http_cache import cached_get
+from metrics import PAGES, stage
+from parsing import Subtrees, make_soup
+
+# Only the buttons, title, content and tag cloud of a book page are parsed
+BOOK_CLASSES = ('post-title', 'post-content', 'tagcloud')
+
+
+def _is_book_class(c):
+    return c is not None and any(v.startswith('wpcmsdev-button') or v in BOOK_CLASSES for v in c.split())
+
+
+BOOK_SUBTREES = Subtrees(
+    SoupStrainer(['a', 'h1', 'div'], class_=_is_book_class),
+    'a[class*="wpcmsdev-button"], h1.post-title, div.post-content, div.tagcloud',
+)
+
+
+# Label at the start of a metadata paragraph -> field; one precompiled alternation for all of them
+FIELD_LABELS = re.compile(
+    r'(?P<author>Συγγραφέας:)|(?P<title>Τίτλος:)|(?P<translator>Μετάφραση)|(?P<isbn>ISBN)'
+    r'|(?P<pages>Σελίδες)|(?P<year>Έτος)|(?P<type>Είδος)'
+)
+# What a field's value is cleaned of, every occurrence as str.replace does: 'Σελίδες 120' stays whole
+FIELD_STRIP = {'author': 'Συγγραφέας:', 'title': 'Τίτλος:', 'isbn': 'ISBN', 'pages': 'Σελίδες:', 'type': 'Είδος:'}
+# Every 'Μετάφραση από τα <language>:' (or 'Μετάφραση:') label is stripped off the translator
+TRANSLATOR_LABEL = re.compile(r'Μετάφραση[^:\n]*:')
+# The key is the whole label, it varies: 'Έτος έκδοσης', 'Έτος 1ης έκδοσης', 'Έτος Β’ έκδοσης'
+YEAR_FIELD = re.compile(r"(Έτος.*?):\s*(.*)")
+PAGES_AND_YEAR = ('pages', 'year', 'type')  # fields a 'Σελίδες: N // Έτος ...: Y' paragraph replaces
+
+
+def _text_field(metadata, field, text, match):
+    metadata[field] = text.replace(FIELD_STRIP[field], '').strip()
+
+
+def _translator_field(metadata, field, text, match):
+    label = TRANSLATOR_LABEL.match(text)
+    metadata[field] = (text[label.end():] if label else text).strip()
+
+
+def _year_field(metadata, field, text, match):
+    year = YEAR_FIELD.search(text)
+    if year:
+        metadata[year.group(1)] = year.group(2)
+    else:
+        print('No match found for year extraction in book.py')
+
+
+FIELD_HANDLERS = {
+    'author': _text_field,
+    'title': _text_field,
+    'translator': _translator_field,
+    'isbn': _text_field,
+    'pages': _text_field,
+    'type': _text_field,
+    'year': _year_field,
+}
+
+
+def _pages_and_year(metadata, text):
+    parts = text.split('//')
+    if len(parts) != 2:
+        return
+    # The year key goes in before pages, as books.json has always had it. Callers of
+    # extract_metadata may pass raw paragraph strings, so entities are decoded here too
+    _year_field(metadata, 'year', html.unescape(parts[1].strip()), None)
+    metadata['pages'] = parts[0].replace('Σελίδες:', '').strip()
+
+
+def extract_metadata(title, paragraphs, description=None, tags=None):
+    """Metadata dict of a book page from its h1 text, the texts of its content paragraphs,
+    its blockquote text and its tag names, in the key order scrape_metadata has always used
+    """
+    metadata = {}
+    if title is not None:
+        metadata['h1'] = title
+    for text in paragraphs:
+        match = FIELD_LABELS.match(text)
+        combined = 'Σελίδες:' in text and 'Έτος' in text
+        if match and not (combined and match.lastgroup in PAGES_AND_YEAR):
+            FIELD_HANDLERS[match.lastgroup](metadata, match.lastgroup, text, match)
+        if combined:
+            _pages_and_year(metadata, text)
+    if description is not None:
+        metadata['description'] = description
+    if tags is not None:
+        metadata['tags'] = tags
+    return metadata
+
+
+def metadata_from_soup(soup):
+    """extract_metadata of a parsed book page (any parsing backend)"""
+    title_element = soup.find('h1', class_='post-title')
+    title = title_element.text.strip() if title_element else None
+    paragraphs, description = (), None
+    content_area = soup.find('div', class_='post-content')
+    if content_area:
+        paragraphs = [p.text.strip() for p in content_area.find_all('p')]
+        blockquote = content_area.find('blockquote')
+        if blockquote:
+            description = blockquote.text.strip()
+    tags = None
+    tags_div = soup.find('div', class_='tagcloud')
+    if tags_div:
+        tags = [tag.text.strip() for tag in tags_div.find_all('a')]
+    return extract_metadata(title, paragraphs, description, tags)
+
+
+def metadata_batch(soups):
+    """metadata_from_soup for many already parsed pages, e.g. the output of a parse pool"""
+    return [metadata_from_soup(soup) for soup in soups]
+
+
+def book_key_from_url(url):
+    return url.split('/')[-2] if url[-1] == '/' else url.split('/')[-1]
+
+
+def parse_book(url, content, parser=None):
+    """book_dict of an already fetched page; top level so it can run in a process pool"""
+    scraper = BookScraper(url, parser=parser)
+    try:
+        scraper.parse(content)
+    except Exception as e:
+        print(f"An error occurred in Book scraper parse_book : {e}")
+    return scraper.to_dict()
+
 
 class BookScraper:
-    def __init__(self, url=None):
+    def __init__(self, url=None, session=None, cache=None, parser=None):
+        # Pass a sessions.PooledSession (or any requests.Session) to reuse connections across books
+        self.session = session if session is not None else requests
+        # Optional http_cache.HttpCache for conditional GETs
+        self.cache = cache
+        # parsing.BACKENDS entry, None picks the fastest installed one
+        self.parser = parser
+        self.unchanged = False
         if url:
             self.url = url
-            self.book_key = url.split('/')[-2] if url[-1] == '/' else url.split('/')[-1]
+            self.book_key = book_key_from_url(url)
             self.book_dict = {
                 self.book_key: {
                     'links': {},
@@ -21,12 +155,13 @@ class BookScraper:
             self.book_key = None
             self.book_dict = {}
         
-    def scrape(self, url=None):
+    def scrape(self, url=None, previous=None):
+        # previous: the book's entry from an earlier run, reused as is when the page is unchanged
         
         try:
             if url:
                 self.url = url
-                self.book_key = url.split('/')[-2] if url[-1] == '/' else url.split('/')[-1]
+                self.book_key = book_key_from_url(url)
                 self.book_dict = {
                     self.book_key: {
                         'links': {},
@@ -37,119 +172,41 @@ class BookScraper:
             if not self.url:
                 raise ValueError("URL is required for scraping")
                 
-            response = requests.get(self.url)
-            soup = BeautifulSoup(response.content, 'html.parser')
-            
-            # Find all links with class that starts with 'wpcmsdev-button'
-            links = soup.find_all('a', class_=lambda c: c and c.startswith('wpcmsdev-button'))
-            
-            # Add the links to the dictionary
-            for i, link in enumerate(links):
-                link_url = link.get('href')
-                type =  html.unescape( link.text.strip()) # pdf or epub or kindle or Android or Apple
-
-                self.book_dict[self.book_key]['links'][type] = link_url
-                
-            self.scrape_metadata(soup)
-                
-            return self.book_dict
+            with stage('detail_fetch'):
+                response = cached_get(self.session, self.url, self.cache)
+            PAGES.labels('book').inc()
+            self.unchanged = response.unchanged
+            if response.unchanged and previous is not None:
+                self.book_dict[self.book_key] = previous
+                return self.book_dict
+            with stage('parse'):
+                return self.parse(response.content)
         
         except Exception as e:
             print(f"An error occurred in Book scraper scrape : {e}")
             return None
+
+    def parse(self, content, restrict=True):
+        """Fill book_dict from an already fetched book page (used by the async crawler)"""
+        soup = make_soup(content, self.parser, BOOK_SUBTREES if restrict else None)
         
-    def scrape_metadata(self, soup):
-        try:
-            # Get the title
-            title_element = soup.find('h1', class_='post-title')
-            if title_element:
-                self.book_dict[self.book_key]['metadata']['h1'] = title_element.text.strip()
-            
-            # Get all paragraphs in the content area
-            content_area = soup.find('div', class_='post-content')
-            if content_area:
-                paragraphs = content_area.find_all('p')
-                
-                # Process each paragraph to extract metadata
-                for p in paragraphs:
-                    text = p.text.strip()
-                    
-                    if text.startswith('Συγγραφέας:'):
-                        self.book_dict[self.book_key]['metadata']['author'] = text.replace('Συγγραφέας:', '').strip()
-                        
-                    elif text.startswith('Τίτλος:'):
-                        self.book_dict[self.book_key]['metadata']['title'] = text.replace('Τίτλος:', '').strip()
-                    
-                    
-                    elif text.startswith('Μετάφραση'):
-                        self.book_dict[self.book_key]['metadata']['translator'] = text.replace('Μετάφραση από τα ισπανικά:', '').strip()
-                    
-                    # elif text.startswith('Άδεια διανομής:'):
-                    #     self.book_dict[self.book_key]['metadata']['license'] = text.replace('Άδεια διανομής:', '').strip()
-                    
-                    elif text.startswith('ISBN'):
-                        self.book_dict[self.book_key]['metadata']['isbn'] = text.replace('ISBN', '').strip()
-                    
-
-
-                    # etos eksodhs to key 'h etos a ekdoshs h etos b ekdoshs
-                    if 'Σελίδες:' in text and 'Έτος' in text:
-                        parts = text.split('//')
-                        if len(parts) == 2:
-                            pages_part = parts[0].strip()
-                            year_part = html.unescape(parts[1].strip())
-
-                            # Extract pages
-                            pages = pages_part.replace('Σελίδες:', '').strip()
-
-                            # Match everything after 'Έτος'
-                            match = re.search(r"(Έτος.*?):\s*(.*)", year_part)
-
-
-                            if match:
-                                # Extract the key (everything before the colon)
-                                key = match.group(1)  
-                                value = match.group(2) 
-                                self.book_dict[self.book_key]['metadata'][key] = value
-                                
-                            else:
-                                print('No match found for year extraction in book.py')
-
-                            self.book_dict[self.book_key]['metadata']['pages'] = pages
-
-                    elif text.startswith('Σελίδες'):
-                        self.book_dict[self.book_key]['metadata']['pages'] = text.replace('Σελίδες:', '').strip()
-
-                    elif text.startswith('Έτος'):
-                    # Match everything after 'Έτος'
-                        match = re.search(r"(Έτος.*?):\s*(.*)", text)
-
-
-                        if match:
-                            # Extract the key (everything before the colon)
-                            key = match.group(1)  
-                            value = match.group(2)  
-                            self.book_dict[self.book_key]['metadata'][key] = value
-                            
-                        else:
-                            print('No match found for year extraction in book.py')
-                            
-                    
-                    elif text.startswith('Είδος'):
-                        self.book_dict[self.book_key]['metadata']['type'] = text.replace('Είδος:', '').strip()
-                
-                # Get the description
-                description = content_area.find('blockquote')
-                if description:
-                    self.book_dict[self.book_key]['metadata']['description'] = description.text.strip()
+        # Find all links with class that starts with 'wpcmsdev-button'
+        links = soup.find_all('a', class_=lambda c: c and c.startswith('wpcmsdev-button'))
+        
+        # Add the links to the dictionary
+        for i, link in enumerate(links):
+            link_url = link.get('href')
+            type =  html.unescape( link.text.strip()) # pdf or epub or kindle or Android or Apple
+
+            self.book_dict[self.book_key]['links'][type] = link_url
             
-            # Get tags
-            tags_div = soup.find('div', class_='tagcloud')
-            if tags_div:
-                tags = [tag.text.strip() for tag in tags_div.find_all('a')]
-                self.book_dict[self.book_key]['metadata']['tags'] = tags
+        self.scrape_metadata(soup)
             
-
+        return self.book_dict
+        
+    def scrape_metadata(self, soup):
+        try:
+            self.book_dict[self.book_key]['metadata'].update(metadata_from_soup(soup))
             return self.book_dict
         
         except Exception as e:
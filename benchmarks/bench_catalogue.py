@@ -0,0 +1,78 @@
+"""Memory of a loaded catalogue, plain book dicts vs catalogue.CompactCatalogue.
+
+    python benchmarks/bench_catalogue.py [books.json] [books]
+
+Without a books.json a synthetic catalogue is written first. Each layout is loaded
+in its own process and reports the RSS it added, per 10k books; the compact one is
+also checked to give back exactly the original books.json text. `pass ms` is one
+walk over items(), which for the compact layout rebuilds every book dict.
+"""
+import gc
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from bench_search import synthetic_catalogue  # noqa: E402
+from book_store import JsonStore, json_chunks  # noqa: E402
+
+
+def rss_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except OSError:  # not Linux: the peak is the best there is
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def measure(layout, path):
+    """Child process: load `path` as `layout` and print the RSS it took"""
+    before = rss_mb()
+    store = JsonStore(path, compact=layout == 'compact')
+    gc.collect()
+    result = {'books': len(store), 'mb': rss_mb() - before}
+    start = time.perf_counter()
+    for _, data in store.items():
+        data['metadata']  # what pdfs.py reads first for every book
+    result['pass_ms'] = (time.perf_counter() - start) * 1000
+    if layout == 'compact':
+        with open(path, encoding='utf-8') as f:
+            result['lossless'] = ''.join(json_chunks(store.items())) == f.read()
+    print(json.dumps(result))
+
+
+def main(path=None, count=10000):
+    with tempfile.TemporaryDirectory() as directory:
+        if not path:
+            catalogue = synthetic_catalogue(count)
+            for i, book in enumerate(catalogue.values()):
+                book['scraped'] = True  # the flags pdfs.py adds
+                if i % 7 == 0:
+                    book['has_audio'] = True
+            path = os.path.join(directory, 'books.json')
+            Path(path).write_text(''.join(json_chunks(catalogue.items())), encoding='utf-8')
+            del catalogue
+
+        print(f"{'layout':<10}{'books':>8}{'MB':>9}{'MB/10k books':>15}{'bytes/book':>12}{'pass ms':>10}  lossless")
+        for layout in ('dict', 'compact'):
+            output = subprocess.run([sys.executable, __file__, '--measure', layout, path],
+                                    capture_output=True, text=True, check=True).stdout
+            result = json.loads(output)
+            per_book = result['mb'] * 1024 * 1024 / result['books']
+            lossless = {True: 'yes', False: 'NO'}.get(result.get('lossless'), '-')
+            print(f"{layout:<10}{result['books']:>8}{result['mb']:>9.1f}{per_book * 10000 / (1024 * 1024):>15.1f}"
+                  f"{per_book:>12.0f}{result['pass_ms']:>10.1f}  {lossless}")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ['--measure']:
+        measure(sys.argv[2], sys.argv[3])
+    else:
+        main(sys.argv[1] if len(sys.argv) > 1 else None, int(sys.argv[2]) if len(sys.argv) > 2 else 10000)
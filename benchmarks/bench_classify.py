@@ -0,0 +1,118 @@
+"""Link classification over a whole catalogue, the old keyword loops vs link_classifier.
+
+    python benchmarks/bench_classify.py [books.json] [books]
+
+Without a books.json a synthetic catalogue is built from typical link names.
+Both sides must pick the same audio / mobile / download links for every book.
+"""
+import json
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import link_classifier  # noqa: E402
+from link_classifier import (AUDIO_KEYWORDS, DOCUMENT_TYPES, MOBILE_KEYWORDS,  # noqa: E402
+                             VOLUME_INDICATORS, plan_catalogue)
+
+LINK_NAMES = [
+    "PDF", "ePub", "Kindle mobi", "Kindle", "Διαβάστε online", "Κατεβάστε", "Audio book (mp3)",
+    "Ακούστε το βιβλίο", "Podcast", "Android", "Apple iOS", "Google Play", "Τόμος Α' (PDF)",
+    "Τόμος Β' (PDF)", "Τεύχος 1", "Μέρος 2ο", "v.1 ePub", "#3 PDF", "Δείτε το βίντεο", "Ιστοσελίδα",
+]
+
+
+# The per-call keyword scans process_book used before link_classifier
+def is_audio_book(link_name):
+    return any(keyword.lower() in link_name.lower() for keyword in AUDIO_KEYWORDS)
+
+
+def is_mobile_app(link_name):
+    return any(keyword.lower() in link_name.lower() for keyword in MOBILE_KEYWORDS)
+
+
+def is_document_link(link_name):
+    return any(doc_type.lower() in link_name.lower() for doc_type in DOCUMENT_TYPES)
+
+
+def is_volume_or_part(link_name):
+    lower_link = link_name.lower()
+    return any(indicator.lower() in lower_link for indicator in VOLUME_INDICATORS)
+
+
+def old_plan(links):
+    download_all_volumes = any(is_volume_or_part(link) for link in links.keys())
+    document_links, audio_links, mobile_links = {}, {}, {}
+    for link_name, link_url in links.items():
+        if is_audio_book(link_name):
+            audio_links[link_name] = link_url
+        elif is_mobile_app(link_name):
+            mobile_links[link_name] = link_url
+        elif is_document_link(link_name) or is_volume_or_part(link_name):
+            document_links[link_name] = link_url
+    if not document_links:
+        for link_name, link_url in links.items():
+            if link_name not in audio_links and link_name not in mobile_links:
+                document_links[link_name] = link_url
+
+    links_to_download = {}
+    if download_all_volumes or not any(is_volume_or_part(link) for link in document_links):
+        links_to_download.update(document_links)
+    else:
+        best_link = None
+        for priority in ["PDF", "ePub", "Kindle mobi", "Kindle", "Διαβάστε"]:
+            for link_name, link_url in document_links.items():
+                if priority.lower() in link_name.lower():
+                    best_link = (link_name, link_url)
+                    break
+            if best_link:
+                break
+        if not best_link and document_links:
+            best_link = next(iter(document_links.items()))
+        if best_link:
+            links_to_download[best_link[0]] = best_link[1]
+    return audio_links, mobile_links, links_to_download
+
+
+def synthetic_catalogue(count):
+    rng = random.Random(0)
+    books = {}
+    for i in range(count):
+        names = rng.sample(LINK_NAMES, rng.randint(1, 4))
+        books[f"book-{i}"] = {"links": {name: f"https://example.org/{i}/{n}?dl=1" for n, name in enumerate(names)}}
+    return books
+
+
+def main(path=None, count=10000):
+    if path:
+        with open(path, 'r', encoding='utf-8') as f:
+            books = json.load(f)
+    else:
+        books = synthetic_catalogue(count)
+    links = sum(len(book.get("links", {})) for book in books.values())
+    print(f"{len(books)} books, {links} links")
+
+    start = time.perf_counter()
+    expected = [old_plan(book.get("links", {})) for book in books.values()]
+    old = time.perf_counter() - start
+
+    link_classifier.classify_link.cache_clear()
+    start = time.perf_counter()
+    plans = list(plan_catalogue(books.items()))
+    cold = time.perf_counter() - start
+
+    start = time.perf_counter()
+    list(plan_catalogue(books.items()))
+    warm = time.perf_counter() - start
+
+    same = expected == [(plan.audio, plan.mobile, plan.download) for _, plan in plans]
+    print(f"{'':<26}{'ms total':>10}{'us/book':>10}")
+    for name, elapsed in [('keyword loops', old), ('classifier (cold cache)', cold), ('classifier (warm cache)', warm)]:
+        print(f"{name:<26}{elapsed * 1000:>10.1f}{elapsed * 1e6 / len(books):>10.2f}")
+    print(f"same plans: {'yes' if same else 'NO'}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else None, int(sys.argv[2]) if len(sys.argv) > 2 else 10000)
@@ -0,0 +1,89 @@
+"""Download throughput against a local aiohttp server, inline writes vs the writer threads.
+
+    python benchmarks/bench_download.py [files] [MB per file]
+
+Reports MB/s and the worst event loop stall seen while the downloads ran.
+"""
+import asyncio
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import aiohttp
+from aiohttp import web
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import pdfs  # noqa: E402
+from file_writer import FileWriter  # noqa: E402
+
+PORT = 8089
+
+
+def make_app(size):
+    body = bytes(range(256)) * (size // 256)
+
+    async def handle(request):
+        return web.Response(body=body, headers={
+            'Content-Type': 'application/pdf',
+            'Content-Disposition': f'attachment; filename="{request.match_info["name"]}.pdf"',
+        })
+
+    app = web.Application()
+    app.router.add_get('/{name}', handle)
+    return app
+
+
+async def watch_loop(stalls):
+    # Sleeps 1ms at a time and records how late it wakes up
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(0.001)
+        stalls.append(time.perf_counter() - start - 0.001)
+
+
+async def run(writer, files, directory):
+    stalls = []
+    watcher = asyncio.create_task(watch_loop(stalls))
+    start = time.perf_counter()
+    async with aiohttp.ClientSession() as session:
+        results = await asyncio.gather(*[
+            pdfs.download_file(session, f'http://127.0.0.1:{PORT}/file{i}', directory, writer=writer)
+            for i in range(files)
+        ])
+    elapsed = time.perf_counter() - start
+    watcher.cancel()
+    assert all(success for success, _ in results)
+    return elapsed, max(stalls) * 1000
+
+
+def serve(size, ready):
+    # The server gets its own thread and loop so it doesn't show up in the stall numbers
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(make_app(size))
+    loop.run_until_complete(runner.setup())
+    loop.run_until_complete(web.TCPSite(runner, '127.0.0.1', PORT).start())
+    ready.set()
+    loop.run_forever()
+
+
+async def main(files=8, megabytes=64):
+    ready = threading.Event()
+    threading.Thread(target=serve, args=(megabytes * 1024 * 1024, ready), daemon=True).start()
+    ready.wait()
+
+    print(f"{files} files x {megabytes} MB")
+    print(f"{'writer':<28}{'MB/s':>10}{'max loop stall ms':>20}")
+    for name, writer in [('inline (threads=0)', FileWriter(threads=0)),
+                         ('thread pool (threads=4)', FileWriter(threads=4))]:
+        with tempfile.TemporaryDirectory() as directory:
+            elapsed, stall = await run(writer, files, directory)
+        writer.close()
+        print(f"{name:<28}{files * megabytes / elapsed:>10.1f}{stall:>20.1f}")
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:3]]
+    asyncio.run(main(*args))
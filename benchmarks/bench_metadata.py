@@ -0,0 +1,153 @@
+"""Metadata extraction, the old if/elif chain vs the table-driven BookScraper.metadata_batch.
+
+    python benchmarks/bench_metadata.py [pages]
+
+Runs both over the fixture book pages and a synthetic set of pages with every field
+layout seen on the site (all 'Μετάφραση ...' variants, pages and year on one line or
+two, labels without their colon, ISBN lines that repeat the label, missing fields),
+parsed once up front. Both must give the same metadata, except
+that only the new one strips a translator label other than the Spanish one; the
+script exits 1 on any other difference. Reports paragraphs/s for each.
+"""
+import html
+import random
+import re
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from BookScraper import BOOK_SUBTREES, extract_metadata, metadata_batch  # noqa: E402
+from parsing import make_soup  # noqa: E402
+
+FIXTURES = Path(__file__).resolve().parent / "fixtures"
+LANGUAGES = ["ισπανικά", "αγγλικά", "γερμανικά", "γαλλικά", "ιταλικά", "αρχαία ελληνικά"]
+YEAR_LABELS = ["Έτος έκδοσης", "Έτος 1ης έκδοσης", "Έτος Β’ έκδοσης", "Έτος ψηφιακής έκδοσης"]
+
+
+# scrape_metadata before the table-driven extractor
+def old_metadata(soup):
+    metadata = {}
+    title_element = soup.find('h1', class_='post-title')
+    if title_element:
+        metadata['h1'] = title_element.text.strip()
+    content_area = soup.find('div', class_='post-content')
+    if content_area:
+        old_paragraphs(metadata, [p.text.strip() for p in content_area.find_all('p')])
+        description = content_area.find('blockquote')
+        if description:
+            metadata['description'] = description.text.strip()
+    tags_div = soup.find('div', class_='tagcloud')
+    if tags_div:
+        metadata['tags'] = [tag.text.strip() for tag in tags_div.find_all('a')]
+    return metadata
+
+
+def old_paragraphs(metadata, texts):
+    for text in texts:
+        if text.startswith('Συγγραφέας:'):
+            metadata['author'] = text.replace('Συγγραφέας:', '').strip()
+        elif text.startswith('Τίτλος:'):
+            metadata['title'] = text.replace('Τίτλος:', '').strip()
+        elif text.startswith('Μετάφραση'):
+            metadata['translator'] = text.replace('Μετάφραση από τα ισπανικά:', '').strip()
+        elif text.startswith('ISBN'):
+            metadata['isbn'] = text.replace('ISBN', '').strip()
+        if 'Σελίδες:' in text and 'Έτος' in text:
+            parts = text.split('//')
+            if len(parts) == 2:
+                pages_part = parts[0].strip()
+                year_part = html.unescape(parts[1].strip())
+                match = re.search(r"(Έτος.*?):\s*(.*)", year_part)
+                if match:
+                    metadata[match.group(1)] = match.group(2)
+                metadata['pages'] = pages_part.replace('Σελίδες:', '').strip()
+        elif text.startswith('Σελίδες'):
+            metadata['pages'] = text.replace('Σελίδες:', '').strip()
+        elif text.startswith('Έτος'):
+            match = re.search(r"(Έτος.*?):\s*(.*)", text)
+            if match:
+                metadata[match.group(1)] = match.group(2)
+        elif text.startswith('Είδος'):
+            metadata['type'] = text.replace('Είδος:', '').strip()
+
+
+def synthetic_page(rng, i):
+    year = f"{rng.choice(YEAR_LABELS)}: {rng.randint(1900, 2024)}"
+    pages = f"Σελίδες: {rng.randint(20, 900)}"
+    paragraphs = ["", f"Συγγραφέας: Συγγραφέας {i}", f"Τίτλος: Βιβλίο {i}"]
+    if rng.random() < 0.6:
+        language = rng.choice(LANGUAGES)
+        paragraphs.append(rng.choice([f"Μετάφραση από τα {language}: Μεταφραστής {i}"] * 8
+                                     + [f"Μετάφραση: Μεταφραστής {i}", f"Μετάφραση Μεταφραστής {i}"]))
+    paragraphs.append("Άδεια διανομής: CC BY-NC-ND 4.0")
+    if rng.random() < 0.8:
+        isbn = f"978-960-{i:05d}-{i % 10}"
+        paragraphs.append(rng.choice([f"ISBN {isbn}"] * 8 + [f"ISBN: {isbn}", f"ISBN {isbn} (ISBN ψηφιακής έκδοσης)"]))
+    if rng.random() < 0.1:
+        pages = pages.replace(':', '')  # labels without their colon are kept in the value
+    paragraphs += [f"{pages} // {year}"] if rng.random() < 0.6 else [pages, year]
+    kind = rng.choice(['Μυθιστόρημα', 'Ποίηση', 'Δοκίμιο', 'Ιστορία'])
+    paragraphs.append(f"Είδος: {kind}" if rng.random() < 0.9 else f"Είδος {kind}")
+    paragraphs += [" ".join(rng.choices(LANGUAGES, k=12)) for _ in range(rng.randint(1, 3))]
+    body = "".join(f"<p>{html.escape(text)}</p>" for text in paragraphs)
+    tags = "".join(f"<a>{tag}</a>" for tag in rng.sample(LANGUAGES, 3))
+    return (f'<html><body><h1 class="post-title">Βιβλίο {i}</h1><div class="post-content">{body}'
+            f'<blockquote>Περιγραφή {i}</blockquote></div><div class="tagcloud">{tags}</div></body></html>')
+
+
+def expected_difference(old, new):
+    """Only the translator may differ: the old code kept any non-Spanish label"""
+    if old.keys() != new.keys():
+        return False
+    for key in old:
+        if old[key] != new[key] and not (key == 'translator' and old[key].endswith(': ' + new[key])):
+            return False
+    return True
+
+
+def main(count=2000):
+    rng = random.Random(0)
+    pages = [path.read_bytes() for path in sorted(FIXTURES.glob("book-*.html"))]
+    pages += [synthetic_page(rng, i) for i in range(count)]
+    soups = [make_soup(page, None, BOOK_SUBTREES) for page in pages]
+    paragraphs = sum(len(soup.find('div', class_='post-content').find_all('p')) for soup in soups)
+
+    start = time.perf_counter()
+    old = [old_metadata(soup) for soup in soups]
+    old_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    new = metadata_batch(soups)
+    new_seconds = time.perf_counter() - start
+
+    # The extraction alone, on paragraph texts pulled out beforehand
+    texts = [[p.text.strip() for p in soup.find('div', class_='post-content').find_all('p')] for soup in soups]
+    start = time.perf_counter()
+    for page_texts in texts:
+        old_paragraphs({}, page_texts)
+    old_extract_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    for page_texts in texts:
+        extract_metadata(None, page_texts)
+    extract_seconds = time.perf_counter() - start
+
+    same = sum(1 for a, b in zip(old, new) if a == b)
+    translator = sum(1 for a, b in zip(old, new) if a != b and expected_difference(a, b))
+    unexpected = [(a, b) for a, b in zip(old, new) if a != b and not expected_difference(a, b)]
+    print(f"{len(soups)} pages, {paragraphs} paragraphs: {same} identical, {translator} with a non-Spanish "
+          f"translator label now stripped, {len(unexpected)} other differences")
+    for a, b in unexpected[:5]:
+        fields = [key for key in a.keys() | b.keys() if a.get(key) != b.get(key)]
+        print(f"  {a.get('h1')}: " + ', '.join(f"{key} {a.get(key)!r} -> {b.get(key)!r}" for key in fields))
+    print(f"{'':<34}{'paragraphs/s':>14}")
+    print(f"{'old chain, from soups':<34}{paragraphs / old_seconds:>14,.0f}")
+    print(f"{'metadata_batch, from soups':<34}{paragraphs / new_seconds:>14,.0f}")
+    print(f"{'old chain, paragraph texts only':<34}{paragraphs / old_extract_seconds:>14,.0f}")
+    print(f"{'extract_metadata, texts only':<34}{paragraphs / extract_seconds:>14,.0f}")
+    if unexpected:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
@@ -0,0 +1,58 @@
+"""Parse time per page for each parser backend on the saved fixture pages.
+
+    python benchmarks/bench_parse.py [repeats]
+
+The first row is the old full html.parser tree. Every other backend parses only the
+subtrees the scrapers read and is checked to give the same book_dict / links.
+"""
+import sys
+import time
+from contextlib import redirect_stdout
+from io import StringIO
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from BookScraper import BookScraper  # noqa: E402
+from listing import parse_page_links  # noqa: E402
+from parsing import BACKENDS  # noqa: E402
+
+FIXTURES = Path(__file__).resolve().parent / "fixtures"
+
+
+def parse_book(content, backend, restrict):
+    scraper = BookScraper('https://www.openbook.gr/fixture/', parser=backend)
+    return scraper.parse(content, restrict=restrict)
+
+
+def parse_listing(content, backend, restrict):
+    with redirect_stdout(StringIO()):  # page size warnings
+        return parse_page_links(content, 1, parser=backend, restrict=restrict)
+
+
+def bench(pages, parse, backend, restrict, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        results = [parse(content, backend, restrict) for content in pages]
+    elapsed = time.perf_counter() - start
+    return elapsed * 1000 / (repeats * len(pages)), results
+
+
+def main(repeats=20):
+    books = [path.read_bytes() for path in sorted(FIXTURES.glob("book-*.html"))]
+    listings = [path.read_bytes() for path in sorted(FIXTURES.glob("listing-*.html"))]
+
+    runs = [('html.parser', False)] + [(backend, True) for backend in BACKENDS]
+    print(f"{'backend':<24}{'book ms/page':>14}{'listing ms/page':>17}  same output")
+    for backend, restrict in runs:
+        book_ms, book_results = bench(books, parse_book, backend, restrict, repeats)
+        listing_ms, listing_results = bench(listings, parse_listing, backend, restrict, repeats)
+        if not restrict:
+            expected = (book_results, listing_results)
+        same = (book_results, listing_results) == expected
+        name = backend + (' (restricted)' if restrict else ' (full tree)')
+        print(f"{name:<24}{book_ms:>14.2f}{listing_ms:>17.2f}  {'yes' if same else 'NO'}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
@@ -0,0 +1,126 @@
+"""Catalogue queries, a scan of every book vs search_index.
+
+    python benchmarks/bench_search.py [books.json] [books]
+
+Without a books.json a synthetic catalogue of Greek metadata is built. Reports the
+index build time and size, the time to open it, and ms per query of each kind for
+the scan and the index, checking both return the same books.
+"""
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from book_store import JsonStore, iter_json_books  # noqa: E402
+from search_index import (SearchIndex, book_year, build_index, first_number, fold,  # noqa: E402
+                          normalize_isbn, words)
+
+WORDS = ["Ιστορία", "ποίηση", "θάλασσα", "Ελλάδα", "πόλεμος", "έρωτας", "ταξίδι", "νύχτα", "φιλοσοφία",
+         "Αθήνα", "μνήμη", "παιδιά", "κάστρο", "χώρα", "άνθρωπος", "ελευθερία", "όνειρο", "σπίτι"]
+SYLLABLES = ["κα", "λο", "πε", "τρι", "μα", "νη", "σο", "φι", "δε", "ρω", "θυ", "γα", "ξε", "χο", "ψυ", "βί", "ζω", "ής"]
+AUTHORS = [f"{first} {last}" for first in ("Γιάννης", "Μαρία", "Νίκος", "Ελένη", "Κώστας")
+           for last in ("Παπαδόπουλος", "Ρίτσος", "Καζαντζάκης", "Δημητρίου", "Σεφέρης", "Ελύτης")]
+TYPES = ["Μυθιστόρημα", "Ποίηση", "Δοκίμιο", "Διηγήματα", "Θέατρο"]
+TAGS = ["λογοτεχνία", "ποίηση", "ιστορία", "παιδικά", "φιλοσοφία", "κοινωνία", "επιστήμη", "τέχνη"]
+
+
+def synthetic_catalogue(count):
+    rng = random.Random(0)
+    # A few common words and a long tail, as in real descriptions
+    vocabulary = WORDS + list({''.join(rng.choices(SYLLABLES, k=rng.randint(2, 4))) for _ in range(20000)})
+    weights = [1 / rank for rank in range(1, len(vocabulary) + 1)]
+    catalogue = {}
+    for i in range(count):
+        catalogue[f'book-{i}'] = {'links': {'PDF': f'https://example.org/{i}.pdf'}, 'metadata': {
+            'h1': ' '.join(rng.sample(WORDS, 3)),
+            'author': rng.choice(AUTHORS),
+            'title': ' '.join(rng.sample(WORDS, 3)),
+            'isbn': f'978-960-{i:05d}-{i % 10}',
+            rng.choice(['Έτος έκδοσης', 'Έτος 1ης έκδοσης']): str(rng.randint(1950, 2024)),
+            'pages': str(rng.randint(20, 800)),
+            'type': rng.choice(TYPES),
+            'description': ' '.join(rng.choices(vocabulary, weights, k=60)),
+            'tags': rng.sample(TAGS, 2),
+        }}
+    return catalogue
+
+
+# The same conditions answered by reading every book
+def scan(catalogue, text=None, author=None, isbn=None, tag=None, year=(None, None), pages=(None, None)):
+    keys = []
+    wanted = set(words(text or ''))
+    for key, book in catalogue.items():
+        metadata = book['metadata']
+        if wanted and not wanted <= set(words(' '.join(metadata.get(f, '') for f in ('h1', 'title', 'description')))):
+            continue
+        if author and fold(metadata.get('author', '')) != fold(author):
+            continue
+        if isbn and normalize_isbn(metadata.get('isbn', '')) != normalize_isbn(isbn):
+            continue
+        if tag and fold(tag) not in {fold(t) for t in metadata.get('tags', [])}:
+            continue
+        for value, (low, high) in ((book_year(metadata), year), (first_number(metadata.get('pages')), pages)):
+            if (low is not None or high is not None) and (
+                    value is None or (low is not None and value < low) or (high is not None and value > high)):
+                break
+        else:
+            keys.append(key)
+    return keys
+
+
+QUERIES = [
+    ('isbn', {'isbn': '978 960 00421 1'}),
+    ('author', {'author': 'γιαννης ριτσος'}),
+    ('tag after 2015', {'tag': 'ΠΟΙΗΣΗ', 'year': (2015, None)}),
+    ('two words', {'text': 'θαλασσα νυχτα'}),
+    ('words + pages', {'text': 'κάστρο', 'pages': (None, 100)}),
+]
+
+
+def main(path=None, count=10000):
+    if path:
+        catalogue = dict(iter_json_books(path))
+    else:
+        catalogue = synthetic_catalogue(count)
+
+    with tempfile.TemporaryDirectory() as directory:
+        store_path = os.path.join(directory, 'books.json')
+        Path(store_path).write_text(json.dumps(catalogue, ensure_ascii=False))
+        index_path = os.path.join(directory, 'search.db')
+        start = time.perf_counter()
+        build_index(JsonStore(store_path), index_path)
+        print(f"{len(catalogue)} books, index built in {time.perf_counter() - start:.2f}s, "
+              f"{os.path.getsize(index_path) / (1024 * 1024):.1f} MB")
+
+        start = time.perf_counter()
+        index = SearchIndex(index_path)
+        print(f"opened in {(time.perf_counter() - start) * 1000:.2f} ms")
+
+        print(f"{'query':<18}{'books':>7}{'scan ms':>10}{'index ms':>10}{'first 20 ms':>13}  same")
+        for name, query in QUERIES:
+            start = time.perf_counter()
+            expected = scan(catalogue, **query)
+            scan_ms = (time.perf_counter() - start) * 1000
+
+            repeats = 200
+            start = time.perf_counter()
+            for _ in range(repeats):
+                found = index.search(**query)
+            index_ms = (time.perf_counter() - start) * 1000 / repeats
+
+            start = time.perf_counter()
+            for _ in range(repeats):
+                first = index.search(**query, limit=20)
+            first_ms = (time.perf_counter() - start) * 1000 / repeats
+            same = found == expected and first == expected[:20]
+            print(f"{name:<18}{len(found):>7}{scan_ms:>10.2f}{index_ms:>10.3f}{first_ms:>13.3f}  {'yes' if same else 'NO'}")
+        index.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else None, int(sys.argv[2]) if len(sys.argv) > 2 else 10000)
@@ -0,0 +1,50 @@
+"""Crash-safety of the JSONL book store: a log torn mid-line must load and take new appends.
+
+    python benchmarks/check_book_store.py
+
+Writes a log, cuts it inside its last record (just the newline, or more of the
+record), reopens it, appends, and reloads. Every record except the torn one must
+come back. Exits 1 on any difference.
+"""
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from book_store import JsonlStore  # noqa: E402
+
+BOOKS = {key: {'metadata': {'title': f'Βιβλίο {key}'}, 'links': {}} for key in ('a', 'b')}
+
+
+def torn_round_trip(path, cut):
+    """Keys after tearing the log `cut` bytes before its end, appending 'c' and reloading"""
+    with JsonlStore(path) as store:
+        for key, data in BOOKS.items():
+            store.upsert(key, data)
+    os.truncate(path, os.path.getsize(path) - cut)
+
+    with JsonlStore(path) as store:
+        store.upsert('c', {'metadata': {'title': 'Βιβλίο c'}, 'links': {}})
+    reloaded = JsonlStore(path)
+    keys = list(reloaded.keys())
+    reloaded.close()
+    os.remove(path)
+    return keys
+
+
+def main():
+    failures = 0
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'books.jsonl')
+        for cut in (1, 5, 20):
+            keys = torn_round_trip(path, cut)
+            ok = keys == ['a', 'c']
+            failures += not ok
+            print(f"torn {cut:>2} bytes before the end: {keys} {'ok' if ok else 'FAILED'}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
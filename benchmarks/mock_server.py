@@ -0,0 +1,292 @@
+"""Local stand-in for openbook.gr and the file hosts, replaying the saved fixture pages.
+
+    python benchmarks/mock_server.py [--port 8090] [--pages 10] [--latency-ms 20] [--error-429 0.02]
+
+    /page/{n}/       listing-page-1.html with its book links pointed at this server and made
+                     unique per page; an empty listing after --pages pages
+    /{key}/          one of the book-*.html fixtures, picked by the key
+    /files/{name}    synthetic file of ?size= bytes (default --file-size) with ETag and Range support;
+                     ?type=pdf|epub makes it a valid file of that type, ?type=html|json an error
+                     page served as the file, and ?cut=N drops its last N bytes
+    /wp-sitemap.xml, /wp-sitemap-posts-post-{n}.xml, /wp-json/wp/v2/posts
+                     the recorded sitemap and posts API fixtures, with one post sitemap (and
+                     21 posts) per listing page and the same book urls as the listing pages
+    /stats           JSON count of the responses sent, by route and status
+
+Every route except /stats waits --latency-ms (plus up to --jitter-ms) and then answers
+429 (with Retry-After) or 500 at the configured rates, from a seeded random generator
+so runs are repeatable.
+"""
+import argparse
+import asyncio
+import hashlib
+import io
+import json
+import random
+import re
+import threading
+import zipfile
+import zlib
+from collections import Counter
+from pathlib import Path
+
+from aiohttp import web
+
+FIXTURES = Path(__file__).resolve().parent / "fixtures"
+PORT = 8090
+PAGES = 10
+FILE_SIZE = 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+SITE = 'https://www.openbook.gr'
+BOOK_LINK = re.compile(r'href="https://www\.openbook\.gr/([^"/]+)/"(\s+class="image-link")')
+SITE_BOOK = re.compile(r'https://www\.openbook\.gr/([^"<\s/]+)/')
+POST_SITEMAP_ENTRY = re.compile(r'<sitemap><loc>[^<]*posts-post-1\.xml</loc></sitemap>')
+EMPTY_LISTING = '<html><body><div class="row b-row listing meta-below grid-3"></div></body></html>'
+
+
+class MockConfig:
+    """What the mock server answers and how slowly; times in seconds, error rates in 0..1"""
+
+    def __init__(self, pages=PAGES, latency=0.0, jitter=0.0, error_429=0.0, error_500=0.0,
+                 retry_after=1, file_size=FILE_SIZE, seed=0, sitemap=True, api=True):
+        self.pages = pages
+        self.latency = latency
+        self.jitter = jitter
+        self.error_429 = error_429
+        self.error_500 = error_500
+        self.retry_after = retry_after
+        self.file_size = file_size
+        self.seed = seed
+        self.sitemap = sitemap
+        self.api = api
+
+    def as_dict(self):
+        return dict(vars(self))
+
+
+def file_body(name, size, start=0):
+    """Chunks of the deterministic content of /files/{name}, from byte `start`"""
+    block = hashlib.sha256(name.encode('utf-8')).digest() * (CHUNK_SIZE // 32)
+    position = start
+    while position < size:
+        offset = position % CHUNK_SIZE
+        chunk = block[offset:offset + min(CHUNK_SIZE - offset, size - position)]
+        yield chunk
+        position += len(chunk)
+
+
+def typed_body(name, size, kind, cut=0):
+    """The whole body of a /files/ response with ?type=, about `size` bytes"""
+    filler = b''.join(file_body(name, size))
+    if kind == 'pdf':
+        body = b'%PDF-1.7\n%' + filler + b'\ntrailer\n<< /Root 1 0 R >>\nstartxref\n0\n%%EOF\n'
+    elif kind == 'epub':
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w') as archive:
+            archive.writestr('mimetype', 'application/epub+zip', compress_type=zipfile.ZIP_STORED)
+            archive.writestr('OEBPS/content.bin', filler, compress_type=zipfile.ZIP_STORED)
+        body = buffer.getvalue()
+    elif kind == 'json':
+        body = json.dumps({'error': 'file not found', 'name': name}).encode('utf-8')
+    else:
+        body = (f'<!DOCTYPE html><html><head><title>{name}</title></head><body>'
+                f'<p>Your download will start shortly.</p></body></html>').encode('utf-8')
+    return body[:len(body) - cut] if cut else body
+
+
+def make_app(config=None):
+    config = config or MockConfig()
+    listing = (FIXTURES / "listing-page-1.html").read_text(encoding='utf-8')
+    books = [path.read_text(encoding='utf-8') for path in sorted(FIXTURES.glob("book-*.html"))]
+    sitemap_index = (FIXTURES / "wp-sitemap.xml").read_text(encoding='utf-8')
+    post_sitemap = (FIXTURES / "wp-sitemap-posts-post-1.xml").read_text(encoding='utf-8')
+    posts = json.loads((FIXTURES / "wp-json-posts.json").read_text(encoding='utf-8'))
+    stats = Counter()
+    rng = random.Random(config.seed)
+
+    async def delay_or_fault(route):
+        """Sleep the configured latency, then return an injected error response or None"""
+        wait = config.latency + (rng.random() * config.jitter if config.jitter else 0.0)
+        if wait:
+            await asyncio.sleep(wait)
+        roll = rng.random()
+        if roll < config.error_429:
+            stats[f'{route} 429'] += 1
+            return web.Response(status=429, headers={'Retry-After': str(config.retry_after)})
+        if roll < config.error_429 + config.error_500:
+            stats[f'{route} 500'] += 1
+            return web.Response(status=500)
+        return None
+
+    def html(route, text):
+        stats[f'{route} 200'] += 1
+        return web.Response(text=text, content_type='text/html')
+
+    async def handle_page(request):
+        fault = await delay_or_fault('page')
+        if fault is not None:
+            return fault
+        page = int(request.match_info['n'])
+        if page > config.pages:
+            return html('page', EMPTY_LISTING)
+        base = f'http://{request.host}'
+        return html('page', BOOK_LINK.sub(lambda m: f'href="{base}/{m.group(1)}-p{page}/"{m.group(2)}', listing))
+
+    def book_urls(text, base, page):
+        # Same url for a book as the listing page gives it (the slugs here are percent-encoded)
+        return SITE_BOOK.sub(lambda m: f'{base}/{m.group(1)}-p{page}/', text)
+
+    def xml(route, text):
+        stats[f'{route} 200'] += 1
+        return web.Response(text=text, content_type='application/xml')
+
+    async def handle_sitemap_index(request):
+        if not config.sitemap:
+            raise web.HTTPNotFound()
+        fault = await delay_or_fault('sitemap')
+        if fault is not None:
+            return fault
+        base = f'http://{request.host}'
+        entries = ''.join(f'<sitemap><loc>{base}/wp-sitemap-posts-post-{n}.xml</loc></sitemap>'
+                          for n in range(1, config.pages + 1))
+        return xml('sitemap', POST_SITEMAP_ENTRY.sub(entries, sitemap_index).replace(SITE, base))
+
+    async def handle_post_sitemap(request):
+        page = int(request.match_info['n'])
+        if not config.sitemap or page > config.pages:
+            raise web.HTTPNotFound()
+        fault = await delay_or_fault('sitemap')
+        if fault is not None:
+            return fault
+        return xml('sitemap', book_urls(post_sitemap, f'http://{request.host}', page))
+
+    async def handle_posts(request):
+        if not config.api:
+            raise web.HTTPNotFound()
+        fault = await delay_or_fault('api')
+        if fault is not None:
+            return fault
+        base = f'http://{request.host}'
+        per_page = int(request.query.get('per_page', 10))
+        page = int(request.query.get('page', 1))
+        total = len(posts) * config.pages
+        total_pages = max((total + per_page - 1) // per_page, 1)
+        if page > total_pages:
+            stats['api 400'] += 1
+            return web.json_response({'code': 'rest_post_invalid_page_number'}, status=400)
+        selected = []
+        for i in range((page - 1) * per_page, min(page * per_page, total)):
+            listing_page, post = divmod(i, len(posts))
+            selected.append(dict(posts[post], link=book_urls(posts[post]['link'], base, listing_page + 1)))
+        stats['api 200'] += 1
+        return web.json_response(selected, headers={'X-WP-Total': str(total), 'X-WP-TotalPages': str(total_pages)})
+
+    async def handle_book(request):
+        fault = await delay_or_fault('book')
+        if fault is not None:
+            return fault
+        key = request.match_info['key']
+        return html('book', books[zlib.crc32(key.encode('utf-8')) % len(books)])
+
+    async def handle_file(request):
+        fault = await delay_or_fault('file')
+        if fault is not None:
+            return fault
+        name = request.match_info['name']
+        size = int(request.query.get('size', config.file_size))
+        typed = None
+        if 'type' in request.query:
+            typed = typed_body(name, size, request.query['type'], int(request.query.get('cut', 0)))
+            size = len(typed)
+        etag = '"%s-%d"' % (hashlib.md5(name.encode('utf-8')).hexdigest(), size)
+        if request.headers.get('If-None-Match') == etag:
+            stats['file 304'] += 1
+            return web.Response(status=304, headers={'ETag': etag})
+
+        content_type = 'text/html' if request.query.get('type') == 'html' else 'application/pdf'
+        headers = {'ETag': etag, 'Accept-Ranges': 'bytes', 'Content-Type': content_type,
+                   'Content-Disposition': f'attachment; filename="{name}"'}
+        start, end, status = 0, size - 1, 200
+        match = re.match(r'bytes=(\d+)-(\d*)', request.headers.get('Range', ''))
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            if start >= size:
+                stats['file 416'] += 1
+                return web.Response(status=416, headers={'Content-Range': f'bytes */{size}'})
+            status = 206
+            headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+        headers['Content-Length'] = str(end - start + 1)
+
+        stats[f'file {status}'] += 1
+        response = web.StreamResponse(status=status, headers=headers)
+        await response.prepare(request)
+        if request.method != 'HEAD' and typed is not None:
+            await response.write(typed[start:end + 1])
+        elif request.method != 'HEAD':
+            for chunk in file_body(name, end + 1, start):
+                await response.write(chunk)
+        await response.write_eof()
+        return response
+
+    async def handle_stats(request):
+        return web.json_response(dict(stats))
+
+    app = web.Application()
+    app['config'] = config
+    app['stats'] = stats
+    app.router.add_get('/stats', handle_stats)
+    app.router.add_get('/page/{n}/', handle_page)
+    app.router.add_get('/files/{name}', handle_file)  # also answers HEAD
+    app.router.add_get('/wp-sitemap.xml', handle_sitemap_index)
+    app.router.add_get('/wp-sitemap-posts-post-{n}.xml', handle_post_sitemap)
+    app.router.add_get('/wp-json/wp/v2/posts', handle_posts)
+    app.router.add_get('/{key}/', handle_book)
+    return app
+
+
+def serve_in_thread(config=None, host='127.0.0.1', port=PORT):
+    """Start the server on its own thread and event loop; returns its base url"""
+    ready = threading.Event()
+
+    def serve():
+        loop = asyncio.new_event_loop()
+        runner = web.AppRunner(make_app(config), access_log=None)
+        loop.run_until_complete(runner.setup())
+        loop.run_until_complete(web.TCPSite(runner, host, port).start())
+        ready.set()
+        loop.run_forever()
+
+    threading.Thread(target=serve, name='mock-server', daemon=True).start()
+    ready.wait()
+    return f'http://{host}:{port}'
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Serve the benchmark fixtures and synthetic files locally.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--pages', type=int, default=PAGES, help='listing pages before the empty one')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='added to every response')
+    parser.add_argument('--jitter-ms', type=float, default=0.0, help='up to this much more, at random')
+    parser.add_argument('--error-429', type=float, default=0.0, help='share of requests answered 429')
+    parser.add_argument('--error-500', type=float, default=0.0, help='share of requests answered 500')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After seconds sent with a 429')
+    parser.add_argument('--file-size', type=int, default=FILE_SIZE, help='bytes of a /files/ response without ?size=')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-sitemap', action='store_true', help='answer 404 for the sitemaps')
+    parser.add_argument('--no-api', action='store_true', help='answer 404 for the posts API')
+    return parser.parse_args(argv)
+
+
+def config_from_args(args):
+    return MockConfig(pages=args.pages, latency=args.latency_ms / 1000, jitter=args.jitter_ms / 1000,
+                      error_429=args.error_429, error_500=args.error_500, retry_after=args.retry_after,
+                      file_size=args.file_size, seed=args.seed, sitemap=not args.no_sitemap, api=not args.no_api)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    config = config_from_args(args)
+    print(f"Serving on http://{args.host}:{args.port} with {json.dumps(config.as_dict())}", flush=True)
+    web.run_app(make_app(config), host=args.host, port=args.port, print=None, access_log=None)
@@ -0,0 +1,338 @@
+"""Offline benchmark suite: parse, async crawl, serial crawl and downloads against the mock server.
+
+    python benchmarks/suite.py [--out results.json] [--compare before.json] [--scenarios crawl_async download]
+                               [--pages 10] [--latency-ms 10] [--error-429 0.02] [--error-500 0.01]
+
+Needs no network: pages come from benchmarks/mock_server.py, replaying the fixtures,
+started as a separate process for each scenario. Every scenario also runs in its own
+process so its peak RSS is its own. Reports pages/s, parse ms/page, MB/s, p50/p99
+request latency and peak RSS as JSON; --compare prints the change against an
+earlier results file.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from contextlib import redirect_stdout
+from io import StringIO
+from pathlib import Path
+
+HERE = Path(__file__).resolve().parent
+sys.path.insert(0, str(HERE.parent))
+
+SCENARIOS = ['parse', 'crawl_async', 'crawl_serial', 'download']
+RESULTS = 'benchmark-results.json'
+SERVER_START_TIMEOUT = 10  # seconds
+
+
+class Latencies:
+    """Every observed duration, for exact percentiles"""
+
+    def __init__(self):
+        self.values = []
+
+    def add(self, seconds):
+        self.values.append(seconds)
+
+    def percentile(self, q):
+        if not self.values:
+            return None
+        ordered = sorted(self.values)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+    def summary(self):
+        return {'count': len(self.values),
+                'p50_ms': _ms(self.percentile(0.5)),
+                'p99_ms': _ms(self.percentile(0.99))}
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 3) if seconds is not None else None
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)  # bytes on macOS, KB elsewhere
+
+
+def counter_totals(family):
+    return {','.join(values): child.value for values, child in family.children.items()}
+
+
+# Scenarios, each run in a child process (the working directory is a fresh temp dir)
+
+def run_parse(args, base):
+    from bench_parse import FIXTURES, parse_book, parse_listing
+    from parsing import BACKENDS
+
+    books = [path.read_bytes() for path in sorted(FIXTURES.glob("book-*.html"))]
+    listings = [path.read_bytes() for path in sorted(FIXTURES.glob("listing-*.html"))]
+    result = {}
+    for backend in BACKENDS:
+        timings = {}
+        for kind, pages, parse in (('book', books, parse_book), ('listing', listings, parse_listing)):
+            start = time.perf_counter()
+            for _ in range(args.repeats):
+                for content in pages:
+                    parse(content, backend, True)
+            timings[kind] = (time.perf_counter() - start) * 1000 / (args.repeats * len(pages))
+        result[backend] = {'book_ms_per_page': round(timings['book'], 3),
+                           'listing_ms_per_page': round(timings['listing'], 3),
+                           'book_pages_per_second': round(1000 / timings['book'], 1)}
+    return result
+
+
+def crawl_result(store, elapsed, latencies):
+    from metrics import PAGES, RETRIES
+
+    pages = sum(counter_totals(PAGES).values())
+    books = len(store)
+    store.close()
+    return {'books': books, 'pages': pages, 'seconds': round(elapsed, 3),
+            'pages_per_second': round(pages / elapsed, 1), 'latency': latencies.summary(),
+            'retries': sum(counter_totals(RETRIES).values())}
+
+
+def run_crawl_async(args, base):
+    import crawler
+    import discovery
+    import listing
+    from book_store import open_store
+
+    listing.LISTING_URL = base + '/page/{page}/?s'
+    discovery.SITEMAP_URLS = (base + '/wp-sitemap.xml',)
+    discovery.WP_POSTS_URL = base + '/wp-json/wp/v2/posts?per_page={per_page}&page={page}'
+    latencies = Latencies()
+    cached_get_async = crawler.cached_get_async
+
+    async def timed_get(session, url, cache):
+        start = time.perf_counter()
+        response = await cached_get_async(session, url, cache)
+        latencies.add(time.perf_counter() - start)
+        return response
+
+    crawler.cached_get_async = timed_get
+    store = open_store('books.jsonl', import_from=None)
+    bench = crawler.Crawler(store, detail_workers=args.workers, per_host=args.per_host, rate=args.rate,
+                            parse_workers=args.parse_workers, discover=args.discover)
+    start = time.perf_counter()
+    asyncio.run(bench.run())
+    return crawl_result(store, time.perf_counter() - start, latencies)
+
+
+def run_crawl_serial(args, base):
+    from requests.adapters import HTTPAdapter
+
+    import listing
+    from book_store import open_store
+    from main import crawl_serial
+    from rate_limit import HostLimiter
+    from sessions import PooledSession
+
+    listing.LISTING_URL = base + '/page/{page}/?s'
+    latencies = Latencies()
+
+    class TimedAdapter(HTTPAdapter):
+        def send(self, request, **kwargs):
+            start = time.perf_counter()
+            response = super().send(request, **kwargs)  # reads the body too, requests don't stream here
+            latencies.add(time.perf_counter() - start)
+            return response
+
+    store = open_store('books.jsonl', import_from=None)
+    with PooledSession(limiter=HostLimiter(rate=args.rate, per_host=None)) as session:
+        session.mount('http://', TimedAdapter())
+        start = time.perf_counter()
+        crawl_serial(1, store, session)
+    return crawl_result(store, time.perf_counter() - start, latencies)
+
+
+def run_download(args, base):
+    import aiohttp
+
+    import pdfs
+    from rate_limit import HostLimiter
+
+    latencies = Latencies()
+    limiter = HostLimiter(rate=args.rate, per_host=args.connections)
+    size = args.file_mb * 1024 * 1024
+
+    async def download_all():
+        slots = asyncio.Semaphore(args.connections)
+
+        async def one(session, i):
+            async with slots:
+                start = time.perf_counter()
+                success, _ = await pdfs.download_file(session, f'{base}/files/file{i}.pdf?size={size}',
+                                                      'downloads', limiter=limiter)
+                latencies.add(time.perf_counter() - start)
+                return success
+
+        async with aiohttp.ClientSession(connector=pdfs.make_connector()) as session:
+            return await asyncio.gather(*(one(session, i) for i in range(args.files)))
+
+    start = time.perf_counter()
+    results = asyncio.run(download_all())
+    elapsed = time.perf_counter() - start
+    done = sum(1 for success in results if success)
+    return {'files': args.files, 'completed': done, 'seconds': round(elapsed, 3),
+            'mb_per_second': round(done * args.file_mb / elapsed, 1), 'latency': latencies.summary()}
+
+
+RUNNERS = {
+    'parse': run_parse,
+    'crawl_async': run_crawl_async,
+    'crawl_serial': run_crawl_serial,
+    'download': run_download,
+}
+
+
+def run_child(args):
+    sys.path.insert(0, str(HERE))
+    with tempfile.TemporaryDirectory(prefix=f'bench-{args.child}-') as directory:
+        os.chdir(directory)
+        with redirect_stdout(StringIO()):  # progress prints of the crawl
+            result = RUNNERS[args.child](args, args.base)
+        os.chdir(HERE)
+    result['peak_rss_mb'] = peak_rss_mb()
+    Path(args.result).write_text(json.dumps(result))
+
+
+# Parent: one mock server and one child per scenario
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def server_stats(base):
+    with urllib.request.urlopen(base + '/stats', timeout=5) as response:
+        return json.loads(response.read())
+
+
+def start_server(args):
+    port = free_port()
+    server = subprocess.Popen(
+        [sys.executable, str(HERE / 'mock_server.py'), '--port', str(port), '--pages', str(args.pages),
+         '--latency-ms', str(args.latency_ms), '--jitter-ms', str(args.jitter_ms),
+         '--error-429', str(args.error_429), '--error-500', str(args.error_500),
+         '--retry-after', str(args.retry_after), '--seed', str(args.seed)],
+        stdout=subprocess.DEVNULL,
+    )
+    base = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while True:
+        try:
+            server_stats(base)
+            return server, base
+        except OSError:
+            if time.monotonic() > deadline or server.poll() is not None:
+                server.kill()
+                raise RuntimeError('mock server did not start')
+            time.sleep(0.05)
+
+
+def run_scenario(name, argv, args):
+    server, base = (None, '') if name == 'parse' else start_server(args)
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            result_path = os.path.join(directory, 'result.json')
+            subprocess.run([sys.executable, __file__, *argv, '--child', name, '--base', base,
+                            '--result', result_path], check=True)
+            result = json.loads(Path(result_path).read_text())
+        if server is not None:
+            result['server_responses'] = server_stats(base)
+        return result
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+
+def flatten(result, prefix=''):
+    """{'a': {'b': 1}} -> {'a.b': 1}, numbers only"""
+    values = {}
+    for key, value in result.items():
+        if isinstance(value, dict):
+            values.update(flatten(value, f'{prefix}{key}.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[prefix + key] = value
+    return values
+
+
+def compare(before, after):
+    old, new = flatten(before['scenarios']), flatten(after['scenarios'])
+    print(f"{'metric':<52}{'before':>12}{'after':>12}{'change':>10}")
+    for key, value in new.items():
+        if key not in old or '.server_responses.' in key:
+            continue
+        change = f"{(value - old[key]) * 100 / old[key]:+.1f}%" if old[key] else ''
+        print(f"{key:<52}{old[key]:>12}{value:>12}{change:>10}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Run the offline benchmarks and write the results as JSON.')
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument('--out', default=RESULTS, help='results file (empty to skip)')
+    parser.add_argument('--compare', help='earlier results file to compare against')
+    parser.add_argument('--repeats', type=int, default=20, help='parse passes over the fixtures')
+    parser.add_argument('--pages', type=int, default=10, help='listing pages served (21 books each)')
+    parser.add_argument('--latency-ms', type=float, default=10.0)
+    parser.add_argument('--jitter-ms', type=float, default=10.0)
+    parser.add_argument('--error-429', type=float, default=0.0)
+    parser.add_argument('--error-500', type=float, default=0.0)
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--rate', type=float, default=1000.0, help='requests/s per host allowed by the limiter')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--per-host', type=int, default=8)
+    parser.add_argument('--parse-workers', type=int, default=0)
+    parser.add_argument('--discover', choices=['listing', 'sitemap', 'api', 'auto'], default='listing',
+                        help='how crawl_async finds the books')
+    parser.add_argument('--files', type=int, default=16)
+    parser.add_argument('--file-mb', type=int, default=16)
+    parser.add_argument('--connections', type=int, default=4)
+    parser.add_argument('--child', choices=SCENARIOS, help=argparse.SUPPRESS)
+    parser.add_argument('--base', help=argparse.SUPPRESS)
+    parser.add_argument('--result', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    args = parse_args(argv)
+    if args.child:
+        run_child(args)
+        return
+
+    settings = {key: value for key, value in vars(args).items()
+                if key not in ('scenarios', 'out', 'compare', 'child', 'base', 'result')}
+    results = {
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                        'cpus': os.cpu_count(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S')},
+        'settings': settings,
+        'scenarios': {},
+    }
+    for name in args.scenarios:
+        print(f"Running {name}...", flush=True)
+        results['scenarios'][name] = run_scenario(name, argv, args)
+        print(json.dumps(results['scenarios'][name], indent=4))
+
+    if args.out:
+        Path(args.out).write_text(json.dumps(results, indent=4))
+        print(f"Results written to {args.out}")
+    if args.compare:
+        compare(json.loads(Path(args.compare).read_text()), results)
+
+
+if __name__ == "__main__":
+    main()
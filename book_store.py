@@ -0,0 +1,377 @@
+import json
+import os
+import sqlite3
+import sys
+
+from catalogue import CompactCatalogue
+
+BOOKS_JSON = 'books.json'
+BOOKS_STORE = 'books.db'
+ITER_BATCH = 500  # rows a SqliteStore scan holds in memory at once
+READ_CHUNK = 64 * 1024
+
+# What pdfs.py adds to a book; a re-crawled book keeps them so its files aren't fetched again
+DOWNLOAD_FLAGS = ('scraped', 'audio_book', 'has_audio', 'has_mobile_apps')
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+
+def atomic_write_text(path, text):
+    """Write to a temp file and rename it over `path`, so a crash never leaves a half written file"""
+    atomic_write_chunks(path, [text])
+
+
+def atomic_write_chunks(path, chunks):
+    """atomic_write_text for text produced piece by piece"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for chunk in chunks:
+            f.write(chunk)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def iter_json_books(path=BOOKS_JSON):
+    """Yield (key, data) from a books.json file without loading the whole file.
+
+    Uses ijson when it is installed, otherwise decodes one entry at a time from a
+    sliding buffer of the file.
+    """
+    with open(path, 'rb' if ijson else 'r', encoding=None if ijson else 'utf-8') as f:
+        if ijson is not None:
+            yield from ijson.kvitems(f, '', use_float=True)
+            return
+
+        decoder = json.JSONDecoder()
+        buffer, pos, eof = '', 0, False
+
+        def skip(chars):
+            # Move past whitespace and the given separators, reading more as needed
+            nonlocal buffer, pos, eof
+            while True:
+                while pos < len(buffer) and (buffer[pos].isspace() or buffer[pos] in chars):
+                    pos += 1
+                if pos < len(buffer) or eof:
+                    return
+                buffer, pos = f.read(READ_CHUNK), 0
+                eof = not buffer
+
+        def decode():
+            nonlocal buffer, pos, eof
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buffer, pos)
+                    if end < len(buffer) or eof:  # a number could continue in the next chunk
+                        pos = end
+                        return value
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                more = f.read(READ_CHUNK)
+                eof = not more
+                buffer, pos = buffer[pos:] + more, 0
+
+        skip('')
+        if buffer[pos:pos + 1] != '{':
+            raise ValueError(f"{path} is not a JSON object")
+        pos += 1
+        while True:
+            skip(',')
+            if pos >= len(buffer) or buffer[pos] == '}':
+                return
+            key = decode()
+            skip(':')
+            yield key, decode()
+
+
+class BookStore:
+    """Book catalogue keyed by book key, with the same values as books.json.
+
+    Behaves like a dict (`in`, `get`, `[]`, `len`, `items`) so the crawler and the
+    downloader can use it in place of the old all_books_dict. Writes are per book;
+    call flush() at checkpoints.
+    """
+
+    def upsert(self, key, data):
+        raise NotImplementedError
+
+    def get(self, key, default=None):
+        raise NotImplementedError
+
+    def keys(self):
+        raise NotImplementedError
+
+    def items(self):
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        data = self.get(key)
+        if data is None:
+            raise KeyError(key)
+        return data
+
+    def __setitem__(self, key, data):
+        self.upsert(key, data)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class JsonStore(BookStore):
+    """The original single books.json file, now rewritten atomically on flush.
+
+    With `compact` the books are held as a catalogue.CompactCatalogue, streamed in
+    from the file, so large catalogues take a fraction of the memory.
+    """
+
+    def __init__(self, path=BOOKS_JSON, indent=4, compact=False):
+        self.path = path
+        self.indent = indent
+        self._dirty = False
+        if compact:
+            self.books = CompactCatalogue(iter_json_books(path) if os.path.exists(path) else ())
+            return
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                self.books = json.load(f)
+        except FileNotFoundError:
+            self.books = {}
+
+    def upsert(self, key, data):
+        self.books[key] = data
+        self._dirty = True
+
+    def get(self, key, default=None):
+        return self.books.get(key, default)
+
+    def keys(self):
+        return self.books.keys()
+
+    def items(self):
+        return self.books.items()
+
+    def __len__(self):
+        return len(self.books)
+
+    def flush(self):
+        if self._dirty:
+            atomic_write_chunks(self.path, json_chunks(self.books.items(), self.indent))
+            self._dirty = False
+
+
+class JsonlStore(BookStore):
+    """Append-only log of {"key": ..., "data": ...} lines; the last line for a key wins.
+
+    A torn last line from a crash (one without its newline) is ignored on load and cut
+    off the file, so the next append starts on a line of its own. compact() rewrites
+    the log with one line per book once it holds more than `compact_ratio` times as
+    many lines.
+    With `compact_memory` the books are held as a catalogue.CompactCatalogue.
+    """
+
+    def __init__(self, path='books.jsonl', compact_ratio=2.0, compact_memory=False):
+        self.path = path
+        self.compact_ratio = compact_ratio
+        self.books = CompactCatalogue() if compact_memory else {}
+        self.lines = 0
+        try:
+            with open(path, 'rb') as f:
+                end = 0  # offset just past the last complete line
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break
+                    end += len(line)
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.books[record['key']] = record['data']
+                    self.lines += 1
+            if end != os.path.getsize(path):
+                os.truncate(path, end)
+        except FileNotFoundError:
+            pass
+        self._log = open(path, 'a', encoding='utf-8')
+
+    def upsert(self, key, data):
+        self.books[key] = data
+        self._log.write(json.dumps({'key': key, 'data': data}, ensure_ascii=False) + '\n')
+        self.lines += 1
+
+    def get(self, key, default=None):
+        return self.books.get(key, default)
+
+    def keys(self):
+        return self.books.keys()
+
+    def items(self):
+        return self.books.items()
+
+    def __len__(self):
+        return len(self.books)
+
+    def flush(self):
+        self._log.flush()
+        os.fsync(self._log.fileno())
+        if self.lines > self.compact_ratio * max(len(self.books), 1):
+            self.compact()
+
+    def compact(self):
+        self._log.close()
+        atomic_write_chunks(self.path, (
+            json.dumps({'key': key, 'data': data}, ensure_ascii=False) + '\n' for key, data in self.books.items()
+        ))
+        self.lines = len(self.books)
+        self._log = open(self.path, 'a', encoding='utf-8')
+
+    def close(self):
+        self.flush()
+        self._log.close()
+
+
+class SqliteStore(BookStore):
+    """SQLite table of books indexed on key and on the downloader's `scraped` flag.
+
+    items() and unscraped() read the table in batches of ITER_BATCH rows, so a scan
+    holds little memory and books can be upserted while it runs.
+    """
+
+    def __init__(self, path=BOOKS_STORE):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS books ('
+            ' key TEXT PRIMARY KEY,'
+            ' scraped INTEGER NOT NULL DEFAULT 0,'
+            ' data TEXT NOT NULL)'
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS books_scraped ON books (scraped)')
+        self.conn.commit()
+
+    def upsert(self, key, data):
+        self.conn.execute(
+            'INSERT INTO books (key, scraped, data) VALUES (?, ?, ?) '
+            'ON CONFLICT(key) DO UPDATE SET scraped = excluded.scraped, data = excluded.data',
+            (key, int(bool(data.get('scraped', False))), json.dumps(data, ensure_ascii=False)),
+        )
+
+    def get(self, key, default=None):
+        row = self.conn.execute('SELECT data FROM books WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def __contains__(self, key):
+        return self.conn.execute('SELECT 1 FROM books WHERE key = ?', (key,)).fetchone() is not None
+
+    def keys(self):
+        return [row[0] for row in self.conn.execute('SELECT key FROM books ORDER BY rowid')]
+
+    def _scan(self, where='1'):
+        last = 0
+        while True:
+            rows = self.conn.execute(
+                f'SELECT rowid, key, data FROM books WHERE rowid > ? AND {where} ORDER BY rowid LIMIT ?',
+                (last, ITER_BATCH),
+            ).fetchall()
+            for last, key, data in rows:
+                yield key, json.loads(data)
+            if len(rows) < ITER_BATCH:
+                return
+
+    def items(self):
+        return self._scan()
+
+    def unscraped(self):
+        return self._scan('scraped = 0')
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM books').fetchone()[0]
+
+    def flush(self):
+        self.conn.commit()
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+def open_store(path=BOOKS_STORE, import_from=BOOKS_JSON, compact=False):
+    """Open the store matching the file extension (.json, .jsonl, .db/.sqlite).
+
+    A new jsonl/sqlite store is seeded from `import_from` (books.json) when that exists.
+    `compact` packs the in-memory books of a json/jsonl store (sqlite keeps them on disk).
+    """
+    if path.endswith('.json'):
+        return JsonStore(path, compact=compact)
+
+    store = JsonlStore(path, compact_memory=compact) if path.endswith('.jsonl') else SqliteStore(path)
+    if len(store) == 0 and import_from and os.path.exists(import_from):
+        import_json(store, import_from)
+    return store
+
+
+def import_json(store, path=BOOKS_JSON):
+    count = 0
+    for key, data in iter_json_books(path):
+        store.upsert(key, data)
+        count += 1
+    store.flush()
+    return count
+
+
+def json_chunks(items, indent=4):
+    """The books.json text of (key, data) pairs, one book at a time"""
+    empty = True
+    for key, data in items:
+        # Same text json.dumps gives for the whole dict, without building it
+        entry = json.dumps({key: data}, indent=indent, ensure_ascii=False)
+        yield ('{' if empty else ',') + entry[1:-2]
+        empty = False
+    yield '{}' if empty else '\n}'
+
+
+def export_json(store, path=BOOKS_JSON, indent=4):
+    """Write the store out in the books.json layout, one book at a time"""
+    atomic_write_chunks(path, json_chunks(store.items(), indent))
+    return len(store)
+
+
+if __name__ == '__main__':
+    # python book_store.py export|import|compact [store] [books.json]
+    command = sys.argv[1] if len(sys.argv) > 1 else 'export'
+    store_path = sys.argv[2] if len(sys.argv) > 2 else BOOKS_STORE
+    json_path = sys.argv[3] if len(sys.argv) > 3 else BOOKS_JSON
+
+    with open_store(store_path, import_from=None) as store:
+        if command == 'export':
+            print(f"Exported {export_json(store, json_path)} books to {json_path}")
+        elif command == 'import':
+            print(f"Imported {import_json(store, json_path)} books from {json_path}")
+        elif command == 'compact' and isinstance(store, JsonlStore):
+            store.compact()
+            print(f"Compacted {store_path} to {len(store)} books")
+        else:
+            print(f"Unknown command {command}")
@@ -0,0 +1,98 @@
+import sys
+import zlib
+
+INTERN_MAX_LENGTH = 40  # tags, authors, link types, years, page counts; not urls or descriptions
+COMPRESS_MIN_LENGTH = 256  # descriptions: zlib'd UTF-8 is a third to a half of the str
+
+# Key tuples (and short string tuples such as tag lists) shared by every book that has them
+_SHARED = {}
+
+
+class Record:
+    """A dict held as a shared tuple of its keys and a tuple of its values"""
+
+    __slots__ = ('shape', 'values')
+
+    def __init__(self, shape, values):
+        self.shape = shape
+        self.values = values
+
+
+def _share(items):
+    return _SHARED.setdefault(items, items)
+
+
+def pack(value):
+    """Compact form of a books.json value: dicts become Records, lists tuples, short strings are
+    interned and long ones compressed (JSON has no bytes, so bytes always mean a packed string)
+    """
+    if isinstance(value, str):
+        if len(value) <= INTERN_MAX_LENGTH:
+            return sys.intern(value)
+        if len(value) >= COMPRESS_MIN_LENGTH:
+            packed = zlib.compress(value.encode('utf-8'))
+            if sys.getsizeof(packed) < sys.getsizeof(value):
+                return packed
+        return value
+    if isinstance(value, dict):
+        return Record(_share(tuple(pack(key) for key in value)), tuple(pack(item) for item in value.values()))
+    if isinstance(value, list):
+        items = tuple(pack(item) for item in value)
+        if all(isinstance(item, str) and len(item) <= INTERN_MAX_LENGTH for item in items):
+            return _share(items)
+        return items
+    return value
+
+
+def unpack(value):
+    """The books.json value `pack` was given, with the same key order"""
+    if isinstance(value, Record):
+        return {key: unpack(item) for key, item in zip(value.shape, value.values)}
+    if isinstance(value, tuple):
+        return [unpack(item) for item in value]
+    if isinstance(value, bytes):
+        return zlib.decompress(value).decode('utf-8')
+    return value
+
+
+class CompactCatalogue:
+    """Books keyed by book key, held packed; reads give back fresh book_dict values.
+
+    A book costs a few hundred bytes plus its unique text (title, description, urls)
+    instead of three dicts and a list with their own copies of every string. Changes
+    to a returned dict are kept only once it is stored again.
+    """
+
+    def __init__(self, books=()):
+        self.books = {}
+        for key, data in (books.items() if hasattr(books, 'items') else books):
+            self[key] = data
+
+    def __setitem__(self, key, data):
+        self.books[key] = pack(data)
+
+    def get(self, key, default=None):
+        packed = self.books.get(key)
+        return unpack(packed) if packed is not None else default
+
+    def __getitem__(self, key):
+        return unpack(self.books[key])
+
+    def __contains__(self, key):
+        return key in self.books
+
+    def __len__(self):
+        return len(self.books)
+
+    def __iter__(self):
+        return iter(self.books)
+
+    def keys(self):
+        return self.books.keys()
+
+    def items(self):
+        for key, packed in self.books.items():
+            yield key, unpack(packed)
+
+    def to_dict(self):
+        return dict(self.items())
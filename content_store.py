@@ -0,0 +1,160 @@
+import fcntl
+import json
+import os
+import shutil
+import threading
+from pathlib import Path
+
+from book_store import atomic_write_text
+
+CONTENT_INDEX = Path("downloads") / "content_index.json"
+FICLONE = 0x40049409  # Linux ioctl for a copy-on-write clone (btrfs, xfs)
+
+
+def link_file(source, destination):
+    """Make `destination` share `source`'s data: reflink, else hardlink, else a plain copy"""
+    destination = str(destination)
+    if os.path.exists(destination):
+        if os.path.samefile(source, destination):
+            return
+        os.remove(destination)
+    os.makedirs(os.path.dirname(destination) or '.', exist_ok=True)
+
+    try:
+        with open(source, 'rb') as src, open(destination, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return
+    except OSError:
+        if os.path.exists(destination):
+            os.remove(destination)
+
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+class ContentStore:
+    """Index of downloaded files by SHA-256, and of urls (with their ETag) to hashes.
+
+    The first file downloaded with a given hash is the stored copy; later files with
+    the same content are linked to it instead of kept twice. A url whose recorded ETag
+    the server confirms with a 304 is linked without transferring it again.
+    Downloads call add and link_known on FileWriter threads while the event loop saves
+    and looks up urls, so the index is only touched under a lock.
+    """
+
+    def __init__(self, index_path=CONTENT_INDEX):
+        self.index_path = Path(index_path)
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            index = {}
+        self.hashes = index.get('hashes', {})  # sha256 -> path of the stored copy
+        self.urls = index.get('urls', {})  # url -> {etag, sha256, filename, size}
+        self.stats = {'linked': 0, 'skipped_fetches': 0, 'bytes_saved': 0}
+        self._lock = threading.Lock()
+
+    def known_url(self, url):
+        with self._lock:
+            record = self.urls.get(url)
+            if record and record.get('etag') and self._path_for(record['sha256']):
+                return record
+        return None
+
+    def path_for(self, digest):
+        with self._lock:
+            return self._path_for(digest)
+
+    def _path_for(self, digest):
+        path = self.hashes.get(digest)
+        if path and os.path.exists(path):
+            return path
+        self.hashes.pop(digest, None)
+        return None
+
+    def link_known(self, url, destination_dir):
+        """Link the recorded content of `url` into destination_dir after a 304. Returns the path or None."""
+        with self._lock:
+            record = self.urls[url]
+            source = self._path_for(record['sha256'])
+        if source is None:
+            return None
+        file_path = os.path.join(destination_dir, record['filename'])
+        link_file(source, file_path)
+        with self._lock:
+            self.stats['skipped_fetches'] += 1
+            self.stats['bytes_saved'] += record.get('size', 0)
+        return file_path
+
+    def add(self, url, etag, digest, file_path):
+        """Record a finished download, replacing it with a link when the content is already stored"""
+        size = os.path.getsize(file_path)
+        with self._lock:
+            # Check and claim in one step, so of two equal files finishing together only one is the stored copy
+            source = self._path_for(digest)
+            if source is None:
+                self.hashes[digest] = str(file_path)
+        if source is not None and not os.path.samefile(source, file_path):
+            link_file(source, file_path)  # outside the lock: a plain copy can take a while
+            with self._lock:
+                self.stats['linked'] += 1
+                self.stats['bytes_saved'] += size
+
+        with self._lock:
+            self.urls[url] = {
+                'etag': etag,
+                'sha256': digest,
+                'filename': os.path.basename(file_path),
+                'size': size,
+            }
+
+    def merge(self, other):
+        """Take in another ContentStore's index (a download shard's); files it stored whose
+        content this index already has are linked to the stored copy.
+
+        The other store's own links to such a file are found by inode under the index's
+        directory and linked too.
+        """
+        with self._lock:
+            self._merge(other)
+
+    def _merge(self, other):
+        replaced = {}  # (device, inode) of a replaced copy that had other links -> stored copy
+        for digest, path in other.hashes.items():
+            if not os.path.exists(path):
+                continue
+            source = self._path_for(digest)
+            if source is None:
+                self.hashes[digest] = path
+            elif not os.path.samefile(source, path):
+                info = os.stat(path)
+                if info.st_nlink > 1:
+                    replaced[(info.st_dev, info.st_ino)] = source
+                link_file(source, path)
+                self.stats['linked'] += 1
+                self.stats['bytes_saved'] += info.st_size
+        self.urls.update(other.urls)
+
+        for directory, _, names in os.walk(self.index_path.parent) if replaced else ():
+            for name in names:
+                path = os.path.join(directory, name)
+                info = os.stat(path)
+                source = replaced.get((info.st_dev, info.st_ino))
+                if source is not None:
+                    link_file(source, path)
+                    self.stats['linked'] += 1
+                    self.stats['bytes_saved'] += info.st_size
+
+    def save(self):
+        self.index_path.parent.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            text = json.dumps({'hashes': self.hashes, 'urls': self.urls}, ensure_ascii=False)
+        atomic_write_text(self.index_path, text)
+
+    def summary(self):
+        with self._lock:
+            return (f"{len(self.hashes)} unique files, {self.stats['linked']} duplicates linked, "
+                    f"{self.stats['skipped_fetches']} fetches skipped, "
+                    f"{self.stats['bytes_saved'] / (1024**2):.1f} MB saved")
@@ -0,0 +1,327 @@
+import asyncio
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import aiohttp
+
+from book_store import DOWNLOAD_FLAGS, atomic_write_text
+from BookScraper import BookScraper, book_key_from_url, parse_book
+from discovery import DISCOVERY_STATE, DiscoveryState, discover_books
+from http_cache import cached_get_async
+from listing import BOOKS_PER_PAGE, listing_url, parse_page_links
+from metrics import HTTP_RESPONSES, PAGES, QUEUE_DEPTH, RETRIES, stage
+from rate_limit import RETRY_STATUSES, HostLimiter
+from sessions import POOL_SIZE, TIMEOUT, ConnectionStats, make_aiohttp_session
+
+
+FETCH_RETRIES = 4
+
+
+class Crawler:
+    """Concurrent listing + detail crawl with the same resume files as the serial loop.
+
+    Listing workers fetch `/page/{n}/?s` and feed a bounded queue of book urls, detail
+    workers consume it. A page is committed to the book store (and completed_pages.txt)
+    only once it and every page before it are fully scraped, so the cursor keeps its
+    meaning and the output keeps the page order of the serial crawl.
+
+    With `incremental` the walk starts from the newest page, only books missing from
+    the store are scraped, and it stops after `stop_after` consecutive listing
+    pages with no new book. completed_pages.txt is left alone in that mode since
+    page numbers shift as books are published.
+
+    With `discover` ('sitemap', 'api' or 'auto') the book urls come from the WordPress
+    sitemap / posts API instead of the listing pages, and only books missing from the
+    store or modified since the last such crawl are scraped. They are committed in
+    groups of BOOKS_PER_PAGE like listing pages. If discovery finds nothing the
+    listing pages are walked as usual. A book whose fetch fails keeps its stored entry
+    and is left out of the discovery state, so the next crawl tries it again.
+
+    A shard worker (shards.py) passes `end_page` to stop after a page range, or a
+    `key_filter` to scrape only the books whose key it accepts.
+    """
+
+    def __init__(self, store, start_page=1, detail_workers=8, listing_workers=2,
+                 per_host=4, rate=5.0, queue_size=64, pool_size=POOL_SIZE, timeout=TIMEOUT,
+                 cache=None, parser=None, parse_workers=0, incremental=False, stop_after=2,
+                 progress_path='completed_pages.txt', discover=None, discovery_state_path=DISCOVERY_STATE,
+                 end_page=None, key_filter=None):
+        self.store = store
+        self.detail_workers = detail_workers
+        self.listing_workers = listing_workers
+        self.limiter = HostLimiter(rate=rate, per_host=per_host)
+        self.per_host = per_host
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.connection_stats = ConnectionStats()
+        self.cache = cache
+        self.parser = parser
+        # With parse_workers > 0 book pages are parsed in a process pool, fed through a
+        # bounded queue of fetched pages
+        self.parse_workers = parse_workers
+        self.parse_pool = None
+        self.parse_queue = asyncio.Queue(maxsize=max(2 * parse_workers, 1))
+        self.incremental = incremental
+        self.stop_after = stop_after
+        if incremental:
+            self.listing_workers = 1  # the known-page streak needs pages in order
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.progress_path = progress_path
+        self.discover = discover if discover != 'listing' else None
+        self.discovery_state_path = discovery_state_path
+        self._listing = True  # False once the urls come from discovery
+        self.key_filter = key_filter
+
+        self._next_page = start_page
+        self._cursor = start_page - 1  # last committed page
+        self._stop_page = end_page + 1 if end_page else None  # first page not crawled: past end_page or without links
+        self._pending = {}
+        self._results = {}
+        self._known_streak = 0
+        self._failed = set()  # keys of books whose page could not be fetched
+
+    async def fetch(self, session, url, stage_name='detail_fetch', use_cache=True):
+        # Retries 429/5xx and connection errors, the limiter decides how long to back off
+        for attempt in range(FETCH_RETRIES):
+            last_attempt = attempt == FETCH_RETRIES - 1
+            host = await self.limiter.acquire(url)
+            started = time.monotonic()
+            try:
+                with stage(stage_name):
+                    response = await cached_get_async(session, url, self.cache if use_cache else None)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self.limiter.report(host, error=True)
+                HTTP_RESPONSES.labels('crawler', 'error').inc()
+                if last_attempt:
+                    raise
+                RETRIES.labels('crawler').inc()
+                print(f"Retrying {url} after error: {e}")
+                continue
+            finally:
+                self.limiter.release(host)
+
+            self.limiter.report(host, response.status, time.monotonic() - started,
+                                response.headers.get('Retry-After'))
+            HTTP_RESPONSES.labels('crawler', str(response.status)).inc()
+            if response.status not in RETRY_STATUSES or last_attempt:
+                return response
+            RETRIES.labels('crawler').inc()
+            print(f"Retrying {url} after status {response.status}")
+
+    def _stopped(self, page):
+        return self._stop_page is not None and page >= self._stop_page
+
+    async def listing_worker(self, session):
+        while True:
+            page = self._next_page
+            if self._stopped(page):
+                return
+            self._next_page += 1
+
+            print(f"Scraping page {page}...")
+            links = None
+            try:
+                response = await self.fetch(session, listing_url(page), 'listing_fetch')
+                if response.status == 200:
+                    PAGES.labels('listing').inc()
+                    with stage('listing_parse'):
+                        links = parse_page_links(response.content, page, self.parser)
+                else:
+                    print(f"Failed to retrieve the webpage for page {page}. Status code: {response.status}")
+            except Exception as e:
+                print(f"An error occurred in crawler listing_worker for page {page}: {e}")
+
+            if not links:
+                print(f"No links found on page {page}. Stopping the program.")
+                if self._stop_page is None or page < self._stop_page:
+                    self._stop_page = page
+                return
+
+            if self.incremental:
+                links = self.new_links(page, links)
+            if self.key_filter is not None:
+                links = [link for link in links if self.key_filter(book_key_from_url(link))]
+
+            self._pending[page] = len(links)
+            self._results[page] = [None] * len(links)
+            if not links:
+                self.commit_ready_pages()
+            for index, link in enumerate(links):
+                await self.queue.put((page, index, link))
+
+    async def feed_worker(self, books):
+        # Discovered urls, committed in pseudo pages of BOOKS_PER_PAGE
+        for start in range(0, len(books), BOOKS_PER_PAGE):
+            page = self._next_page
+            self._next_page += 1
+            links = [book.url for book in books[start:start + BOOKS_PER_PAGE]]
+            self._pending[page] = len(links)
+            self._results[page] = [None] * len(links)
+            for index, link in enumerate(links):
+                await self.queue.put((page, index, link))
+
+    async def discovered_books(self, session):
+        """Books to scrape according to the sitemap / posts API, or None to walk the listing pages"""
+        books = await discover_books(
+            lambda url: self.fetch(session, url, 'discovery_fetch', use_cache=False), self.discover)
+        if books is None:
+            print(f"Discovery ({self.discover}) found no books, walking the listing pages instead")
+            return None, None
+        if self.key_filter is not None:
+            books = [book for book in books if self.key_filter(book_key_from_url(book.url))]
+        state = DiscoveryState(self.discovery_state_path)
+        changed = state.changed(books, self.store)
+        print(f"Discovered {len(books)} books, {len(changed)} new or modified")
+        self._listing = False
+        self._next_page = 1
+        self._cursor = 0
+        return changed, state
+
+    def new_links(self, page, links):
+        new = []
+        for link in links:
+            if book_key_from_url(link) not in self.store and link not in new:
+                new.append(link)
+
+        if new:
+            self._known_streak = 0
+            print(f"Found {len(new)} new books on page {page}")
+        else:
+            self._known_streak += 1
+            if self._known_streak >= self.stop_after:
+                print(f"No new books on the last {self._known_streak} pages. Stopping the program.")
+                self._stop_page = page + 1
+        return new
+
+    async def detail_worker(self, session):
+        while True:
+            item = await self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+
+            page, index, link = item
+            scraper = BookScraper(link, parser=self.parser)
+            failed = False
+            if not self._stopped(page):
+                try:
+                    response = await self.fetch(session, link)
+                    if response.status != 200:
+                        raise Exception(f"Non-200 response: {response.status}")
+                    PAGES.labels('book').inc()
+                    previous = self.store.get(scraper.book_key)
+                    if response.unchanged and previous is not None:
+                        scraper.book_dict[scraper.book_key] = previous  # page unchanged, skip parsing
+                    elif self.parse_pool is not None:
+                        # Blocks while the parse stage is full, so fetched html can't pile up
+                        await self.parse_queue.put((page, index, link, response.content))
+                        self.queue.task_done()
+                        continue
+                    else:
+                        with stage('parse'):
+                            scraper.parse(response.content)
+                except Exception as e:
+                    print(f"An error occurred in Book scraper scrape : {e}")
+                    failed = True
+
+            self.record(page, index, scraper.book_key, scraper.to_dict()[scraper.book_key], failed)
+            self.queue.task_done()
+
+    async def parse_worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self.parse_queue.get()
+            if item is None:
+                return
+
+            page, index, link, content = item
+            try:
+                with stage('parse'):
+                    book_dict = await loop.run_in_executor(self.parse_pool, parse_book, link, content, self.parser)
+            except Exception as e:
+                # e.g. BrokenProcessPool after a worker was killed; the page still has to be
+                # recorded, or its detail workers wait on a full parse queue forever
+                print(f"An error occurred in crawler parse_worker for {link}: {e!r}")
+                scraper = BookScraper(link, parser=self.parser)
+                self.record(page, index, scraper.book_key, scraper.to_dict()[scraper.book_key], failed=True)
+                continue
+            book_key, book_data = next(iter(book_dict.items()))
+            self.record(page, index, book_key, book_data)
+
+    def record(self, page, index, book_key, book_data, failed=False):
+        previous = self.store.get(book_key)
+        if failed:
+            self._failed.add(book_key)
+            if previous is not None:
+                book_data = previous  # keep the good entry rather than an empty one
+        elif previous:
+            book_data.update((flag, previous[flag]) for flag in DOWNLOAD_FLAGS if flag in previous)
+        self._results[page][index] = (book_key, book_data)
+        self._pending[page] -= 1
+        if self._pending[page] == 0:
+            self.commit_ready_pages()
+
+    def commit_ready_pages(self):
+        committed = False
+        while True:
+            page = self._cursor + 1
+            if self._stopped(page) or self._pending.get(page, -1) != 0:
+                break
+            for book_key, book_data in self._results.pop(page):
+                self.store.upsert(book_key, book_data)
+            del self._pending[page]
+            self._cursor = page
+            committed = True
+
+        if committed:
+            self.save()
+            if self.cache is not None:
+                self.cache.save()
+            print(f"Saved and Scraped {len(self.store)} books so far")
+
+    def save(self):
+        # Save data first, so the cursor never points past books that are not stored yet
+        self.store.flush()
+
+        # Save progress
+        if self._listing and not self.incremental:
+            atomic_write_text(self.progress_path, str(self._cursor))
+
+    async def run(self):
+        session = make_aiohttp_session(self.connection_stats, pool_size=self.pool_size,
+                                       per_host=self.per_host, timeout=self.timeout)
+        if self.parse_workers:
+            self.parse_pool = ProcessPoolExecutor(self.parse_workers)
+        QUEUE_DEPTH.labels('book_urls').set_function(self.queue.qsize)
+        QUEUE_DEPTH.labels('fetched_pages').set_function(self.parse_queue.qsize)
+        try:
+            async with session:
+                details = [asyncio.create_task(self.detail_worker(session)) for _ in range(self.detail_workers)]
+                parsers = [asyncio.create_task(self.parse_worker()) for _ in range(self.parse_workers)]
+                books, state = (None, None)
+                if self.discover:
+                    books, state = await self.discovered_books(session)
+                if books is not None:
+                    listings = [asyncio.create_task(self.feed_worker(books))]
+                else:
+                    listings = [asyncio.create_task(self.listing_worker(session)) for _ in range(self.listing_workers)]
+
+                await asyncio.gather(*listings)
+                for _ in details:
+                    await self.queue.put(None)
+                await asyncio.gather(*details)
+                for _ in parsers:
+                    await self.parse_queue.put(None)
+                await asyncio.gather(*parsers)
+                if state is not None:
+                    state.update(book for book in books if book_key_from_url(book.url) not in self._failed)
+                    state.save()
+        finally:
+            if self.parse_pool is not None:
+                self.parse_pool.shutdown()
+                self.parse_pool = None
+
+        print(f"Connections: {self.connection_stats.summary()}")
+        print(f"Rate limits: {self.limiter.summary()}")
+
+        return self.store
@@ -0,0 +1,178 @@
+import asyncio
+import json
+import re
+import xml.etree.ElementTree as ET
+from collections import namedtuple
+from datetime import datetime, timezone
+from urllib.parse import unquote
+
+from book_store import atomic_write_text
+from BookScraper import book_key_from_url
+
+SITE = 'https://www.openbook.gr'
+# WordPress core sitemaps, then the Yoast / generic names
+SITEMAP_URLS = (f'{SITE}/wp-sitemap.xml', f'{SITE}/sitemap_index.xml', f'{SITE}/sitemap.xml')
+WP_POSTS_URL = SITE + '/wp-json/wp/v2/posts?per_page={per_page}&page={page}&_fields=link,modified_gmt'
+WP_PER_PAGE = 100  # the API maximum
+MODES = ('listing', 'sitemap', 'api', 'auto')
+DISCOVERY_STATE = 'discovery.json'
+
+# Sitemaps of posts (books): wp-sitemap-posts-post-1.xml, post-sitemap.xml, post-sitemap2.xml
+POST_SITEMAP = re.compile(r'(?:posts-post-\d+|/post-sitemap\d*)\.xml')
+
+Discovered = namedtuple('Discovered', 'url modified')
+
+
+def normalize_url(url):
+    """Sitemaps and the API percent-encode Greek slugs, the listing pages don't; book keys must match"""
+    return unquote(url.strip())
+
+
+def normalize_modified(value):
+    """'2024-04-28T18:00:31+00:00', '...Z' or a naive GMT time -> naive UTC ISO string, or None"""
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value.strip().replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed.isoformat()
+
+
+def _local(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def parse_sitemap(content):
+    """('index', [sitemap urls]) or ('urlset', [Discovered]) from a sitemap document"""
+    root = ET.fromstring(content)
+    entries = []
+    for entry in root:
+        fields = {_local(child.tag): (child.text or '').strip() for child in entry}
+        if fields.get('loc'):
+            entries.append(fields)
+    if _local(root.tag) == 'sitemapindex':
+        return 'index', [fields['loc'] for fields in entries]
+    return 'urlset', [Discovered(normalize_url(fields['loc']), normalize_modified(fields.get('lastmod')))
+                      for fields in entries]
+
+
+async def sitemap_books(fetch, index_urls=None):
+    """Every post url (with its lastmod) from the first sitemap index that answers, or None"""
+    for index_url in index_urls or SITEMAP_URLS:
+        try:
+            response = await fetch(index_url)
+            if response.status != 200:
+                continue
+            kind, entries = parse_sitemap(response.content)
+        except Exception as e:
+            print(f"Could not read sitemap {index_url}: {e}")
+            continue
+        if kind == 'urlset':
+            return entries
+
+        sitemaps = [url for url in entries if POST_SITEMAP.search(url)]
+        responses = await asyncio.gather(*(fetch(url) for url in sitemaps), return_exceptions=True)
+        books = []
+        for url, response in zip(sitemaps, responses):
+            if isinstance(response, Exception) or response.status != 200:
+                print(f"Could not read sitemap {url}: {getattr(response, 'status', response)}")
+                return None  # a partial url set would look like deleted books
+            books.extend(parse_sitemap(response.content)[1])
+        return books
+    return None
+
+
+def _api_page(content):
+    return [Discovered(normalize_url(post['link']), normalize_modified(post.get('modified_gmt')))
+            for post in json.loads(content)]
+
+
+async def api_books(fetch, url=None, per_page=WP_PER_PAGE):
+    """Every post from the paginated wp-json posts endpoint, or None if it isn't available"""
+    url = url or WP_POSTS_URL
+    try:
+        response = await fetch(url.format(per_page=per_page, page=1))
+        if response.status != 200:
+            return None
+        books = _api_page(response.content)
+        total_pages = int(response.headers.get('X-WP-TotalPages', 0))
+    except Exception as e:
+        print(f"Could not read the posts API: {e}")
+        return None
+
+    if total_pages:
+        # The page count is known, so the rest can be fetched together
+        pages = range(2, total_pages + 1)
+        responses = await asyncio.gather(*(fetch(url.format(per_page=per_page, page=page)) for page in pages),
+                                         return_exceptions=True)
+        for page, response in zip(pages, responses):
+            if isinstance(response, Exception) or response.status != 200:
+                print(f"Could not read posts API page {page}: {getattr(response, 'status', response)}")
+                return None
+            books.extend(_api_page(response.content))
+        return books
+
+    # No X-WP-TotalPages header: walk until a short page (WordPress answers 400 past the end)
+    page, last = 1, books
+    while len(last) == per_page:
+        page += 1
+        response = await fetch(url.format(per_page=per_page, page=page))
+        if response.status == 400:
+            break
+        if response.status != 200:
+            return None
+        last = _api_page(response.content)
+        books.extend(last)
+    return books
+
+
+async def discover_books(fetch, mode='auto'):
+    """Book urls from the sitemap and/or the posts API, unique, in the order found.
+
+    `fetch(url)` is a coroutine returning a response with status, content and headers.
+    None means the mode found nothing and the caller should walk the listing pages.
+    """
+    books = None
+    if mode in ('sitemap', 'auto'):
+        books = await sitemap_books(fetch)
+    if not books and mode in ('api', 'auto'):
+        books = await api_books(fetch)
+    if not books:
+        return None
+
+    seen = set()
+    unique = []
+    for book in books:
+        if book.url not in seen:
+            seen.add(book.url)
+            unique.append(book)
+    return unique
+
+
+class DiscoveryState:
+    """The modified time of every post at the last discovery crawl, in discovery.json"""
+
+    def __init__(self, path=DISCOVERY_STATE):
+        self.path = path
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                self.modified = json.load(f)
+        except FileNotFoundError:
+            self.modified = {}
+
+    def changed(self, books, store):
+        """The books missing from `store` or modified since the last crawl (all, without a modified time)"""
+        return [book for book in books
+                if book_key_from_url(book.url) not in store
+                or book.modified is None
+                or self.modified.get(book.url) != book.modified]
+
+    def update(self, books):
+        for book in books:
+            self.modified[book.url] = book.modified
+
+    def save(self):
+        atomic_write_text(self.path, json.dumps(self.modified, indent=1, ensure_ascii=False))
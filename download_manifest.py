@@ -0,0 +1,121 @@
+import hashlib
+import os
+import sqlite3
+import time
+from pathlib import Path
+
+MANIFEST_PATH = Path("downloads") / "manifest.db"
+MAX_FILE_ATTEMPTS = 3  # runs that may fail on a file before its book is settled without it
+
+DONE = 'done'
+FAILED = 'failed'
+
+
+def verify_file(path, size, sha256=None):
+    """True if `path` exists with the recorded size (and hash, when one is given)"""
+    try:
+        if os.path.getsize(path) != size:
+            return False
+    except OSError:
+        return False
+    if sha256 is None:
+        return True
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest() == sha256
+
+
+class DownloadManifest:
+    """Per-file record of every download: url, final path, size, ETag, SHA-256, status, attempts.
+
+    Each finished or failed file is committed on its own, so after a crash a restart
+    knows exactly which files are on disk and fetches only the rest.
+    """
+
+    def __init__(self, path=MANIFEST_PATH):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(self.path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS files ('
+            ' url TEXT PRIMARY KEY,'
+            ' path TEXT,'
+            ' size INTEGER,'
+            ' etag TEXT,'
+            ' sha256 TEXT,'
+            ' status TEXT NOT NULL,'
+            ' attempts INTEGER NOT NULL DEFAULT 0,'
+            ' error TEXT,'
+            ' updated REAL NOT NULL)'
+        )
+        self.conn.commit()
+        self.stats = {'done': 0, 'failed': 0, 'skipped': 0}
+
+    def get(self, url):
+        row = self.conn.execute('SELECT * FROM files WHERE url = ?', (url,)).fetchone()
+        return dict(row) if row else None
+
+    def done(self, url):
+        """Record of a finished download of `url`, or None"""
+        record = self.get(url)
+        return record if record and record['status'] == DONE else None
+
+    def retryable(self, url):
+        """True unless `url` finished or has failed MAX_FILE_ATTEMPTS times"""
+        record = self.get(url)
+        return record is None or (record['status'] != DONE and record['attempts'] < MAX_FILE_ATTEMPTS)
+
+    def record_done(self, url, path, size, etag=None, sha256=None):
+        self.conn.execute(
+            'INSERT INTO files (url, path, size, etag, sha256, status, attempts, error, updated) '
+            'VALUES (?, ?, ?, ?, ?, ?, 1, NULL, ?) '
+            'ON CONFLICT(url) DO UPDATE SET path = excluded.path, size = excluded.size, etag = excluded.etag, '
+            'sha256 = excluded.sha256, status = excluded.status, attempts = attempts + 1, error = NULL, '
+            'updated = excluded.updated',
+            (url, str(path), size, etag, sha256, DONE, time.time()),
+        )
+        self.conn.commit()
+        self.stats['done'] += 1
+
+    def record_failed(self, url, error):
+        self.conn.execute(
+            'INSERT INTO files (url, status, attempts, error, updated) VALUES (?, ?, 1, ?, ?) '
+            'ON CONFLICT(url) DO UPDATE SET status = excluded.status, attempts = attempts + 1, '
+            'error = excluded.error, updated = excluded.updated',
+            (url, FAILED, error, time.time()),
+        )
+        self.conn.commit()
+        self.stats['failed'] += 1
+
+    def merge(self, path):
+        """Copy in the records of another manifest (a download shard's); the newer record of a url wins"""
+        self.conn.execute('ATTACH DATABASE ? AS other', (str(path),))
+        try:
+            self.conn.execute(
+                'INSERT INTO files (url, path, size, etag, sha256, status, attempts, error, updated) '
+                'SELECT url, path, size, etag, sha256, status, attempts, error, updated FROM other.files WHERE 1 '
+                'ON CONFLICT(url) DO UPDATE SET path = excluded.path, size = excluded.size, etag = excluded.etag, '
+                'sha256 = excluded.sha256, status = excluded.status, attempts = excluded.attempts, '
+                'error = excluded.error, updated = excluded.updated WHERE excluded.updated > files.updated'
+            )
+            self.conn.commit()
+        finally:
+            self.conn.execute('DETACH DATABASE other')
+
+    def mark_skipped(self):
+        self.stats['skipped'] += 1
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+    def summary(self):
+        counts = dict(self.conn.execute('SELECT status, COUNT(*) FROM files GROUP BY status').fetchall())
+        return (f"{self.stats['done']} files recorded, {self.stats['failed']} failures, "
+                f"{self.stats['skipped']} verified on disk and skipped; "
+                f"{counts.get(DONE, 0)} done / {counts.get(FAILED, 0)} failed in total")
@@ -0,0 +1,196 @@
+import asyncio
+import json
+import os
+import re
+import time
+from collections import defaultdict
+from pathlib import Path
+
+import aiohttp
+
+from book_store import atomic_write_text
+from metrics import HTTP_RESPONSES
+
+PLAN_PATH = Path("downloads") / "plan.json"
+PROBE_CONCURRENCY = 32
+PROBE_TIMEOUT = aiohttp.ClientTimeout(total=30)
+DEAD_STATUSES = (404, 410)  # links a probe can safely drop
+ESTIMATED_THROUGHPUT = 2 * 1024 * 1024  # bytes/s per connection, only for the time estimate
+# Ask for the bytes as stored: aiohttp would otherwise request gzip and inflate it,
+# and Content-Length / Content-Range would no longer match what is written to disk
+IDENTITY = {'Accept-Encoding': 'identity'}
+CONTENT_RANGE = re.compile(r'bytes (\d+)-(\d+)/(\d+|\*)')
+
+
+def parse_content_range(content_range):
+    """Return (first byte, total size) from a 'bytes 100-199/1000' header; total is None for '*'"""
+    match = CONTENT_RANGE.match(content_range or '')
+    if not match:
+        return None, None
+    total = match.group(3)
+    return int(match.group(1)), (int(total) if total != '*' else None)
+
+
+def range_bounds(content_range):
+    """Return (first byte, last byte) from a 'bytes 100-199/1000' header"""
+    match = CONTENT_RANGE.match(content_range or '')
+    if not match:
+        return None, None
+    return int(match.group(1)), int(match.group(2))
+
+
+async def probe_url(session, url, limiter, name_file=None):
+    """Describe the file at `url` without downloading it.
+
+    Sends a HEAD and, if that gives no size, a GET for the first byte only. Returns a
+    dict with the status, size, content type, ETag, range support and, when
+    `name_file(response)` is given, the filename the download would be saved under.
+    """
+    entry = {'url': url, 'status': None, 'size': None, 'filename': None, 'content_type': None,
+             'etag': None, 'ranges': False, 'error': None}
+    for method, headers in (('HEAD', IDENTITY), ('GET', {**IDENTITY, 'Range': 'bytes=0-0'})):
+        host = await limiter.acquire(url)
+        started = time.monotonic()
+        try:
+            async with session.request(method, url, headers=headers, timeout=PROBE_TIMEOUT) as response:
+                limiter.report(host, response.status, time.monotonic() - started, response.headers.get('Retry-After'))
+                HTTP_RESPONSES.labels('probe', str(response.status)).inc()
+                entry['status'] = response.status
+                if response.status not in (200, 206):
+                    continue
+
+                if response.status == 206:
+                    _, size = parse_content_range(response.headers.get('Content-Range'))
+                else:
+                    content_length = response.headers.get('Content-Length')
+                    size = int(content_length) if content_length else None
+                entry.update(
+                    size=size,
+                    content_type=response.headers.get('Content-Type'),
+                    etag=response.headers.get('ETag'),
+                    ranges=response.status == 206 or response.headers.get('Accept-Ranges') == 'bytes',
+                    error=None,
+                )
+                if name_file is not None:
+                    entry['filename'] = await name_file(response)
+                if size is not None:
+                    return entry
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            limiter.report(host, error=True)
+            entry['error'] = str(e) or type(e).__name__
+        finally:
+            limiter.release(host)
+    return entry
+
+
+class DownloadPlan:
+    """What a run is about to download, built from probes before any file is transferred.
+
+    Gives the scheduler size hints, drops dead links and files over `max_size`, and
+    reports likely duplicates (same strong ETag and size under different urls) and
+    destination paths claimed by more than one url.
+    """
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self.files = {}  # url -> probe entry plus book and path
+
+    def add(self, entry, book, destination_dir):
+        entry['book'] = book
+        entry['path'] = os.path.join(destination_dir, entry['filename']) if entry['filename'] else None
+        self.files[entry['url']] = entry
+
+    def skip_reason(self, url):
+        """Why `url` should not be downloaded, or None"""
+        entry = self.files.get(url)
+        if entry is None:
+            return None
+        if entry['status'] in DEAD_STATUSES:
+            return f"probe returned {entry['status']}"
+        if self.max_size is not None and entry['size'] is not None and entry['size'] > self.max_size:
+            return f"file too large ({entry['size'] / (1024**3):.2f} GB)"
+        return None
+
+    def sizes(self):
+        return {url: entry['size'] for url, entry in self.files.items() if entry['size'] is not None}
+
+    def duplicates(self):
+        groups = defaultdict(list)
+        for url, entry in self.files.items():
+            etag = entry['etag']
+            if etag and not etag.startswith('W/') and entry['size'] is not None:
+                groups[(etag, entry['size'])].append(url)
+        return [urls for urls in groups.values() if len(urls) > 1]
+
+    def path_conflicts(self):
+        paths = defaultdict(list)
+        for url, entry in self.files.items():
+            if entry['path']:
+                paths[entry['path']].append(url)
+        return {path: urls for path, urls in paths.items() if len(urls) > 1}
+
+    def totals(self):
+        """(files to fetch, known bytes, files of unknown size, skipped files)"""
+        fetch = [entry for url, entry in self.files.items() if self.skip_reason(url) is None]
+        known = sum(entry['size'] for entry in fetch if entry['size'] is not None)
+        unknown = sum(1 for entry in fetch if entry['size'] is None)
+        return len(fetch), known, unknown, len(self.files) - len(fetch)
+
+    def summary(self, connections=1):
+        files, known, unknown, skipped = self.totals()
+        duplicate_bytes = sum(self.files[url]['size'] for urls in self.duplicates() for url in urls[1:])
+        seconds = known / (ESTIMATED_THROUGHPUT * max(connections, 1))
+        return (f"{files} files, {known / (1024**2):.1f} MB known + {unknown} of unknown size, "
+                f"{skipped} skipped, {len(self.duplicates())} duplicate groups "
+                f"({duplicate_bytes / (1024**2):.1f} MB), {len(self.path_conflicts())} path conflicts, "
+                f"~{seconds / 60:.1f} min at {ESTIMATED_THROUGHPUT / (1024**2):.0f} MB/s per connection")
+
+    def save(self, path=PLAN_PATH):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        atomic_write_text(path, json.dumps({
+            'files': list(self.files.values()),
+            'duplicates': self.duplicates(),
+            'path_conflicts': self.path_conflicts(),
+        }, indent=4, ensure_ascii=False))
+
+
+def load_sizes(path=PLAN_PATH):
+    """{url: size} from a plan an earlier run saved, or {} if there is none; hints only, they may be stale"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            files = json.load(f)['files']
+    except (FileNotFoundError, json.JSONDecodeError, KeyError):
+        return {}
+    return {entry['url']: entry['size'] for entry in files if entry.get('size') is not None}
+
+
+async def build_plan(session, targets, limiter, name_file=None, max_size=None, concurrency=PROBE_CONCURRENCY):
+    """Probe every (book, link name, url, destination dir) in `targets` and return the DownloadPlan.
+
+    `concurrency` workers take the targets from a bounded queue, so the tasks in flight
+    don't grow with the catalogue.
+    """
+    plan = DownloadPlan(max_size)
+    queue = asyncio.Queue(maxsize=2 * concurrency)
+
+    async def worker():
+        while True:
+            target = await queue.get()
+            if target is None:
+                return
+            book, link_name, url, destination_dir = target
+            describe = (lambda response: name_file(response, url, link_name)) if name_file else None
+            entry = await probe_url(session, url, limiter, describe)
+            plan.add(entry, book, destination_dir)
+
+    workers = [asyncio.create_task(worker()) for _ in range(concurrency)]
+    try:
+        for target in targets:
+            await queue.put(target)
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+    finally:
+        for task in workers:
+            task.cancel()  # a failed worker would otherwise leave the rest waiting on the queue
+    return plan
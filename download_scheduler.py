@@ -0,0 +1,73 @@
+import asyncio
+import itertools
+import math
+from collections import defaultdict, deque
+from urllib.parse import urlparse
+
+
+class DownloadScheduler:
+    """Runs download jobs from a priority queue on a fixed pool of workers.
+
+    The number of workers is the global download limit and at most `per_host` jobs
+    run against one host; a job whose host is busy is parked until one of them
+    finishes instead of holding a worker. Jobs with a known size run smallest first,
+    jobs without one after them in submission order. Sizes come from a download plan
+    (pdfs.py --plan, or the plan an earlier run saved); without one every job is
+    unsized and they run in submission order. A worker picks the next job as soon as
+    it is free, so one slow transfer never holds back the rest.
+    """
+
+    def __init__(self, max_downloads=16, per_host=4):
+        self.max_downloads = max_downloads
+        self.per_host = per_host
+        self.queue = asyncio.PriorityQueue()
+        self._active = defaultdict(int)
+        self._parked = defaultdict(deque)
+        self._counter = itertools.count()
+        self._workers = []
+
+    def start(self):
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.max_downloads)]
+
+    async def _worker(self):
+        while True:
+            entry = await self.queue.get()
+            job = entry[-1]
+            if job is None:
+                return
+
+            url, job_func, future = job
+            if future.cancelled():
+                continue
+
+            host = urlparse(url).netloc
+            if self._active[host] >= self.per_host:
+                self._parked[host].append(entry)
+                continue
+
+            self._active[host] += 1
+            try:
+                result = await job_func()
+            except Exception as e:
+                if not future.cancelled():
+                    future.set_exception(e)
+            else:
+                if not future.cancelled():
+                    future.set_result(result)
+            finally:
+                self._active[host] -= 1
+                if self._parked[host]:
+                    self.queue.put_nowait(self._parked[host].popleft())
+
+    def submit(self, url, job_func, size=None):
+        """Queue `job_func()` (a coroutine function) for `url`; returns a future of its result"""
+        future = asyncio.get_running_loop().create_future()
+        priority = size if size is not None else math.inf
+        self.queue.put_nowait((0, priority, next(self._counter), (url, job_func, future)))
+        return future
+
+    async def close(self):
+        for _ in self._workers:
+            self.queue.put_nowait((1, 0, next(self._counter), None))  # after every queued job
+        await asyncio.gather(*self._workers)
+        self._workers = []
@@ -0,0 +1,90 @@
+import os
+import re
+import struct
+
+SNIFF_BYTES = 1024  # a PDF header may come after up to 1024 bytes of junk
+TAIL_BYTES = 22 + 65535  # a ZIP end of central directory record with the longest comment
+PDF_EOF_WINDOW = 1024  # readers look for %%EOF this far from the end
+
+PDF, EPUB, ZIP, MOBI, MP3 = 'pdf', 'epub', 'zip', 'mobi', 'mp3'
+HTML, JSON, EMPTY = 'html', 'json', 'empty'
+REJECTED = (HTML, JSON, EMPTY)  # error and interstitial pages that hosts serve with a 200
+CHECKED = (PDF, EPUB, ZIP)  # types whose last bytes show whether the file is whole
+
+# The extension a file of each type is saved with, then the others it may keep
+EXTENSIONS = {
+    PDF: ('.pdf',),
+    EPUB: ('.epub',),
+    ZIP: ('.zip', '.epub', '.cbz', '.docx', '.odt'),  # an EPUB whose mimetype entry isn't first is still one
+    MOBI: ('.mobi', '.azw', '.azw3', '.prc'),
+    MP3: ('.mp3',),
+}
+
+MARKUP = re.compile(rb'\s*<(?:!doctype|html|head|body|\?xml|!--|script|meta|title)', re.IGNORECASE)
+JSON_START = re.compile(rb'\s*[\[{]\s*["\[{]')  # not '{\rtf'
+EXTENSION = re.compile(r'\.[A-Za-z0-9]{1,5}')
+ZIP_EOCD = b'PK\x05\x06'
+ZIP_CENTRAL_ENTRY = b'PK\x01\x02'
+ZIP64_OFFSET = 0xFFFFFFFF
+
+
+def sniff(head):
+    """Type of a file from its first bytes (at least SNIFF_BYTES of them when the file is that long);
+    None if it is none of the known types"""
+    if not head:
+        return EMPTY
+    if head.startswith(b'PK\x03\x04'):
+        # EPUB: a stored 'mimetype' first entry holding application/epub+zip
+        return EPUB if head[30:38] == b'mimetype' and b'application/epub+zip' in head[38:100] else ZIP
+    if b'%PDF-' in head[:SNIFF_BYTES]:
+        return PDF
+    if head[60:68] in (b'BOOKMOBI', b'TEXtREAd'):  # Palm database type and creator
+        return MOBI
+    if head.startswith(b'ID3') or (len(head) > 1 and head[0] == 0xFF and head[1] & 0xE0 == 0xE0):
+        return MP3  # an ID3 tag or an MPEG frame sync
+    text = head[3:] if head.startswith(b'\xef\xbb\xbf') else head
+    if MARKUP.match(text):
+        return HTML
+    if JSON_START.match(text):
+        return JSON
+    return None
+
+
+def incomplete(kind, tail, size):
+    """Why a `size` byte file of type `kind` ending in `tail` looks cut short; None if it looks whole"""
+    if kind == PDF:
+        if b'%%EOF' not in tail[-PDF_EOF_WINDOW:]:
+            return 'no %%EOF at the end of the PDF'
+    elif kind in (EPUB, ZIP):
+        at = tail.rfind(ZIP_EOCD)
+        if at < 0 or len(tail) - at < 22:
+            return 'no end of central directory record'
+        cd_size, cd_offset, comment_length = struct.unpack_from('<LLH', tail, at + 12)
+        if at + 22 + comment_length > len(tail):
+            return 'archive comment cut short'
+        if cd_offset == ZIP64_OFFSET:
+            return None  # the real offset is in the ZIP64 record
+        tail_start = size - len(tail)
+        if cd_offset + cd_size != tail_start + at:
+            return 'central directory does not end at its end record'
+        if cd_offset >= tail_start and tail[cd_offset - tail_start:cd_offset - tail_start + 4] != ZIP_CENTRAL_ENTRY:
+            return 'no central directory at its recorded offset'
+    return None
+
+
+def with_extension(path, kind):
+    """`path` with the extension of `kind`, unless its own already fits the type"""
+    if kind not in EXTENSIONS:
+        return path
+    stem, extension = os.path.splitext(path)
+    if extension.lower() in EXTENSIONS[kind]:
+        return path
+    if not EXTENSION.fullmatch(extension):
+        stem = path  # "Τόμος 2. Μέρος Α", not an extension
+    return stem + EXTENSIONS[kind][0]
+
+
+def read_range(path, start, length):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        return f.read(length)
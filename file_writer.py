@@ -0,0 +1,158 @@
+import asyncio
+import ctypes
+import ctypes.util
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import BYTES, STAGE_SECONDS
+
+WRITE_THREADS = 4
+WRITE_CHUNK_SIZE = 1024 * 1024  # bytes handed to the disk per write
+POOLED_BUFFERS = 64
+
+FALLOC_FL_KEEP_SIZE = 1
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _fallocate = _libc.fallocate
+    _fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong]
+except (OSError, AttributeError, TypeError):
+    _fallocate = None
+
+
+def preallocate(fd, offset, length):
+    """Reserve disk blocks without changing the file size (so .part sizes stay meaningful)"""
+    if _fallocate is None or length <= 0:
+        return False
+    return _fallocate(fd, FALLOC_FL_KEEP_SIZE, offset, length) == 0
+
+
+class BufferPool:
+    """Reusable bytearrays, so incoming chunks are batched without a new buffer each time"""
+
+    def __init__(self, size=WRITE_CHUNK_SIZE, count=POOLED_BUFFERS):
+        self.size = size
+        self.count = count
+        self._free = []
+
+    def get(self):
+        return self._free.pop() if self._free else bytearray(self.size)
+
+    def put(self, buffer):
+        if len(self._free) < self.count:
+            self._free.append(buffer)
+
+
+class FileWriter:
+    """Runs file I/O on a small thread pool so disk latency doesn't stall the event loop.
+
+    With threads=0 everything runs inline on the loop, as before.
+    """
+
+    def __init__(self, threads=WRITE_THREADS, chunk_size=WRITE_CHUNK_SIZE):
+        self.threads = threads
+        self.chunk_size = chunk_size
+        self.buffers = BufferPool(chunk_size)
+        self._executor = ThreadPoolExecutor(threads, thread_name_prefix='file-writer') if threads else None
+
+    async def run(self, func, *args):
+        if self._executor is None:
+            return func(*args)
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def open(self, path, mode='wb', size=None, digest=None, offset=None):
+        """Open `path` for streaming writes. `size` preallocates the remaining bytes, `digest` is updated with
+        every byte, `offset` starts writing at that position (with mode 'r+b', for one range of a file)."""
+        f = await self.run(open, path, mode)
+        if offset is not None:
+            await self.run(f.seek, offset)
+        if size:
+            await self.run(preallocate, f.fileno(), f.tell(), size)
+        return AsyncFile(self, f, digest)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+
+
+_DISK_WRITE = STAGE_SECONDS.labels('disk_write')
+_DISK_BYTES = BYTES.labels('disk')
+
+
+class AsyncFile:
+    """Batches chunks into pooled buffers and writes each full buffer on the writer's pool.
+
+    One write is in flight at a time, so the next buffer fills from the network while
+    the previous one goes to disk, and bytes reach the file in order. `written` counts
+    the bytes handed to the file so far, not those still being batched.
+    """
+
+    def __init__(self, writer, f, digest=None):
+        self.writer = writer
+        self.f = f
+        self.digest = digest
+        self._buffer = writer.buffers.get()
+        self._filled = 0
+        self._pending = None
+        self.written = 0
+
+    def _write(self, buffer, length):
+        with _DISK_WRITE.time():
+            view = memoryview(buffer)[:length]
+            self.f.write(view)
+            if self.digest is not None:
+                self.digest.update(view)  # hashlib drops the GIL for large buffers
+            view.release()
+        self.written += length
+        _DISK_BYTES.inc(length)
+        self.writer.buffers.put(buffer)
+
+    async def _flush_buffer(self):
+        if self._pending is not None:
+            await self._pending
+            self._pending = None
+        if self._filled:
+            buffer, length = self._buffer, self._filled
+            self._buffer = self.writer.buffers.get()
+            self._filled = 0
+            if self.writer._executor is None:
+                self._write(buffer, length)
+            else:
+                self._pending = asyncio.ensure_future(self.writer.run(self._write, buffer, length))
+
+    async def write(self, data):
+        view = memoryview(data)
+        while view:
+            room = len(self._buffer) - self._filled
+            taken = view[:room]
+            self._buffer[self._filled:self._filled + len(taken)] = taken
+            self._filled += len(taken)
+            view = view[len(taken):]
+            if self._filled == len(self._buffer):
+                await self._flush_buffer()
+
+    async def close(self):
+        try:
+            await self._flush_buffer()
+            if self._pending is not None:
+                await self._pending
+                self._pending = None
+        finally:
+            self.writer.buffers.put(self._buffer)
+            await self.writer.run(self.f.close)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+_default_writer = None
+
+
+def get_writer():
+    """Shared FileWriter for the download path"""
+    global _default_writer
+    if _default_writer is None:
+        _default_writer = FileWriter()
+    return _default_writer
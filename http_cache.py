@@ -0,0 +1,173 @@
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+CACHE_DIR = Path(".http_cache")
+CACHE_TTL = 0  # seconds a stored page is reused without asking the server again
+CACHE_MAX_BYTES = 512 * 1024 * 1024  # 512 MB
+
+
+class CachedResponse:
+    def __init__(self, status, content, unchanged=False, headers=None):
+        self.status = status
+        self.content = content
+        self.unchanged = unchanged  # body is the stored copy (fresh hit or 304)
+        self.headers = headers if headers is not None else {}
+
+
+class HttpCache:
+    """On-disk page cache keyed by url, revalidated with ETag / Last-Modified.
+
+    Entries younger than `ttl` are served without a request. Older ones are sent
+    with If-None-Match / If-Modified-Since and reused on a 304. The store is kept
+    under `max_bytes` by evicting the least recently used pages.
+    """
+
+    def __init__(self, directory=CACHE_DIR, ttl=CACHE_TTL, max_bytes=CACHE_MAX_BYTES):
+        self.directory = Path(directory)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.index_path = self.directory / "index.json"
+        self.stats = {"hits": 0, "misses": 0, "not_modified": 0}
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                self.index = OrderedDict(json.load(f))
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.index = OrderedDict()
+        self.size = sum(entry["size"] for entry in self.index.values())
+
+    def _body_path(self, url):
+        return self.directory / (hashlib.sha1(url.encode('utf-8')).hexdigest() + ".html")
+
+    def _read(self, url):
+        try:
+            with open(self._body_path(url), 'rb') as f:
+                content = f.read()
+        except FileNotFoundError:
+            self._drop(url)
+            return None
+        self.index.move_to_end(url)
+        return content
+
+    def _drop(self, url):
+        entry = self.index.pop(url, None)
+        if entry:
+            self.size -= entry["size"]
+            try:
+                os.remove(self._body_path(url))
+            except FileNotFoundError:
+                pass
+
+    def fresh(self, url):
+        """Stored body if it is still within the ttl, else None"""
+        entry = self.index.get(url)
+        if entry and time.time() - entry["stored"] < self.ttl:
+            content = self._read(url)
+            if content is not None:
+                self.stats["hits"] += 1
+                return content
+        return None
+
+    def request_headers(self, url):
+        entry = self.index.get(url)
+        headers = {}
+        if entry:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def not_modified(self, url):
+        """Body for a 304 answer. Returns None if the stored copy went missing."""
+        content = self._read(url)
+        if content is not None:
+            self.index[url]["stored"] = time.time()
+            self.stats["not_modified"] += 1
+        return content
+
+    def store(self, url, content, headers):
+        self.stats["misses"] += 1
+        etag = headers.get("ETag")
+        last_modified = headers.get("Last-Modified")
+        if not etag and not last_modified and not self.ttl:
+            return  # nothing to revalidate with, keeping it would only waste disk
+        if len(content) > self.max_bytes:
+            return
+
+        self._drop(url)
+        with open(self._body_path(url), 'wb') as f:
+            f.write(content)
+        self.index[url] = {
+            "etag": etag,
+            "last_modified": last_modified,
+            "stored": time.time(),
+            "size": len(content),
+        }
+        self.size += len(content)
+
+        # Evict least recently used pages
+        while self.size > self.max_bytes:
+            self._drop(next(iter(self.index)))
+
+    def save(self):
+        tmp_path = self.index_path.with_suffix(".tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def summary(self):
+        return (f"{self.stats['hits']} hits, {self.stats['not_modified']} not modified (304), "
+                f"{self.stats['misses']} misses, {len(self.index)} pages / {self.size / (1024**2):.1f} MB stored")
+
+
+def cached_get(session, url, cache=None):
+    """GET through a requests session, consulting the cache when one is given"""
+    if cache is None:
+        response = session.get(url)
+        return CachedResponse(response.status_code, response.content, headers=response.headers)
+
+    content = cache.fresh(url)
+    if content is not None:
+        return CachedResponse(200, content, unchanged=True)
+
+    response = session.get(url, headers=cache.request_headers(url))
+    if response.status_code == 304:
+        content = cache.not_modified(url)
+        if content is not None:
+            return CachedResponse(200, content, unchanged=True)
+        response = session.get(url)
+
+    if response.status_code == 200:
+        cache.store(url, response.content, response.headers)
+    return CachedResponse(response.status_code, response.content, headers=response.headers)
+
+
+async def cached_get_async(session, url, cache=None):
+    """Same as cached_get for an aiohttp session"""
+    if cache is not None:
+        content = cache.fresh(url)
+        if content is not None:
+            return CachedResponse(200, content, unchanged=True)
+
+        async with session.get(url, headers=cache.request_headers(url)) as response:
+            if response.status == 304:
+                content = cache.not_modified(url)
+                if content is not None:
+                    return CachedResponse(200, content, unchanged=True, headers=response.headers)
+            else:
+                content = await response.read()
+                if response.status == 200:
+                    cache.store(url, content, response.headers)
+                return CachedResponse(response.status, content, headers=response.headers)
+
+    async with session.get(url) as response:
+        content = await response.read()
+        if cache is not None and response.status == 200:
+            cache.store(url, content, response.headers)
+        return CachedResponse(response.status, content, headers=response.headers)
@@ -0,0 +1,133 @@
+import re
+from collections import namedtuple
+from functools import lru_cache
+
+# Keywords for categorization
+AUDIO_KEYWORDS = ["audio", "audio-book", "audio book", "ακούστε", "podcast", "mp3"]
+MOBILE_KEYWORDS = ["android", "apple", "ios", "google play"]
+
+# Identify document types from link names
+DOCUMENT_TYPES = ["pdf", "epub", "kindle", "mobi", ".mobi", "διαβάστε", "κατεβάστε"]
+
+# Types that may represent document volumes/parts
+VOLUME_INDICATORS = [
+    "τόμος", "τεύχος", "μέρος", "τόμ", "τευχ", "μερ",
+    "α'", "β'", "γ'", "δ'", "ε'", "στ'", "ζ'", "η'",
+    "1ος", "2ος", "3ος", "4ος", "5ος", "6ος", "7ος", "8ος", "9ος", "10ος",
+    "1ο", "2ο", "3ο", "4ο", "5ο", "6ο", "7ο", "8ο", "9ο", "10ο",
+    "v.1", "v.2", "v.3", "v.4", "v.5", "τόμος α", "τόμος β", "τόμος γ",
+    "#1", "#2", "#3", "#4", "#5", "τεύχος 1", "τεύχος 2", "τεύχος 3"
+]
+
+# Preferred formats when only one document link is kept (PDF > EPUB > Kindle > other)
+FORMAT_PRIORITY = ["PDF", "ePub", "Kindle mobi", "Kindle", "Διαβάστε"]
+NO_PRIORITY = len(FORMAT_PRIORITY)
+
+AUDIO, MOBILE, DOCUMENT, VOLUME = 1, 2, 4, 8
+
+CLASSIFY_CACHE_SIZE = 4096  # link names repeat a lot ("PDF", "ePub", ...) across the catalogue
+
+
+def _build_matcher():
+    # keyword -> (flags, best priority) of every keyword that matches where it does
+    keywords = {}
+    for flag, words in [(AUDIO, AUDIO_KEYWORDS), (MOBILE, MOBILE_KEYWORDS),
+                        (DOCUMENT, DOCUMENT_TYPES), (VOLUME, VOLUME_INDICATORS)]:
+        for word in words:
+            word = word.lower()
+            flags, priority = keywords.get(word, (0, NO_PRIORITY))
+            keywords[word] = (flags | flag, priority)
+    for rank, word in enumerate(FORMAT_PRIORITY):
+        word = word.lower()
+        flags, priority = keywords.get(word, (0, NO_PRIORITY))
+        keywords[word] = (flags, min(priority, rank))
+
+    # The regex reports the longest keyword at each position, so fold in the
+    # keywords that are its prefixes (they start at the same place and match too)
+    folded = {}
+    for word in keywords:
+        flags, priority = 0, NO_PRIORITY
+        for other, (other_flags, other_priority) in keywords.items():
+            if word.startswith(other):
+                flags |= other_flags
+                priority = min(priority, other_priority)
+        folded[word] = (flags, priority)
+
+    # One pass over the name: a lookahead at each position finds overlapping keywords
+    alternation = '|'.join(re.escape(word) for word in sorted(folded, key=len, reverse=True))
+    return re.compile(f'(?=({alternation}))'), folded
+
+
+_PATTERN, _KEYWORDS = _build_matcher()
+
+
+class LinkClass(namedtuple('LinkClass', ['flags', 'priority'])):
+    """Which keyword groups a link name matched (a bit set) and its FORMAT_PRIORITY rank"""
+
+    __slots__ = ()
+
+    @property
+    def category(self):
+        if self.flags & AUDIO:
+            return 'audio'
+        if self.flags & MOBILE:
+            return 'mobile'
+        if self.flags & (DOCUMENT | VOLUME):
+            return 'document'
+        return None
+
+    @property
+    def volume(self):
+        return bool(self.flags & VOLUME)
+
+
+@lru_cache(maxsize=CLASSIFY_CACHE_SIZE)
+def classify_link(link_name):
+    """Classify a link name with a single scan over its lowercased text"""
+    flags, priority = 0, NO_PRIORITY
+    for keyword in _PATTERN.findall(link_name.lower()):
+        keyword_flags, keyword_priority = _KEYWORDS[keyword]
+        flags |= keyword_flags
+        priority = min(priority, keyword_priority)
+    return LinkClass(flags, priority)
+
+
+LinkPlan = namedtuple('LinkPlan', ['documents', 'audio', 'mobile', 'download'])
+
+
+def plan_links(links):
+    """Split a book's {link name: url} into document, audio and mobile links and pick the documents to download"""
+    classes = {link_name: classify_link(link_name) for link_name in links}
+
+    documents, audio, mobile = {}, {}, {}
+    for link_name, link_url in links.items():
+        category = classes[link_name].category
+        if category == 'audio':
+            audio[link_name] = link_url
+        elif category == 'mobile':
+            mobile[link_name] = link_url
+        elif category == 'document':
+            documents[link_name] = link_url
+
+    # If no document links found, treat all non-audio, non-mobile links as documents
+    if not documents:
+        documents = {name: url for name, url in links.items() if name not in audio and name not in mobile}
+
+    # Download every document when the book comes in volumes or none of them is one,
+    # otherwise the best format (PDF > EPUB > Kindle > other), or the first link
+    download_all_volumes = any(link_class.volume for link_class in classes.values())
+    if download_all_volumes or not any(classes[name].volume for name in documents):
+        download = dict(documents)
+    elif documents:
+        best = min(documents, key=lambda name: classes[name].priority)
+        download = {best: documents[best]}
+    else:
+        download = {}
+
+    return LinkPlan(documents, audio, mobile, download)
+
+
+def plan_catalogue(books):
+    """Batch pass over (title, book data) pairs, e.g. store.items(); yields (title, LinkPlan)"""
+    for title, book_data in books:
+        yield title, plan_links(book_data.get("links", {}))
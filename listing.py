@@ -0,0 +1,59 @@
+from bs4 import SoupStrainer # type: ignore
+
+from parsing import Subtrees, make_soup
+
+LISTING_URL = 'https://www.openbook.gr/page/{page}/?s'
+BOOKS_PER_PAGE = 21
+LISTING_CLASS = 'row b-row listing meta-below grid-3'
+
+# Only the listing grid of a page is parsed
+LISTING_SUBTREES = Subtrees(
+    SoupStrainer('div', class_=LISTING_CLASS),
+    'div.row.b-row.listing.meta-below.grid-3',
+)
+
+
+def listing_url(page):
+    return LISTING_URL.format(page=page)
+
+
+def parse_page_links(content, page, parser=None, restrict=True):
+    """Extract the book urls of a listing page. Returns False when the page has no books."""
+
+    results = []
+
+    try:
+        soup = make_soup(content, parser, LISTING_SUBTREES if restrict else None)
+
+        # Find all the <a> tags within the specified class
+
+        books= soup.find('div', class_=LISTING_CLASS)
+        column_class = 'column one-third b-col'
+        columns = books.find_all('div', class_=column_class)
+
+        # Extract all <a> tags from each column
+
+        for column in columns:
+            links = column.find_all('a', class_ = 'image-link')
+
+            for link in links:
+                results.append(link.get('href'))
+
+        if len(results) > BOOKS_PER_PAGE:
+            print(f"Found {len(results)} links on page {page}. More than {BOOKS_PER_PAGE} links found.")
+
+        elif len(results) == 0:
+            print(f"Fatal erorr: No links found on page {page}.")
+            print('Stopping the program.')
+            return False
+
+
+        elif len(results) < BOOKS_PER_PAGE:
+            print(f"Found {len(results)} links on page {page}. Less than {BOOKS_PER_PAGE} links found.")
+
+
+        return results
+
+    except Exception as e:
+        print(f"An error occurred in get page links main.py while parsing the page {page} Skipping this page: {e}")
+        return []
@@ -1,58 +1,99 @@
 import requests
-from bs4 import BeautifulSoup # type: ignore
 from BookScraper import BookScraper 
-import json
+from book_store import BOOKS_JSON, BOOKS_STORE, atomic_write_text, export_json, open_store
+from crawler import Crawler
+from discovery import MODES
+from listing import listing_url, parse_page_links
+from http_cache import CACHE_DIR, CACHE_MAX_BYTES, CACHE_TTL, HttpCache, cached_get
+from metrics import METRICS_PORT, METRICS_SUMMARY, PAGES, REGISTRY, stage, start_metrics_server
+from parsing import BACKENDS, DEFAULT_BACKEND
+from rate_limit import HostLimiter
+from sessions import POOL_SIZE, TIMEOUT, PooledSession
+import argparse
+import asyncio
 
-def get_page_links(page):
+def get_page_links(page, session=None, cache=None, parser=None):
     
-    results = []
-    url = f'https://www.openbook.gr/page/{page}/?s'
-    response = requests.get(url)
+    url = listing_url(page)
+    with stage('listing_fetch'):
+        response = cached_get(session or requests, url, cache)
 
     # Check if the request was successful
-    if response.status_code == 200:
+    if response.status == 200:
+        PAGES.labels('listing').inc()
+        with stage('listing_parse'):
+            return parse_page_links(response.content, page, parser)
+    else:
+        print(f"Failed to retrieve the webpage for page {page}. Status code: {response.status}")
+
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Scrape the openbook.gr catalogue into books.json')
+    parser.add_argument('--workers', type=int, default=8, help='concurrent book page fetches')
+    parser.add_argument('--listing-workers', type=int, default=2, help='concurrent listing page fetches')
+    parser.add_argument('--per-host', type=int, default=4, help='max open requests per host')
+    parser.add_argument('--rate', type=float, default=5.0, help='starting requests per second per host, adapted to 429/503s and errors (0 = unlimited)')
+    parser.add_argument('--pool-size', type=int, default=POOL_SIZE, help='max pooled keep-alive connections')
+    parser.add_argument('--timeout', type=float, default=TIMEOUT, help='default request timeout in seconds')
+    parser.add_argument('--cache-dir', default=str(CACHE_DIR), help='on-disk page cache for conditional GETs')
+    parser.add_argument('--cache-ttl', type=float, default=CACHE_TTL, help='seconds a cached page is used without revalidating')
+    parser.add_argument('--cache-max-mb', type=float, default=CACHE_MAX_BYTES / (1024 * 1024), help='page cache size limit')
+    parser.add_argument('--no-cache', action='store_true', help='always download and parse every page')
+    parser.add_argument('--parser', choices=BACKENDS, default=DEFAULT_BACKEND, help='HTML parser backend')
+    parser.add_argument('--parse-workers', type=int, default=0,
+                        help='parse book pages in this many processes (0 = in the crawler process)')
+    parser.add_argument('--store', default=BOOKS_STORE,
+                        help='book store: .db (SQLite), .jsonl (append log) or .json (single file)')
+    parser.add_argument('--compact', action='store_true',
+                        help='hold a .json/.jsonl store packed in memory (much lower RSS on large catalogues)')
+    parser.add_argument('--export', default=BOOKS_JSON,
+                        help='write the books.json layout here at the end of the run (empty to skip)')
+    parser.add_argument('--incremental', action='store_true',
+                        help='walk from the newest page and scrape only books missing from the store')
+    parser.add_argument('--stop-after', type=int, default=2,
+                        help='with --incremental, stop after this many listing pages without new books')
+    parser.add_argument('--serial', action='store_true', help='use the old one-page-at-a-time loop')
+    parser.add_argument('--discover', choices=MODES, default='listing',
+                        help='find books from the listing pages, the WordPress sitemap, the posts API, or '
+                             'sitemap then API (auto); the last three scrape only new or modified books')
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT,
+                        help='serve Prometheus metrics on http://127.0.0.1:PORT/metrics during the run (0 = off)')
+    parser.add_argument('--metrics-out', default=METRICS_SUMMARY,
+                        help='write a JSON summary of the run metrics here at the end (empty to skip)')
+    return parser.parse_args(argv)
+
+
+def crawl_serial(page, store, session, cache=None, parser=None):
+    while True:
+        print(f"Scraping page {page}...")
+        links = get_page_links(page, session, cache, parser)
+        if not links:
+            print(f"No links found on page {page}. Stopping the program.")
+            break
         
-        try:
-            soup = BeautifulSoup(response.content, 'html.parser')
-            
-            # Find all the <a> tags within the specified class
-            
-            books= soup.find('div', class_='row b-row listing meta-below grid-3')  
-            column_class = 'column one-third b-col'
-            columns = books.find_all('div', class_=column_class)
+        for link in links:
+            scraper = BookScraper(link, session, cache, parser)
+            scraper.scrape(previous=store.get(scraper.book_key))
+            book_data_dict = scraper.to_dict()
+            store.upsert(scraper.book_key, book_data_dict[scraper.book_key])
+
+        # Save data
+        store.flush()
+
+        # Save progress
+        atomic_write_text('completed_pages.txt', str(page))
             
-            # Extract all <a> tags from each column
+        if cache is not None:
+            cache.save()
             
-            for column in columns:
-                links = column.find_all('a', class_ = 'image-link')
-                
-                for link in links:
-                    results.append(link.get('href'))
-                
-            if len(results) > 21: 
-                print(f"Found {len(results)} links on page {page}. More than 21 links found.")
-                
-            elif len(results) == 0:
-                print(f"Fatal erorr: No links found on page {page}.")
-                print('Stopping the program.')
-                return False
-                
-                
-            elif len(results) < 21:
-                print(f"Found {len(results)} links on page {page}. Less than 21 links found.") 
-                
-
-            return results
-                    
-        except Exception as e:
-            print(f"An error occurred in get page links main.py while parsing the page {page} Skipping this page: {e}")
-            return []
-    else:
-        print(f"Failed to retrieve the webpage for page {page}. Status code: {response.status_code}")
-
+        print(f"Saved and Scraped {len(store)} books so far")
+        page += 1 
 
 
-def main():
+def main(argv=None):
+    args = parse_args(argv)
+    start_metrics_server(args.metrics_port)
     try:
         # Initialize page from file or start at 1
         try:
@@ -62,35 +103,46 @@ def main():
             page = 1
 
         # Load existing data
+        store = open_store(args.store, compact=args.compact)
+
+        cache = None
+        if not args.no_cache:
+            cache = HttpCache(args.cache_dir, ttl=args.cache_ttl, max_bytes=int(args.cache_max_mb * 1024 * 1024))
+
         try:
-            with open('books.json', 'r') as json_file:
-                all_books_dict = json.load(json_file)
-        except FileNotFoundError:
-            all_books_dict = {}
-
-        while True:
-            print(f"Scraping page {page}...")
-            links = get_page_links(page)
-            if not links:
-                print(f"No links found on page {page}. Stopping the program.")
-                break
-            
-            for link in links:
-                scraper = BookScraper(link)
-                scraper.scrape()
-                book_data_dict = scraper.to_dict()
-                all_books_dict[scraper.book_key] = book_data_dict[scraper.book_key]
-
-            # Save progress
-            with open('completed_pages.txt', 'w') as f:
-                f.write(str(page))
-                
-            # Save data
-            with open('books.json', 'w') as json_file:
-                json.dump(all_books_dict, json_file, indent=4, ensure_ascii=False)
-                
-            print(f"Saved and Scraped {len(all_books_dict)} books so far")
-            page += 1 
+            if args.incremental:
+                crawler = Crawler(store, start_page=1, detail_workers=args.workers,
+                                  per_host=args.per_host, rate=args.rate,
+                                  pool_size=args.pool_size, timeout=args.timeout, cache=cache, parser=args.parser,
+                                  parse_workers=args.parse_workers,
+                                  incremental=True, stop_after=args.stop_after, discover=args.discover)
+                asyncio.run(crawler.run())
+            elif args.serial:
+                if args.discover != 'listing':
+                    print("--discover needs the async crawler, the serial loop walks the listing pages")
+                limiter = HostLimiter(rate=args.rate, per_host=None)
+                with PooledSession(args.pool_size, args.timeout, limiter) as session:
+                    try:
+                        crawl_serial(page, store, session, cache, args.parser)
+                    finally:
+                        print(f"Connections: {session.connection_stats().summary()}")
+                        print(f"Rate limits: {limiter.summary()}")
+            else:
+                crawler = Crawler(store, start_page=page, detail_workers=args.workers,
+                                  listing_workers=args.listing_workers, per_host=args.per_host, rate=args.rate,
+                                  pool_size=args.pool_size, timeout=args.timeout, cache=cache, parser=args.parser,
+                                  parse_workers=args.parse_workers, discover=args.discover)
+                asyncio.run(crawler.run())
+        finally:
+            if cache is not None:
+                cache.save()
+                print(f"Cache: {cache.summary()}")
+            if args.export and args.store != args.export:
+                print(f"Exported {export_json(store, args.export)} books to {args.export}")
+            store.close()
+            if args.metrics_out:
+                REGISTRY.write_summary(args.metrics_out)
+                print(f"Metrics written to {args.metrics_out}")
 
     except Exception as e:
         print(f"An error occurred in main.py main: {e}")
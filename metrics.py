@@ -0,0 +1,238 @@
+import bisect
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from book_store import atomic_write_text
+
+METRICS_PORT = 0  # 0 = no /metrics endpoint
+METRICS_SUMMARY = 'metrics.json'
+
+# Seconds, roughly x2.5 apart: 1 ms for parses up to minutes for large downloads
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+def _label_text(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, values)) + '}'
+
+
+def _round(value):
+    return round(value, 6) if value is not None else None
+
+
+class Counter:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Gauge:
+    """Set directly, or read from `function` whenever the metrics are collected"""
+
+    __slots__ = ('value', 'function')
+
+    def __init__(self):
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        self.function = function
+
+    def get(self):
+        if self.function is not None:
+            try:
+                return self.function()
+            except Exception:
+                return 0
+        return self.value
+
+
+class Histogram:
+    """Fixed buckets; observe() is a bisect and two additions, cheap enough for per-chunk use"""
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self):
+        return _Timer(self)
+
+    def quantile(self, q):
+        """Estimate from the buckets, interpolating linearly inside the one that holds it"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+
+class _Timer:
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Family:
+    """A metric name with its labelled children, e.g. stage_seconds{stage="parse"}"""
+
+    def __init__(self, kind, name, help_text, label_names, factory):
+        self.kind = kind
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(label_names)
+        self.factory = factory
+        self.children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            with self._lock:
+                child = self.children.setdefault(values, self.factory())
+        return child
+
+
+class Registry:
+    """Counters, gauges and histograms of a run, as Prometheus text and as a JSON summary"""
+
+    def __init__(self):
+        self.families = {}
+        self.started = time.time()
+
+    def _family(self, kind, name, help_text, labels, factory):
+        if name not in self.families:
+            self.families[name] = Family(kind, name, help_text, labels, factory)
+        return self.families[name]
+
+    def counter(self, name, help_text, labels=()):
+        return self._family('counter', name, help_text, labels, Counter)
+
+    def gauge(self, name, help_text, labels=()):
+        return self._family('gauge', name, help_text, labels, Gauge)
+
+    def histogram(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._family('histogram', name, help_text, labels, lambda: Histogram(buckets))
+
+    def render(self):
+        """Prometheus text exposition format"""
+        lines = []
+        for family in self.families.values():
+            lines.append(f'# HELP {family.name} {family.help}')
+            lines.append(f'# TYPE {family.name} {family.kind}')
+            for values, child in list(family.children.items()):
+                labels = _label_text(family.label_names, values)
+                if family.kind == 'histogram':
+                    cumulative = 0
+                    for bound, count in zip(child.buckets + (float('inf'),), child.counts):
+                        cumulative += count
+                        le = '+Inf' if bound == float('inf') else repr(bound)
+                        bucket_labels = _label_text(family.label_names + ('le',), values + (le,))
+                        lines.append(f'{family.name}_bucket{bucket_labels} {cumulative}')
+                    lines.append(f'{family.name}_sum{labels} {child.sum}')
+                    lines.append(f'{family.name}_count{labels} {child.count}')
+                else:
+                    value = child.get() if family.kind == 'gauge' else child.value
+                    lines.append(f'{family.name}{labels} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """Totals, per-second rates and latency percentiles since the registry was created"""
+        elapsed = max(time.time() - self.started, 1e-9)
+        result = {'elapsed_seconds': round(elapsed, 3)}
+        for family in self.families.values():
+            entries = {}
+            for values, child in list(family.children.items()):
+                key = ','.join(f'{name}={value}' for name, value in zip(family.label_names, values)) or 'total'
+                if family.kind == 'histogram':
+                    entries[key] = {
+                        'count': child.count,
+                        'sum': round(child.sum, 6),
+                        'mean': round(child.sum / child.count, 6) if child.count else None,
+                        'p50': _round(child.quantile(0.5)),
+                        'p90': _round(child.quantile(0.9)),
+                        'p99': _round(child.quantile(0.99)),
+                    }
+                elif family.kind == 'counter':
+                    entries[key] = {'total': child.value, 'per_second': round(child.value / elapsed, 3)}
+                else:
+                    entries[key] = child.get()
+            result[family.name] = entries
+        return result
+
+    def write_summary(self, path=METRICS_SUMMARY):
+        atomic_write_text(path, json.dumps(self.summary(), indent=4))
+
+
+REGISTRY = Registry()
+
+# Time per pipeline stage: listing_fetch, detail_fetch, parse, classify, download, disk_write
+STAGE_SECONDS = REGISTRY.histogram('openbook_stage_seconds', 'Time spent in each crawl / download stage', ['stage'])
+HTTP_RESPONSES = REGISTRY.counter('openbook_http_responses_total', 'HTTP responses by component and status',
+                                  ['component', 'status'])
+RETRIES = REGISTRY.counter('openbook_retries_total', 'Requests retried after an error or a 429/5xx', ['component'])
+PAGES = REGISTRY.counter('openbook_pages_total', 'Listing and book pages fetched', ['kind'])
+BYTES = REGISTRY.counter('openbook_bytes_total', 'Bytes downloaded from the network / written to disk', ['direction'])
+QUEUE_DEPTH = REGISTRY.gauge('openbook_queue_depth', 'Items waiting in a work queue', ['queue'])
+
+
+def stage(name):
+    """Timer for one stage, `with stage('parse'): ...`"""
+    return STAGE_SECONDS.labels(name).time()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port=METRICS_PORT, host='127.0.0.1'):
+    """Serve /metrics from a daemon thread (works for the serial and the async paths alike)"""
+    if not port:
+        return None
+    server = ThreadingHTTPServer((host, port), _Handler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
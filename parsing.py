@@ -0,0 +1,62 @@
+from bs4 import BeautifulSoup # type: ignore
+
+try:
+    import lxml  # noqa: F401
+    HAVE_LXML = True
+except ImportError:
+    HAVE_LXML = False
+
+try:
+    from selectolax.lexbor import LexborHTMLParser as SelectolaxParser
+except ImportError:
+    try:
+        from selectolax.parser import HTMLParser as SelectolaxParser
+    except ImportError:
+        SelectolaxParser = None
+
+BACKENDS = ['html.parser'] + (['lxml'] if HAVE_LXML else []) + (['selectolax'] if SelectolaxParser else [])
+DEFAULT_BACKEND = BACKENDS[-1]
+
+
+class Subtrees:
+    """The parts of a page a scraper reads, as a SoupStrainer and the matching CSS selector"""
+
+    def __init__(self, strainer, css):
+        self.strainer = strainer
+        self.css = css
+
+
+def _outermost_html(tree, css):
+    # Drop matches nested inside an earlier match, their html is already included
+    kept = set()
+    fragments = []
+    for node in tree.css(css):
+        parent = node.parent
+        while parent is not None and parent.mem_id not in kept:
+            parent = parent.parent
+        if parent is None:
+            kept.add(node.mem_id)
+            fragments.append(node.html)
+    return ''.join(fragments)
+
+
+def make_soup(content, backend=None, only=None):
+    """BeautifulSoup of `content`, built only from the `only` subtrees when given.
+
+    With the selectolax backend the page is parsed by selectolax and just the matching
+    subtrees are handed to BeautifulSoup, so callers keep using the soup API.
+    """
+    backend = backend or DEFAULT_BACKEND
+    if only is None:
+        if backend == 'selectolax':
+            backend = 'lxml' if HAVE_LXML else 'html.parser'
+        return BeautifulSoup(content, backend)
+
+    if backend == 'selectolax':
+        if SelectolaxParser is None:
+            raise ValueError("selectolax is not installed")
+        if isinstance(content, bytes):
+            content = content.decode('utf-8', 'replace')
+        return BeautifulSoup(_outermost_html(SelectolaxParser(content), only.css), 'html.parser')
+
+    return BeautifulSoup(content, backend, parse_only=only.strainer)
@@ -1,14 +1,31 @@
-import json
 import os
+import argparse
 import asyncio
 import aiohttp
 import logging
 import re
+import hashlib
+import json
+import random
+import time
+from functools import partial
 from pathlib import Path
 from tqdm import tqdm
 from urllib.parse import unquote, urlparse
 import mimetypes
 
+from book_store import BOOKS_JSON, BOOKS_STORE, atomic_write_text, export_json, open_store
+from content_store import CONTENT_INDEX, ContentStore
+from file_writer import get_writer, preallocate
+from download_scheduler import DownloadScheduler
+from rate_limit import get_limiter
+from metrics import BYTES, HTTP_RESPONSES, QUEUE_DEPTH, REGISTRY, RETRIES, stage, start_metrics_server
+from download_plan import IDENTITY, PLAN_PATH, build_plan, load_sizes, parse_content_range, range_bounds
+from download_manifest import MANIFEST_PATH, DownloadManifest, verify_file
+from file_types import CHECKED, REJECTED, SNIFF_BYTES, TAIL_BYTES, incomplete, read_range, sniff, with_extension
+from link_classifier import (AUDIO, AUDIO_KEYWORDS, DOCUMENT, DOCUMENT_TYPES, MOBILE, MOBILE_KEYWORDS,
+                             VOLUME_INDICATORS, classify_link, plan_links)
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -24,23 +41,15 @@ logger = logging.getLogger('book_downloader')
 DOWNLOAD_DIR = Path("downloads")
 AUDIO_DIR = DOWNLOAD_DIR / "audio_books"
 MOBILE_DIR = DOWNLOAD_DIR / "mobile_apps"
+DOWNLOAD_METRICS = DOWNLOAD_DIR / "metrics.json"
 
-# Keywords for categorization
-AUDIO_KEYWORDS = ["audio", "audio-book", "audio book", "ακούστε", "podcast", "mp3"]
-MOBILE_KEYWORDS = ["android", "apple", "ios", "google play"]
-
-# Identify document types from link names
-DOCUMENT_TYPES = ["pdf", "epub", "kindle", "mobi", ".mobi", "διαβάστε", "κατεβάστε"]
-
-# Types that may represent document volumes/parts
-VOLUME_INDICATORS = [
-    "τόμος", "τεύχος", "μέρος", "τόμ", "τευχ", "μερ", 
-    "α'", "β'", "γ'", "δ'", "ε'", "στ'", "ζ'", "η'", 
-    "1ος", "2ος", "3ος", "4ος", "5ος", "6ος", "7ος", "8ος", "9ος", "10ος",
-    "1ο", "2ο", "3ο", "4ο", "5ο", "6ο", "7ο", "8ο", "9ο", "10ο",
-    "v.1", "v.2", "v.3", "v.4", "v.5", "τόμος α", "τόμος β", "τόμος γ",
-    "#1", "#2", "#3", "#4", "#5", "τεύχος 1", "τεύχος 2", "τεύχος 3"
-]
+# Download scheduling
+MAX_CONCURRENT_DOWNLOADS = 16  # files transferring at once
+MAX_DOWNLOADS_PER_HOST = 4
+MAX_CONNECTIONS_PER_HOST = 8  # every connection to a host, segments of large files included
+MAX_DOWNLOADS_PER_BOOK = 2
+MAX_CONCURRENT_BOOKS = 32  # books being categorized / waiting on their files
+CHECKPOINT_EVERY = 100  # books between store flushes
 
 # async def get_filename_from_response(response):
 #     """Extract filename from Content-Disposition header or URL"""
@@ -90,7 +99,7 @@ async def get_filename_from_response(response):
 
 
 async def get_file_extension(response, url):
-    """Determine file extension from content-type or URL"""
+    """Determine file extension from content-type or URL (download_file corrects it from the content)"""
     content_type = response.headers.get('Content-Type', '')
     extension = mimetypes.guess_extension(content_type)
     
@@ -168,8 +177,10 @@ async def retry_with_backoff(coro_func, max_retries=3, initial_delay=2, backoff_
             return await coro_func()
         except Exception as e:
             if attempt < max_retries - 1:
-                logger.warning(f"Retry {attempt + 1} failed. Retrying in {delay}s... Error: {e}")
-                await asyncio.sleep(delay)
+                wait = delay * random.uniform(0.5, 1.5)  # jitter, so failed downloads don't retry in lockstep
+                RETRIES.labels('downloader').inc()
+                logger.warning(f"Retry {attempt + 1} failed. Retrying in {wait:.1f}s... Error: {e}")
+                await asyncio.sleep(wait)
                 delay *= backoff_factor
             else:
                 raise e
@@ -177,76 +188,438 @@ async def retry_with_backoff(coro_func, max_retries=3, initial_delay=2, backoff_
 
 MAX_FILE_SIZE_BYTES = 20 * 1024 * 1024 * 1024  # 20 GB
 
-async def download_file(session, url, destination_dir, link_name=None):
-    """Download a file asynchronously with retries, timeouts, chunked writing, and size check"""
+# Per read rather than total, so slow but healthy transfers of large files don't fail
+CONNECT_TIMEOUT = 30
+READ_TIMEOUT = 60  # seconds without receiving any data
+DOWNLOAD_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT)
+DOWNLOAD_RETRIES = 5  # each retry continues from the bytes already on disk
+PART_SUFFIX = '.part'
+VALIDATOR_SUFFIX = '.validator'  # ETag / Last-Modified of the response a .part file was started from
+PREALLOCATE = True  # reserve Content-Length on disk up front to limit fragmentation
+VERIFY_HASHES = False  # re-hash files the manifest lists as done on restart, not just compare sizes
+CHECK_COMPLETE = True  # check the end of PDFs and EPUB/ZIPs for their trailer / central directory
+
+# Segmented downloads (opt-in): large files on servers with Accept-Ranges are fetched
+# as SEGMENTS ranges over parallel connections
+SEGMENTS = 1
+SEGMENT_THRESHOLD = 256 * 1024 * 1024  # 256 MB
+SEGMENTS_SUFFIX = '.segments'  # progress of each range, so a later run resumes them
+SEGMENT_SAVE_INTERVAL = 5  # seconds between saves of that progress while the ranges download
+
+
+def hash_file(digest, path):
+    """Feed the bytes already on disk into `digest` (used when resuming a .part file)"""
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+
+
+def load_validator(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return f.read() or None
+    except FileNotFoundError:
+        return None
+
+
+def save_validator(path, validator):
+    """Record the validator of a new .part file, or drop the stale one when the server sent none"""
+    if validator:
+        atomic_write_text(path, validator)
+    elif os.path.exists(path):
+        os.remove(path)
 
-    async def attempt():
-        async with session.get(url, timeout=aiohttp.ClientTimeout(total=60)) as response:
-            if response.status != 200:
-                raise Exception(f"Non-200 response: {response.status}")
-
-            # Check content size
-            content_length = response.headers.get('Content-Length')
-            if content_length:
-                file_size = int(content_length)
-                if file_size > MAX_FILE_SIZE_BYTES:
-                    logger.warning(f"Skipped {url} — File too large ({file_size / (1024**3):.2f} GB)")
-                    return False, None
-            else:
-                logger.info(f"No Content-Length header for {url}. Proceeding anyway.")
-
-            # Get filename from headers or fallback
-            filename = await get_filename_from_response(response)
-            if not filename or filename == '':
-                extension = await get_file_extension(response, url)
-                if link_name:
-                    sanitized_link_name = re.sub(r'[\\/*?:"<>|]', '', link_name)
-                    filename = f"{sanitized_link_name}{extension}"
-                else:
-                    filename = f"file_{hash(url) % 10000}{extension}"
 
-            try:
-                filename.encode('utf-8')  # Force check
-            except UnicodeEncodeError:
-                filename = filename.encode('utf-8', 'ignore').decode('utf-8')
-                logger.error(f"Filename {filename} contained invalid characters. Cleaned fallback used.")
+def split_segments(total, count):
+    """Byte ranges [{start, end (inclusive), done}] splitting `total` bytes into `count` parts"""
+    length = -(-total // count)
+    return [{'start': start, 'end': min(start + length, total) - 1, 'done': 0} for start in range(0, total, length)]
+
+
+def load_segments(path, total, validator):
+    """Segment progress saved by an earlier run for the same file version, or None"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            saved = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    if saved.get('total') != total or saved.get('validator') != validator:
+        return None
+    return saved['segments']
+
+
+def save_segments(path, segments, total, validator):
+    atomic_write_text(path, json.dumps({'total': total, 'validator': validator, 'segments': segments}))
+
+
+async def read_head(chunks, size):
+    """At least the first `size` bytes of a response body (all of it if shorter), in whole chunks"""
+    head = b''
+    async for chunk in chunks:
+        head += chunk
+        if len(head) >= size:
+            break
+    return head
+
+
+def create_part_file(path, total):
+    """Empty file of the final size (sparse, preallocated) for segments to be written into"""
+    with open(path, 'wb') as f:
+        f.truncate(total)
+        if PREALLOCATE:
+            preallocate(f.fileno(), 0, total)
+
+
+async def resolve_filename(response, url, link_name=None):
+    """Name a download is saved under: from the headers or url, else the link name plus an extension"""
+    filename = await get_filename_from_response(response)
+    if not filename or filename == '':
+        extension = await get_file_extension(response, url)
+        if link_name:
+            sanitized_link_name = re.sub(r'[\\/*?:"<>|]', '', link_name)
+            filename = f"{sanitized_link_name}{extension}"
+        else:
+            filename = f"file_{hash(url) % 10000}{extension}"
 
-            os.makedirs(destination_dir, exist_ok=True)
-            file_path = os.path.join(destination_dir, filename)
+    try:
+        filename.encode('utf-8')  # Force check
+    except UnicodeEncodeError:
+        filename = filename.encode('utf-8', 'ignore').decode('utf-8')
+        logger.error(f"Filename {filename} contained invalid characters. Cleaned fallback used.")
+    return filename
+
+
+async def download_file(session, url, destination_dir, link_name=None, content_store=None, writer=None,
+                        limiter=None, manifest=None, segments=SEGMENTS):
+    """Download a file asynchronously with retries, resume, timeouts, chunked writing, and size check
+
+    Data goes to <file>.part and is renamed once its size matches the server's. A retry
+    (or a later run) sends a Range request for the missing bytes when the server supports it;
+    a later run only when the validator saved next to the .part matches the server's.
+    With a ContentStore the file is hashed while it is written and deduplicated, and a
+    url whose recorded ETag is still current is linked without downloading it.
+    Disk work runs on the FileWriter's threads, off the event loop. Requests are paced
+    by the shared per-host limiter, which backs off on 429/503 and failing hosts.
+    With a DownloadManifest the outcome (path, size, ETag, hash or the error) is recorded.
+    With segments > 1, a file of at least SEGMENT_THRESHOLD bytes from a server that
+    accepts ranges is split into that many ranges fetched over parallel connections.
+    The first bytes of the body are sniffed before anything is written: an HTML or JSON
+    page instead of a file is dropped, and the file is saved with the extension of its
+    type. With CHECK_COMPLETE, a PDF or EPUB/ZIP must end in its trailer or central
+    directory, checked on the last bytes as they stream past.
+    """
+
+    writer = writer or get_writer()
+    limiter = limiter or get_limiter()
+    state = {'file_path': None, 'part_path': None, 'validator': None, 'etag': None,
+             'segment_total': None, 'segments': None, 'segments_saved': 0.0, 'segments_saving': False,
+             'sniffed': False, 'kind': None}
+
+    def reject(kind):
+        logger.warning(f"Skipped {url} — served {kind} instead of a file")
+        if manifest is not None:
+            manifest.record_failed(url, f"served {kind} instead of a file")
+        return False, None
 
-            # Save file in chunks
-            with open(file_path, 'wb') as f:
-                async for chunk in response.content.iter_chunked(1024 * 64):  # 64KB chunks
-                    f.write(chunk)
+    async def resolve_file_path(response):
+        filename = await resolve_filename(response, url, link_name)
+        await writer.run(partial(os.makedirs, destination_dir, exist_ok=True))
+        return os.path.join(destination_dir, filename)
+
+    async def fetch_segment(segment):
+        start = segment['start'] + segment['done']
+        if start > segment['end']:
+            return
+        headers = {**IDENTITY, 'Range': f"bytes={start}-{segment['end']}"}
+        if state['validator']:
+            headers['If-Range'] = state['validator']
+
+        host = await limiter.acquire(url)
+        started = time.monotonic()
+        reported = False
+        try:
+            async with session.get(url, headers=headers, timeout=DOWNLOAD_TIMEOUT) as response:
+                limiter.report(host, response.status, time.monotonic() - started, response.headers.get('Retry-After'))
+                HTTP_RESPONSES.labels('downloader', str(response.status)).inc()
+                reported = True
+                first, last = range_bounds(response.headers.get('Content-Range'))
+                if response.status != 206 or first != start or last > segment['end']:
+                    # A 200 means the file changed since its first response, start over unsegmented
+                    state['segment_total'] = None
+                    raise Exception(f"Range {start}-{segment['end']} of {url} answered with {response.status}")
+
+                # `done` only counts bytes handed to the file, so saved progress never covers a hole
+                done = segment['done']
+                length = segment['end'] + 1 - segment['start']
+                received = done
+                f = await writer.open(state['part_path'], 'r+b', offset=start)
+                try:
+                    async with f:
+                        async for chunk in response.content.iter_chunked(1024 * 64):
+                            chunk = chunk[:length - received]
+                            BYTES.labels('network').inc(len(chunk))
+                            await f.write(chunk)
+                            received += len(chunk)
+                            segment['done'] = done + f.written
+                            await checkpoint_segments()
+                finally:
+                    segment['done'] = done + f.written
+                if segment['done'] != length:
+                    # A server that caps range sizes or drops the connection: retry the rest
+                    raise Exception(f"Range {start}-{segment['end']} of {url} ended after "
+                                    f"{segment['done'] - done} bytes")
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            if not reported:
+                limiter.report(host, error=True)
+            raise
+        finally:
+            limiter.release(host)
+
+    async def checkpoint_segments(force=False):
+        """Save the progress of each range every SEGMENT_SAVE_INTERVAL, so a killed run resumes them"""
+        now = time.monotonic()
+        if not force and (now - state['segments_saved'] < SEGMENT_SAVE_INTERVAL or state['segments_saving']):
+            return
+        state['segments_saved'] = now
+        state['segments_saving'] = True
+        try:
+            snapshot = [dict(segment) for segment in state['segments']]  # the ranges keep moving meanwhile
+            await writer.run(save_segments, state['part_path'] + SEGMENTS_SUFFIX, snapshot,
+                             state['segment_total'], state['validator'])
+        finally:
+            state['segments_saving'] = False
+
+    async def download_segments():
+        total = state['segment_total']
+        part_path = state['part_path']
+        sidecar = part_path + SEGMENTS_SUFFIX
+        parts = state['segments']
+        if parts is None:
+            parts = await writer.run(load_segments, sidecar, total, state['validator'])
+            if parts is None or not os.path.exists(part_path):
+                parts = split_segments(total, segments)
+                await writer.run(create_part_file, part_path, total)
+                state['segments'] = parts
+                await checkpoint_segments(force=True)
+            else:
+                logger.info(f"Resuming {len(parts)} segments of {url}")
+                state['segments'] = parts
+
+        results = await asyncio.gather(*(fetch_segment(segment) for segment in parts), return_exceptions=True)
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if errors:
+            if state['segment_total'] is None:  # the file changed, drop what the segments wrote
+                state['segments'] = None
+                await writer.run(os.remove, part_path)
+                if os.path.exists(sidecar):
+                    await writer.run(os.remove, sidecar)
+            else:
+                await checkpoint_segments(force=True)
+            raise errors[0]
+
+        digest = hashlib.sha256() if content_store is not None or manifest is not None else None
+        if digest is not None:
+            await writer.run(hash_file, digest, part_path)
+        return await complete(total, digest)
+
+    async def complete(total, digest, tail=b''):
+        part_path = state['part_path']
+        size = await writer.run(os.path.getsize, part_path)
+        if total is not None and size != total:
+            raise Exception(f"Incomplete download: {size} of {total} bytes")
+
+        if not state['sniffed']:  # resumed from an earlier run or segmented: the head is on disk
+            state['kind'] = sniff(await writer.run(read_range, part_path, 0, SNIFF_BYTES))
+            state['sniffed'] = True
+            if state['kind'] in REJECTED:
+                await writer.run(os.remove, part_path)
+                return reject(state['kind'])
+        if CHECK_COMPLETE and state['kind'] in CHECKED:
+            if len(tail) < min(size, TAIL_BYTES):
+                tail = await writer.run(read_range, part_path, max(size - TAIL_BYTES, 0), TAIL_BYTES)
+            problem = incomplete(state['kind'], tail, size)
+            if problem and total is None:
+                raise Exception(f"Incomplete download: {problem}")
+            if problem:
+                logger.warning(f"{url} has all {size} bytes but looks truncated on the server: {problem}")
+        state['file_path'] = with_extension(state['file_path'], state['kind'])
+
+        await writer.run(os.replace, part_path, state['file_path'])
+        for sidecar in (part_path + SEGMENTS_SUFFIX, part_path + VALIDATOR_SUFFIX):
+            if os.path.exists(sidecar):
+                await writer.run(os.remove, sidecar)
+        logger.info(f"Downloaded {url} to {state['file_path']}")
+        if content_store is not None:
+            await writer.run(content_store.add, url, state['etag'], digest.hexdigest(), state['file_path'])
+        if manifest is not None:
+            manifest.record_done(url, state['file_path'], size, state['etag'], digest.hexdigest())
+        return True, state['file_path']
 
-            logger.info(f"Downloaded {url} to {file_path}")
-            return True, file_path
+    async def attempt():
+        if state['segment_total'] is not None:
+            return await download_segments()
+
+        part_path = state['part_path']
+        offset = os.path.getsize(part_path) if part_path and os.path.exists(part_path) else 0
+        headers = dict(IDENTITY)
+        if offset:
+            headers['Range'] = f'bytes={offset}-'
+            if state['validator']:
+                headers['If-Range'] = state['validator']  # full body instead if the file changed
+        elif content_store is not None and state['file_path'] is None:
+            known = content_store.known_url(url)
+            if known:
+                headers['If-None-Match'] = known['etag']
+
+        resume = False
+        host = await limiter.acquire(url)
+        started = time.monotonic()
+        reported = False
+        try:
+            async with session.get(url, headers=headers, timeout=DOWNLOAD_TIMEOUT) as response:
+                limiter.report(host, response.status, time.monotonic() - started, response.headers.get('Retry-After'))
+                HTTP_RESPONSES.labels('downloader', str(response.status)).inc()
+                reported = True
+                if response.status == 304 and 'If-None-Match' in headers:
+                    file_path = await writer.run(content_store.link_known, url, destination_dir)
+                    if file_path is None:
+                        raise Exception(f"Stored copy of {url} went missing, downloading it again")
+                    logger.info(f"Unchanged {url}, linked stored copy to {file_path}")
+                    if manifest is not None:
+                        manifest.record_done(url, file_path, known['size'], known['etag'], known['sha256'])
+                    return True, file_path
+                if response.status == 416 and part_path:
+                    await writer.run(os.remove, part_path)
+                    raise Exception(f"Range not satisfiable, restarting {url} from the beginning")
+                if response.status not in (200, 206):
+                    raise Exception(f"Non-200 response: {response.status}")
+
+                if response.status == 206:
+                    start, total = parse_content_range(response.headers.get('Content-Range'))
+                    if start != offset:
+                        await writer.run(os.remove, part_path)
+                        raise Exception(f"Server resumed {url} at byte {start} instead of {offset}")
+                else:
+                    offset = 0
+                    content_length = response.headers.get('Content-Length')
+                    total = int(content_length) if content_length else None
+                    if response.headers.get('Content-Encoding', 'identity') != 'identity':
+                        total = None  # compressed anyway: the length is not that of the body aiohttp inflates
+
+                # Check content size
+                if total is not None:
+                    if total > MAX_FILE_SIZE_BYTES:
+                        logger.warning(f"Skipped {url} — File too large ({total / (1024**3):.2f} GB)")
+                        if manifest is not None:
+                            manifest.record_failed(url, "file too large")
+                        return False, None
+                else:
+                    logger.info(f"No Content-Length header for {url}. Proceeding anyway.")
+
+                if state['file_path'] is None:
+                    state['file_path'] = await resolve_file_path(response)
+                    state['part_path'] = state['file_path'] + PART_SUFFIX
+                    etag = response.headers.get('ETag')
+                    state['etag'] = etag
+                    if etag and not etag.startswith('W/'):
+                        state['validator'] = etag
+                    else:
+                        state['validator'] = response.headers.get('Last-Modified')
+
+                    accepts_ranges = response.headers.get('Accept-Ranges') == 'bytes'
+                    sidecar = state['part_path'] + SEGMENTS_SUFFIX
+
+                    # A previous run left a partial file, ask again for just the rest. Only if it is
+                    # of this same version: its validator is gone with that run, so If-Range can't tell
+                    if accepts_ranges and os.path.exists(state['part_path']) and not os.path.exists(sidecar):
+                        saved = await writer.run(load_validator, state['part_path'] + VALIDATOR_SUFFIX)
+                        resume = state['validator'] is not None and saved == state['validator']
+                        if not resume:
+                            logger.info(f"Partial file of {url} is not known to be of this version, starting over")
+
+                    # Large file on a server that takes ranges: fetch it in parallel segments
+                    if (not resume and accepts_ranges and segments > 1 and response.status == 200
+                            and total is not None and total >= SEGMENT_THRESHOLD):
+                        state['segment_total'] = total
+
+                if not resume and state['segment_total'] is None:
+                    chunks = response.content.iter_chunked(1024 * 64)  # 64KB reads, batched into bigger writes
+                    head = b''
+                    if not offset:
+                        # Sniff the type before anything is written, so an error page costs one chunk
+                        head = await read_head(chunks, SNIFF_BYTES)
+                        BYTES.labels('network').inc(len(head))
+                        state['kind'] = sniff(head)
+                        state['sniffed'] = True
+                        if state['kind'] in REJECTED:
+                            return reject(state['kind'])
+                        await writer.run(save_validator, state['part_path'] + VALIDATOR_SUFFIX, state['validator'])
+
+                    digest = hashlib.sha256() if content_store is not None or manifest is not None else None
+                    if offset and digest is not None:
+                        await writer.run(hash_file, digest, state['part_path'])
+
+                    # Save file in chunks, written and hashed on the writer threads
+                    remaining = total - offset if total is not None and PREALLOCATE else None
+                    keep_tail = CHECK_COMPLETE and state['kind'] in CHECKED
+                    tail = bytearray(head[-TAIL_BYTES:] if keep_tail else b'')
+                    f = await writer.open(state['part_path'], 'ab' if offset else 'wb', size=remaining, digest=digest)
+                    async with f:
+                        if head:
+                            await f.write(head)
+                        async for chunk in chunks:
+                            BYTES.labels('network').inc(len(chunk))
+                            await f.write(chunk)
+                            if keep_tail:
+                                tail += chunk
+                                del tail[:-TAIL_BYTES]
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            if not reported:
+                limiter.report(host, error=True)
+            raise
+        finally:
+            limiter.release(host)
+
+        if resume or state['segment_total'] is not None:
+            if resume:
+                logger.info(f"Resuming {url} from {os.path.getsize(state['part_path'])} bytes")
+            return await attempt()
+
+        return await complete(total, digest, tail)
 
     try:
-        return await retry_with_backoff(attempt)
+        with stage('download'):
+            return await retry_with_backoff(attempt, max_retries=DOWNLOAD_RETRIES)
     except Exception as e:
         logger.error(f"Failed to download after retries: {url}. Error: {e}")
+        if manifest is not None:
+            manifest.record_failed(url, str(e))
         return False, None
 
 
 
 
+def save_mobile_link(mobile_file, book_title, link_name, link_url):
+    os.makedirs(MOBILE_DIR, exist_ok=True)
+    with open(mobile_file, 'w', encoding='utf-8') as f:
+        f.write(f"Title: {book_title}\nLink Type: {link_name}\nURL: {link_url}\n")
+
+
 def is_audio_book(link_name):
     """Check if the link is for an audio book"""
-    return any(keyword.lower() in link_name.lower() for keyword in AUDIO_KEYWORDS)
+    return bool(classify_link(link_name).flags & AUDIO)
 
 def is_mobile_app(link_name):
     """Check if the link is for a mobile app"""
-    return any(keyword.lower() in link_name.lower() for keyword in MOBILE_KEYWORDS)
+    return bool(classify_link(link_name).flags & MOBILE)
 
 def is_document_link(link_name):
     """Check if the link is for a document to download"""
-    return any(doc_type.lower() in link_name.lower() for doc_type in DOCUMENT_TYPES)
+    return bool(classify_link(link_name).flags & DOCUMENT)
 
 def is_volume_or_part(link_name):
     """Check if the link name indicates a volume or part of a book"""
-    lower_link = link_name.lower()
-    return any(indicator.lower() in lower_link for indicator in VOLUME_INDICATORS)
+    return classify_link(link_name).volume
 
 def should_download_all_volumes(book_links):
     """Determine if we should download all volumes for a book"""
@@ -254,8 +627,35 @@ def should_download_all_volumes(book_links):
     volume_count = sum(1 for link in book_links if is_volume_or_part(link))
     return volume_count > 0
 
-async def process_book(session, book_title, book_data, progress_bar):
-    """Process a single book: create folder and download files"""
+def download_targets(book_title, plan):
+    """[(link name, url, destination dir)] of the document and of the audio files to fetch for a book's LinkPlan"""
+    folder_name = re.sub(r'[\\/*?:"<>|]', '', book_title)
+    # Remove links that don't end with dl=1
+    documents = [(link_name, link_url, DOWNLOAD_DIR / folder_name)
+                 for link_name, link_url in plan.download.items() if not link_url.endswith("dl=0")]
+    audio = [(link_name, link_url, AUDIO_DIR / folder_name)
+             for link_name, link_url in plan.audio.items() if link_url.endswith("dl=1") or "dl=1" in link_url]
+    return documents, audio
+
+
+def book_downloads(book_title, book_data):
+    """Every (link name, url, destination dir) process_book would download for a book"""
+    links = book_data.get("links", {})
+    if book_data.get("scraped", False) or not links or all(is_audio_book(link_name) for link_name in links):
+        return []
+    documents, audio = download_targets(book_title, plan_links(links))
+    return documents + audio if documents else []
+
+
+async def process_book(session, scheduler, book_title, book_data, progress_bar, size_hints=None, content_store=None,
+                       manifest=None, download_plan=None, segments=SEGMENTS):
+    """Process a single book: create folder and download files
+
+    Files the manifest lists as done and that still check out on disk are not fetched
+    again. With a manifest the book is only marked scraped once none of its files is
+    left to retry, so a partly failed book is picked up again for the missing files.
+    Links a DownloadPlan found dead or too large are not fetched.
+    """
     # Skip if already scraped
     if book_data.get("scraped", False):
         progress_bar.update(1)
@@ -280,80 +680,55 @@ async def process_book(session, book_title, book_data, progress_bar):
 
     # Create sanitized folder name for the book
     folder_name = re.sub(r'[\\/*?:"<>|]', '', book_title)
-    book_folder = DOWNLOAD_DIR / folder_name
-    
-    # Check if we should download all volumes
-    download_all_volumes = should_download_all_volumes(links.keys())
-    
-    # Determine which links to download
-    links_to_download = {}
-    document_links = {}
-    audio_links = {}
-    mobile_links = {}
-    
-    # First, categorize all links
-    for link_name, link_url in links.items():
-        if is_audio_book(link_name):
-            audio_links[link_name] = link_url
-        elif is_mobile_app(link_name):
-            mobile_links[link_name] = link_url
-        elif is_document_link(link_name) or is_volume_or_part(link_name):
-            document_links[link_name] = link_url
     
-    # If no document links found, treat all non-audio, non-mobile links as documents
-    if not document_links:
-        for link_name, link_url in links.items():
-            if link_name not in audio_links and link_name not in mobile_links:
-                document_links[link_name] = link_url
-    
-    # If we should download all volumes or there are no volume indicators,
-    # add all document links to download
-    if download_all_volumes or not any(is_volume_or_part(link) for link in document_links):
-        links_to_download.update(document_links)
-    else:
-        # Try to find the best link (PDF > EPUB > Kindle > other)
-        best_link = None
-        for priority in ["PDF", "ePub", "Kindle mobi", "Kindle", "Διαβάστε"]:
-            for link_name, link_url in document_links.items():
-                if priority.lower() in link_name.lower():
-                    best_link = (link_name, link_url)
-                    break
-            if best_link:
-                break
-        
-        # If no priority link found, use the first document link
-        if not best_link and document_links:
-            best_link = next(iter(document_links.items()))
-        
-        if best_link:
-            links_to_download[best_link[0]] = best_link[1]
-    
-    # Remove links that don't end with dl=1
-    valid_links_to_download = {name: url for name, url in links_to_download.items() if not url.endswith("dl=0") }
+    # Categorize the links and pick the documents to download, each name classified once
+    with stage('classify'):
+        plan = plan_links(links)
+        audio_links, mobile_links = plan.audio, plan.mobile
+        document_targets, audio_targets = download_targets(book_title, plan)
     
     # If no valid links to download, log and return
-    if not valid_links_to_download:
+    if not document_targets:
         progress_bar.update(1)
         logger.warning(f"No valid download links found for {book_title}")
         return book_title, False
     
-    # Download all selected document links
+    # Queue the downloads, at most MAX_DOWNLOADS_PER_BOOK of this book at a time
+    book_slots = asyncio.Semaphore(MAX_DOWNLOADS_PER_BOOK)
+    size_hints = size_hints or {}
+
+    async def schedule(link_url, destination_dir, link_name):
+        reason = download_plan.skip_reason(link_url) if download_plan is not None else None
+        if reason is not None:
+            logger.warning(f"Skipped {link_url} — {reason}")
+            if manifest is not None:
+                manifest.record_failed(link_url, reason)
+            return False, None
+        if manifest is not None:
+            record = manifest.done(link_url)
+            if record is not None and await get_writer().run(
+                    verify_file, record['path'], record['size'], record['sha256'] if VERIFY_HASHES else None):
+                manifest.mark_skipped()
+                return True, record['path']
+        async with book_slots:
+            return await scheduler.submit(
+                link_url,
+                lambda: download_file(session, link_url, destination_dir, link_name, content_store,
+                                      manifest=manifest, segments=segments),
+                size=size_hints.get(link_url),
+            )
+
+    # Download all selected document links, and audio links to the audio folder
     download_tasks = []
-    for link_name, link_url in valid_links_to_download.items():
-        download_tasks.append(download_file(session, link_url, book_folder, link_name))
-    
-    # Download audio links to the audio folder
-    for link_name, link_url in audio_links.items():
-        if link_url.endswith("dl=1") or "dl=1" in link_url:
-            audio_book_folder = AUDIO_DIR / folder_name
-            download_tasks.append(download_file(session, link_url, audio_book_folder, link_name))
+    download_urls = []
+    for link_name, link_url, destination_dir in document_targets + audio_targets:
+        download_tasks.append(schedule(link_url, destination_dir, link_name))
+        download_urls.append(link_url)
     
     # Save mobile links to the mobile folder (create files with links inside)
     for link_name, link_url in mobile_links.items():
-        os.makedirs(MOBILE_DIR, exist_ok=True)
         mobile_file = MOBILE_DIR / f"{folder_name}_{link_name}.txt"
-        with open(mobile_file, 'w', encoding='utf-8') as f:
-            f.write(f"Title: {book_title}\nLink Type: {link_name}\nURL: {link_url}\n")
+        await get_writer().run(save_mobile_link, mobile_file, book_title, link_name, link_url)
     
     # Execute all download tasks
     if download_tasks:
@@ -361,75 +736,179 @@ async def process_book(session, book_title, book_data, progress_bar):
         successful_downloads = sum(1 for success, _ in download_results if success)
         
         if successful_downloads > 0:
-            book_data["scraped"] = True
+            failed_urls = [url for url, (success, _) in zip(download_urls, download_results) if not success]
+            retry_later = manifest is not None and any(manifest.retryable(url) for url in failed_urls)
+            if not retry_later:
+                book_data["scraped"] = True
             if audio_links:
                 book_data["has_audio"] = True
             if mobile_links:
                 book_data["has_mobile_apps"] = True
             
             progress_bar.update(1)
-            logger.info(f"Successfully downloaded {successful_downloads} files for {book_title}")
+            if retry_later:
+                logger.info(f"Downloaded {successful_downloads} files for {book_title}, "
+                            f"{len(failed_urls)} failed and will be retried next run")
+            else:
+                logger.info(f"Successfully downloaded {successful_downloads} files for {book_title}")
             return book_title, True
     
     progress_bar.update(1)
     logger.warning(f"Failed to download any files for {book_title}")
     return book_title, False
 
-async def main():
-    # Load the books data
-    try:
-        with open('books.json', 'r', encoding='utf-8') as f:
-            books = json.load(f)
-    except Exception as e:
-        logger.error(f"Error loading books.json: {str(e)}")
-        return
+def make_connector():
+    """Connection pool capping the connections to any one host, whatever the scheduler and segments ask for"""
+    return aiohttp.TCPConnector(limit_per_host=MAX_CONNECTIONS_PER_HOST)
+
+
+async def plan_downloads(session, books, manifest=None):
+    """Probe every file this run would fetch for the (title, data) `books` (not the ones the manifest
+    has) and save the DownloadPlan"""
+    targets = []
+    for title, book_data in books:
+        for link_name, link_url, destination_dir in book_downloads(title, book_data):
+            if manifest is None or manifest.done(link_url) is None:
+                targets.append((title, link_name, link_url, destination_dir))
+
+    download_plan = await build_plan(session, targets, get_limiter(), resolve_filename, MAX_FILE_SIZE_BYTES)
+    download_plan.save(PLAN_PATH)
+    logger.info(f"Download plan: {download_plan.summary(MAX_CONCURRENT_DOWNLOADS)}")
+    return download_plan
+
+
+async def main(plan=False, plan_only=False, segments=SEGMENTS, store=None, books=None,
+               manifest_path=MANIFEST_PATH, content_index=CONTENT_INDEX, export=BOOKS_JSON):
+    """Download every book in the store. With `plan`, probe all files first so the
+    scheduler gets their sizes and dead or oversized links are dropped; `plan_only`
+    stops after writing the plan. `segments` > 1 splits large files into parallel ranges.
+
+    A shard worker (shards.py) passes the `store` its results go to, the (title, data)
+    `books` of its shard, its own manifest and content index, and no `export`.
+    """
+    # Open the catalogue; books are streamed from it rather than loaded up front
+    if store is None:
+        try:
+            store = open_store(BOOKS_STORE)
+        except Exception as e:
+            logger.error(f"Error loading {BOOKS_STORE}: {str(e)}")
+            return
+    total_books = len(store) if books is None else len(books)
+
+    def catalogue():
+        return store.items() if books is None else books
     
     # Create necessary directories
     DOWNLOAD_DIR.mkdir(exist_ok=True)
     AUDIO_DIR.mkdir(exist_ok=True)
     MOBILE_DIR.mkdir(exist_ok=True)
     
-    logger.info(f"Starting download of {len(books)} books")
+    content_store = ContentStore(content_index)
+    manifest = DownloadManifest(manifest_path)
+
+    download_plan = None
+    if plan or plan_only:
+        async with aiohttp.ClientSession(connector=make_connector()) as session:
+            download_plan = await plan_downloads(session, catalogue(), manifest)
+        print(f"Download plan saved to {PLAN_PATH}: {download_plan.summary(MAX_CONCURRENT_DOWNLOADS)}")
+        if plan_only:
+            manifest.close()
+            store.close()
+            return
+    # Without probing, the sizes an earlier --plan run saved still order the downloads smallest first
+    size_hints = download_plan.sizes() if download_plan is not None else load_sizes(PLAN_PATH)
+
+    logger.info(f"Starting download of {total_books} books")
     
     # Create a progress bar
-    progress_bar = tqdm(total=len(books), desc="Processing books")
-    
-    # Process books
-    async with aiohttp.ClientSession() as session:
-        tasks = []
-        
-        for title, book_data in books.items():
-            tasks.append(process_book(session, title, book_data, progress_bar))
-            
-        # Run downloads in parallel, with a limit of 100 concurrent downloads
-        results = []
-        for i in range(0, len(tasks), 100):
-            batch = tasks[i:i+100]
-            batch_results = await asyncio.gather(*batch)
-            results.extend(batch_results)
-            
-            # Save updated books data after each batch to avoid losing progress
-            with open('books.json', 'w', encoding='utf-8') as f:
-                json.dump(books, f, ensure_ascii=False, indent=2)
+    progress_bar = tqdm(total=total_books, desc="Processing books")
+
+    # Process books: a fixed set of book workers pull from a bounded queue, their
+    # downloads share one scheduler with global and per-host limits. Only outcome
+    # counts are kept, so memory doesn't grow with the catalogue.
+    outcomes = {None: 0, True: 0, False: 0, "audio_only": 0}
+    book_queue = asyncio.Queue(maxsize=MAX_CONCURRENT_BOOKS)
+    unsaved = 0
+
+    async def book_worker(session, scheduler):
+        nonlocal unsaved
+        while True:
+            item = await book_queue.get()
+            if item is None:
+                return
+            title, book_data = item
+            result = await process_book(session, scheduler, title, book_data, progress_bar,
+                                        size_hints=size_hints, content_store=content_store, manifest=manifest,
+                                        download_plan=download_plan, segments=segments)
+            outcomes[result[1]] += 1
+
+            # Save updated books as they finish to avoid losing progress
+            if result[1] is not None:
+                store.upsert(title, book_data)
+                unsaved += 1
+                if unsaved >= CHECKPOINT_EVERY:
+                    store.flush()
+                    content_store.save()
+                    unsaved = 0
+
+    async with aiohttp.ClientSession(connector=make_connector()) as session:
+        scheduler = DownloadScheduler(MAX_CONCURRENT_DOWNLOADS, MAX_DOWNLOADS_PER_HOST)
+        scheduler.start()
+        QUEUE_DEPTH.labels('books').set_function(book_queue.qsize)
+        QUEUE_DEPTH.labels('downloads').set_function(scheduler.queue.qsize)
+        workers = [asyncio.create_task(book_worker(session, scheduler)) for _ in range(MAX_CONCURRENT_BOOKS)]
+
+        for title, book_data in catalogue():
+            await book_queue.put((title, book_data))
+        for _ in workers:
+            await book_queue.put(None)
+
+        await asyncio.gather(*workers)
+        await scheduler.close()
+        store.flush()
+        content_store.save()
     
     progress_bar.close()
     
-    # Save final updated books data
-    with open('books.json', 'w', encoding='utf-8') as f:
-        json.dump(books, f, ensure_ascii=False, indent=2)
+    # Keep books.json in sync with the store
+    if export:
+        export_json(store, export)
+    store.close()
     
     # Print summary
-    skipped = sum(1 for _, success in results if success is None)
-    successful = sum(1 for _, success in results if success is True)
-    audio_only = sum(1 for _, success in results if success == "audio_only")
-    failed = sum(1 for _, success in results if success is False)
+    skipped = outcomes[None]
+    successful = outcomes[True]
+    audio_only = outcomes["audio_only"]
+    failed = outcomes[False]
     
     logger.info(f"\nDownload summary:")
     logger.info(f"- {skipped} books already scraped and skipped")
     logger.info(f"- {successful} books downloaded successfully")
     logger.info(f"- {audio_only} books flagged as audio-only and skipped")
     logger.info(f"- {failed} books failed to download")
-    logger.info(f"- {len(results)} books processed in total")
+    logger.info(f"- {sum(outcomes.values())} books processed in total")
+    logger.info(f"- Deduplication: {content_store.summary()}")
+    logger.info(f"- Manifest: {manifest.summary()}")
+    manifest.close()
+    logger.info(f"- Rate limits: {get_limiter().summary()}")
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Download the files of every book in the store")
+    parser.add_argument('--plan', action='store_true',
+                        help='probe every file first (HEAD / 1 byte range) to size and order the downloads '
+                             f'smallest first; without it the sizes saved in {PLAN_PATH} by an earlier --plan '
+                             'run are used, if any, else files run in catalogue order')
+    parser.add_argument('--plan-only', action='store_true',
+                        help=f'write the probe results to {PLAN_PATH} and exit without downloading')
+    parser.add_argument('--metrics-port', type=int, default=0,
+                        help='serve Prometheus metrics on http://127.0.0.1:PORT/metrics during the run (0 = off)')
+    parser.add_argument('--metrics-out', default=str(DOWNLOAD_METRICS),
+                        help='write a JSON summary of the run metrics here at the end (empty to skip)')
+    parser.add_argument('--segments', type=int, default=SEGMENTS,
+                        help=f'parallel ranges per file of {SEGMENT_THRESHOLD // (1024**2)} MB or more '
+                             f'when the server accepts ranges (1 = off)')
+    args = parser.parse_args()
+    start_metrics_server(args.metrics_port)
+    asyncio.run(main(plan=args.plan, plan_only=args.plan_only, segments=args.segments))
+    if args.metrics_out:
+        REGISTRY.write_summary(args.metrics_out)
\ No newline at end of file
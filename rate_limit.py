@@ -0,0 +1,180 @@
+import asyncio
+import random
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+# Statuses that mean "slow down"; other 5xx only count towards the circuit breaker
+THROTTLE_STATUSES = (429, 503)
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+UNLIMITED_RATE = 1000.0  # what rate=0 means
+
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header (delta seconds or an HTTP date)"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class HostState:
+    """Token bucket (as a theoretical arrival time), AIMD rate and circuit breaker for one host"""
+
+    def __init__(self, rate, per_host):
+        self.rate = rate
+        self.tat = 0.0  # when the bucket is next empty
+        self.blocked_until = 0.0  # Retry-After or open circuit
+        self.failures = 0  # consecutive
+        self.cooldown = None  # set while the circuit has been tripped
+        self.probing = False  # half open: one request is testing the host
+        self.prober = None  # the task sending that request
+        self.semaphore = asyncio.Semaphore(per_host) if per_host else None
+
+
+class HostLimiter:
+    """Per-host request limiter shared by the crawler and the downloader.
+
+    Requests to a host are spaced by a token bucket of `rate` requests/s (bursts of
+    `burst`). The rate adapts AIMD style: it creeps up by `increase` after each fast
+    success and is cut by `decrease` on 429/503 or connection errors, slow responses
+    trim it a little. Retry-After blocks the host for the given time. After
+    `failure_threshold` consecutive failures the circuit opens for a cooldown that
+    doubles each time it trips again, then a single probe request decides whether
+    it closes. Every wait gets up to `jitter` of the request interval added.
+    """
+
+    def __init__(self, rate=5.0, per_host=4, burst=1, min_rate=0.2, max_rate=20.0,
+                 increase=0.05, decrease=0.5, slow_latency=5.0, jitter=0.1,
+                 failure_threshold=5, cooldown=30.0, max_cooldown=300.0):
+        if not rate:
+            rate = max_rate = UNLIMITED_RATE
+        self.rate = rate
+        self.per_host = per_host
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max(max_rate, self.rate)
+        self.increase = increase
+        self.decrease = decrease
+        self.slow_latency = slow_latency
+        self.jitter = jitter
+        self.failure_threshold = failure_threshold
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.hosts = {}
+        self.stats = {'requests': 0, 'throttled': 0, 'errors': 0, 'circuit_trips': 0}
+
+    def host_state(self, url):
+        host = urlparse(url).netloc
+        if host not in self.hosts:
+            self.hosts[host] = HostState(self.rate, self.per_host)
+        return host, self.hosts[host]
+
+    def _reserve(self, state):
+        """Claim the next request slot; returns how long to wait for it (None: a probe is running)"""
+        now = time.monotonic()
+        if state.probing:
+            return None
+        interval = 1.0 / state.rate
+        start = max(now, state.tat - (self.burst - 1) * interval, state.blocked_until)
+        if state.cooldown is not None and start >= state.blocked_until:
+            state.probing = True  # circuit half open, this request is the probe
+        state.tat = max(state.tat, start) + interval
+        return start - now + random.uniform(0, self.jitter * interval)
+
+    async def acquire(self, url):
+        """Wait for a request slot to the host of `url`; every acquire must be paired with a release"""
+        host, state = self.host_state(url)
+        if state.semaphore is not None:
+            await state.semaphore.acquire()
+        try:
+            while True:
+                delay = self._reserve(state)
+                if delay is None:
+                    await asyncio.sleep(random.uniform(0.5, 1.5))
+                    continue
+                if state.probing:
+                    state.prober = asyncio.current_task()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                return host
+        except asyncio.CancelledError:
+            self.release(host)  # cancelled while waiting: give the slot (and a claimed probe) back
+            raise
+
+    def acquire_sync(self, url):
+        host, state = self.host_state(url)
+        while True:
+            delay = self._reserve(state)
+            if delay is None:
+                time.sleep(random.uniform(0.5, 1.5))
+                continue
+            if delay > 0:
+                time.sleep(delay)
+            return host
+
+    def release(self, host):
+        state = self.hosts[host]
+        if state.probing and state.prober is asyncio.current_task():
+            # The probe ended without a report (cancelled, or failed outside the request):
+            # let the next request probe instead of leaving the host half open for good
+            state.probing = False
+            state.prober = None
+        if state.semaphore is not None:
+            state.semaphore.release()
+
+    def report(self, host, status=None, latency=None, retry_after=None, error=False):
+        """Feed back the outcome of a request (a status, or error=True for connection failures)"""
+        state = self.hosts[host]
+        now = time.monotonic()
+        self.stats['requests'] += 1
+        state.probing = False
+        state.prober = None
+
+        failed = error or (status is not None and status >= 500) or status == 429
+        if error or status in THROTTLE_STATUSES:
+            state.rate = max(self.min_rate, state.rate * self.decrease)
+            self.stats['errors' if error else 'throttled'] += 1
+        elif not failed and latency is not None and latency > self.slow_latency:
+            state.rate = max(self.min_rate, state.rate * 0.9)
+        elif not failed:
+            state.rate = min(self.max_rate, state.rate + self.increase)
+
+        wait = parse_retry_after(retry_after)
+        if wait:
+            state.blocked_until = max(state.blocked_until, now + wait)
+
+        if not failed:
+            state.failures = 0
+            state.cooldown = None
+            return
+
+        state.failures += 1
+        if state.cooldown is not None or state.failures >= self.failure_threshold:
+            # Trip (or re-trip after a failed probe) the circuit
+            state.cooldown = min(self.max_cooldown, state.cooldown * 2) if state.cooldown else self.base_cooldown
+            state.blocked_until = max(state.blocked_until, now + state.cooldown)
+            self.stats['circuit_trips'] += 1
+
+    def summary(self):
+        rates = ', '.join(f"{host} {state.rate:.2f}/s" for host, state in self.hosts.items())
+        return (f"{self.stats['requests']} requests, {self.stats['throttled']} throttled, "
+                f"{self.stats['errors']} connection errors, {self.stats['circuit_trips']} circuit trips; "
+                f"rates: {rates}")
+
+
+_default_limiter = None
+
+
+def get_limiter():
+    """Shared HostLimiter for the download path (no per-host concurrency cap, the scheduler has one)"""
+    global _default_limiter
+    if _default_limiter is None:
+        _default_limiter = HostLimiter(rate=2.0, per_host=None)
+    return _default_limiter
@@ -0,0 +1,245 @@
+import argparse
+import os
+import re
+import sqlite3
+import time
+import unicodedata
+
+from book_store import BOOKS_STORE, open_store
+
+INDEX_PATH = 'search.db'
+MMAP_SIZE = 256 * 1024 * 1024  # the whole index of a large catalogue stays mapped
+BUILD_BATCH = 5000  # term rows inserted per executemany
+
+# terms.field of the title/description words; the exact values use author, translator, isbn, tag, type
+TEXT = 'text'
+
+WORD = re.compile(r'\w+')
+YEAR = re.compile(r'\b(1[5-9]\d\d|20\d\d)\b')
+NUMBER = re.compile(r'\d+')
+AUTHOR_SEPARATORS = re.compile(r'\s*(?:,|&|;|\s+και\s+)\s*')
+
+
+def fold(text):
+    """Lower case without accents or diaeresis, final sigma as σ: 'Ποίηση' and 'ΠΟΙΗΣΗ' both give 'ποιηση'"""
+    decomposed = unicodedata.normalize('NFD', text)
+    return ''.join(c for c in decomposed if not unicodedata.combining(c)).casefold()
+
+
+def words(text):
+    return WORD.findall(fold(text))
+
+
+def normalize_isbn(value):
+    return re.sub(r'[^0-9x]', '', fold(value))
+
+
+def first_number(value, pattern=NUMBER):
+    match = pattern.search(value or '')
+    return int(match.group(0)) if match else None
+
+
+def book_year(metadata):
+    """Year of the first 'Έτος ...' entry (the keys vary: 'Έτος έκδοσης', 'Έτος 1ης έκδοσης', ...)"""
+    for key, value in metadata.items():
+        if key.startswith('Έτος') and isinstance(value, str):
+            year = first_number(value, YEAR)
+            if year is not None:
+                return year
+    return None
+
+
+def book_terms(metadata):
+    """(field, term) pairs a book is indexed under"""
+    terms = set()
+    for field in ('h1', 'title', 'description'):
+        if metadata.get(field):
+            terms.update((TEXT, word) for word in words(metadata[field]))
+    for field in ('author', 'translator'):
+        value = metadata.get(field)
+        if value:
+            terms.add((field, fold(value).strip()))
+            terms.update((field, name) for name in AUTHOR_SEPARATORS.split(fold(value)) if name)
+    if metadata.get('isbn'):
+        terms.add(('isbn', normalize_isbn(metadata['isbn'])))
+    if metadata.get('type'):
+        terms.add(('type', fold(metadata['type']).strip()))
+    for tag in metadata.get('tags') or ():
+        terms.add(('tag', fold(tag).strip()))
+    return terms
+
+
+def build_index(store, path=INDEX_PATH):
+    """Index every book of `store` into a new SQLite file at `path`; returns the number of books.
+
+    The file is written next to `path` and moved into place, so a running search keeps
+    the old index until the new one is complete.
+    """
+    tmp_path = f'{path}.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    conn.execute('PRAGMA journal_mode=OFF')
+    conn.execute('PRAGMA synchronous=OFF')
+    conn.execute('CREATE TABLE books (id INTEGER PRIMARY KEY, key TEXT NOT NULL, title TEXT, author TEXT, '
+                 'year INTEGER, pages INTEGER)')
+    conn.execute('CREATE TABLE terms (field TEXT NOT NULL, term TEXT NOT NULL, id INTEGER NOT NULL, '
+                 'PRIMARY KEY (field, term, id)) WITHOUT ROWID')
+    conn.execute('CREATE TABLE meta (name TEXT PRIMARY KEY, value TEXT)')
+
+    count = 0
+    rows = []
+    for count, (key, book) in enumerate(store.items(), 1):
+        metadata = book.get('metadata') or {}
+        conn.execute('INSERT INTO books VALUES (?, ?, ?, ?, ?, ?)', (
+            count, key, metadata.get('title') or metadata.get('h1'), metadata.get('author'),
+            book_year(metadata), first_number(metadata.get('pages')),
+        ))
+        rows.extend((field, term, count) for field, term in book_terms(metadata))
+        if len(rows) >= BUILD_BATCH:
+            conn.executemany('INSERT INTO terms VALUES (?, ?, ?)', rows)
+            rows = []
+    conn.executemany('INSERT INTO terms VALUES (?, ?, ?)', rows)
+
+    conn.execute('CREATE TABLE counts (field TEXT NOT NULL, term TEXT NOT NULL, books INTEGER NOT NULL, '
+                 'PRIMARY KEY (field, term)) WITHOUT ROWID')
+    conn.execute('INSERT INTO counts SELECT field, term, COUNT(*) FROM terms GROUP BY field, term')
+    conn.execute('CREATE INDEX books_year ON books (year)')
+    conn.execute('CREATE INDEX books_pages ON books (pages)')
+    conn.execute('CREATE UNIQUE INDEX books_key ON books (key)')  # describe() looks books up by key
+    conn.executemany('INSERT INTO meta VALUES (?, ?)', [('books', str(count)), ('built', str(time.time()))])
+    conn.commit()
+    conn.execute('VACUUM')  # packs the pages so the file maps with no free space
+    conn.close()
+    os.replace(tmp_path, path)
+    return count
+
+
+class SearchIndex:
+    """Read-only queries over an index file built by build_index.
+
+    Every condition narrows the result: words of the title/description (a trailing *
+    matches a prefix), exact author / translator / ISBN / tag / type after folding,
+    and year / pages ranges. Results are book keys in catalogue order.
+    """
+
+    def __init__(self, path=INDEX_PATH):
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"No search index at {path}, build it with --rebuild")
+        self.conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True, check_same_thread=False)
+        self.conn.execute(f'PRAGMA mmap_size={MMAP_SIZE}')
+        self.conn.execute('PRAGMA query_only=ON')
+
+    def __len__(self):
+        return int(self.conn.execute("SELECT value FROM meta WHERE name = 'books'").fetchone()[0])
+
+    def _count(self, field, term):
+        row = self.conn.execute('SELECT books FROM counts WHERE field = ? AND term = ?', (field, term)).fetchone()
+        return row[0] if row else 0
+
+    def search(self, text=None, author=None, translator=None, isbn=None, tag=None, type=None,
+               year=(None, None), pages=(None, None), limit=None):
+        """Keys of the books matching every given condition; year/pages are (low, high), either may be None
+
+        The rarest term drives the query and every other condition is checked per
+        candidate against the primary keys, so the cost follows the smallest posting list.
+        """
+        terms = [(TEXT, word) for word in words(text or '')]
+        prefix = terms.pop() if text and text.rstrip().endswith('*') and terms else None
+        for field, value in (('author', author), ('translator', translator), ('isbn', isbn),
+                             ('tag', tag), ('type', type)):
+            if value:
+                terms.append((field, normalize_isbn(value) if field == 'isbn' else fold(value).strip()))
+
+        where, params = [], []
+        for column, (low, high) in (('year', year), ('pages', pages)):
+            if low is not None:
+                where.append(f'b.{column} >= ?')
+                params.append(low)
+            if high is not None:
+                where.append(f'b.{column} <= ?')
+                params.append(high)
+        if prefix is not None:
+            where.append('EXISTS (SELECT 1 FROM terms p WHERE p.field = ? AND p.term >= ? AND p.term < ? '
+                         'AND p.id = b.id)')
+            params += [prefix[0], prefix[1], prefix[1] + '\U0010ffff']
+
+        if terms:
+            counts = [self._count(field, term) for field, term in terms]
+            if not all(counts):
+                return []
+            terms = [term for _, term in sorted(zip(counts, terms))]
+            for field, term in terms[1:]:
+                where.insert(0, 'EXISTS (SELECT 1 FROM terms o WHERE o.field = ? AND o.term = ? AND o.id = t.id)')
+                params[:0] = [field, term]
+            query = 'SELECT b.key FROM terms t CROSS JOIN books b ON b.id = t.id WHERE t.field = ? AND t.term = ?'
+            params[:0] = list(terms[0])
+            order = 't.id'
+        else:
+            query = 'SELECT b.key FROM books b WHERE 1'
+            order = 'b.id'
+        query += ''.join(f' AND {condition}' for condition in where) + f' ORDER BY {order}'
+        if limit:
+            query += ' LIMIT ?'
+            params.append(limit)
+        return [key for key, in self.conn.execute(query, params)]
+
+    def describe(self, key):
+        """(title, author, year, pages) of an indexed book"""
+        return self.conn.execute('SELECT title, author, year, pages FROM books WHERE key = ?', (key,)).fetchone()
+
+    def close(self):
+        self.conn.close()
+
+
+def parse_range(value):
+    """'2015-' -> (2015, None), '-200' -> (None, 200), '1990-1999' -> (1990, 1999), '2001' -> (2001, 2001)"""
+    if not value:
+        return None, None
+    if '-' not in value:
+        return int(value), int(value)
+    low, high = value.split('-', 1)
+    return (int(low) if low else None), (int(high) if high else None)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Search the scraped catalogue.')
+    parser.add_argument('words', nargs='*', help='words of the title or description, a trailing * for a prefix')
+    parser.add_argument('--store', default=BOOKS_STORE, help='book store the index is built from')
+    parser.add_argument('--index', default=INDEX_PATH)
+    parser.add_argument('--rebuild', action='store_true', help='(re)build the index from the store first')
+    parser.add_argument('--author')
+    parser.add_argument('--translator')
+    parser.add_argument('--isbn')
+    parser.add_argument('--tag')
+    parser.add_argument('--type')
+    parser.add_argument('--year', help='YEAR, FROM-, -TO or FROM-TO')
+    parser.add_argument('--pages', help='PAGES, FROM-, -TO or FROM-TO')
+    parser.add_argument('--limit', type=int, default=50)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.rebuild or not os.path.exists(args.index):
+        store = open_store(args.store)
+        start = time.perf_counter()
+        count = build_index(store, args.index)
+        store.close()
+        print(f"Indexed {count} books into {args.index} in {time.perf_counter() - start:.1f}s")
+
+    index = SearchIndex(args.index)
+    start = time.perf_counter()
+    keys = index.search(' '.join(args.words), author=args.author, translator=args.translator, isbn=args.isbn,
+                        tag=args.tag, type=args.type, year=parse_range(args.year), pages=parse_range(args.pages),
+                        limit=args.limit)
+    elapsed = time.perf_counter() - start
+    for key in keys:
+        title, author, year, pages = index.describe(key)
+        print(f"{key}\t{title or ''}\t{author or ''}\t{year or ''}\t{pages or ''}")
+    print(f"{len(keys)} books in {elapsed * 1000:.2f} ms")
+    index.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+import time
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import HTTP_RESPONSES, RETRIES
+from rate_limit import RETRY_STATUSES
+
+try:
+    import brotli  # noqa: F401  (lets requests/aiohttp decode br responses)
+    ACCEPT_ENCODING = 'gzip, deflate, br'
+except ImportError:
+    ACCEPT_ENCODING = 'gzip, deflate'
+
+POOL_SIZE = 16
+KEEPALIVE_TIMEOUT = 30  # seconds an idle connection is kept open
+TIMEOUT = 30  # seconds, default for every request
+
+DEFAULT_HEADERS = {'Accept-Encoding': ACCEPT_ENCODING}
+
+
+class ConnectionStats:
+    """Per-run counters of connections opened vs. reused"""
+
+    def __init__(self):
+        self.requests = 0
+        self.opened = 0
+        self.reused = 0
+
+    def summary(self):
+        return f"{self.requests} requests, {self.opened} connections opened, {self.reused} reused"
+
+
+class PooledSession(requests.Session):
+    """requests.Session with a sized connection pool, compression and a default timeout.
+
+    With a rate_limit.HostLimiter every request is paced per host, and 429/5xx or
+    connection errors are retried up to `retries` times.
+    """
+
+    def __init__(self, pool_size=POOL_SIZE, timeout=TIMEOUT, limiter=None, retries=4):
+        super().__init__()
+        self.timeout = timeout
+        self.limiter = limiter
+        self.retries = retries
+        self.headers.update(DEFAULT_HEADERS)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        if self.limiter is None:
+            return super().request(method, url, **kwargs)
+
+        for attempt in range(self.retries):
+            last_attempt = attempt == self.retries - 1
+            host = self.limiter.acquire_sync(url)
+            started = time.monotonic()
+            try:
+                response = super().request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                self.limiter.report(host, error=True)
+                HTTP_RESPONSES.labels('crawler', 'error').inc()
+                if last_attempt:
+                    raise
+                RETRIES.labels('crawler').inc()
+                continue
+
+            self.limiter.report(host, response.status_code, time.monotonic() - started,
+                                response.headers.get('Retry-After'))
+            HTTP_RESPONSES.labels('crawler', str(response.status_code)).inc()
+            if response.status_code not in RETRY_STATUSES or last_attempt:
+                return response
+            RETRIES.labels('crawler').inc()
+
+    def connection_stats(self):
+        stats = ConnectionStats()
+        for adapter in set(self.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools[key]
+                stats.requests += pool.num_requests
+                stats.opened += pool.num_connections
+        stats.reused = stats.requests - stats.opened
+        return stats
+
+
+def make_aiohttp_session(stats=None, pool_size=POOL_SIZE, per_host=0, keepalive_timeout=KEEPALIVE_TIMEOUT, timeout=TIMEOUT):
+    """Pooled aiohttp.ClientSession, counting into `stats` (a ConnectionStats) when given"""
+
+    if stats is None:
+        stats = ConnectionStats()
+
+    async def on_request_end(session, context, params):
+        stats.requests += 1
+
+    async def on_connection_create_end(session, context, params):
+        stats.opened += 1
+
+    async def on_connection_reuseconn(session, context, params):
+        stats.reused += 1
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_end.append(on_request_end)
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+
+    connector = aiohttp.TCPConnector(limit=pool_size, limit_per_host=per_host, keepalive_timeout=keepalive_timeout)
+    return aiohttp.ClientSession(
+        connector=connector,
+        headers=DEFAULT_HEADERS,
+        timeout=aiohttp.ClientTimeout(total=timeout) if timeout else aiohttp.ClientTimeout(),
+        trace_configs=[trace_config],
+    )
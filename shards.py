@@ -0,0 +1,414 @@
+import argparse
+import asyncio
+import os
+import shutil
+import socket
+import sqlite3
+import time
+import zlib
+from contextlib import suppress
+from pathlib import Path
+
+from book_store import BOOKS_JSON, BOOKS_STORE, DOWNLOAD_FLAGS, JsonlStore, export_json, iter_json_books, open_store
+from content_store import CONTENT_INDEX, ContentStore
+from crawler import Crawler
+from discovery import MODES
+from download_manifest import MANIFEST_PATH, DownloadManifest
+from parsing import BACKENDS, DEFAULT_BACKEND
+
+JOBS_DB = 'jobs.db'
+SHARD_DIR = Path('shards')  # each job's output, next to jobs.db on the shared filesystem
+LEASE_SECONDS = 300  # a worker renews its lease every third of this; a dead worker's job is free after it
+MAX_JOB_ATTEMPTS = 3
+HASH_BUCKETS = 256  # hash shards are ranges of these, so the split doesn't depend on the worker count
+PAGES_PER_SHARD = 10
+POLL_SECONDS = 10
+
+KINDS = ('crawl', 'download')
+PAGES = 'pages'
+HASH = 'hash'
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+MERGED = 'merged'
+
+
+class LeaseLost(Exception):
+    pass
+
+
+def bucket(key):
+    """Hash bucket of a book key, the same in every process and on every host"""
+    return zlib.crc32(key.encode('utf-8')) % HASH_BUCKETS
+
+
+def split_range(first, last, count):
+    """[first, last] cut into at most `count` contiguous (first, last) ranges of near equal size"""
+    bounds = [first + (last - first + 1) * i // count for i in range(count + 1)]
+    return [(bounds[i], bounds[i + 1] - 1) for i in range(count) if bounds[i + 1] > bounds[i]]
+
+
+def owner_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class JobTable:
+    """Shared SQLite table of shard jobs, claimed under time-limited leases.
+
+    A job is a page range (crawl by pages) or a range of key hash buckets (crawl or
+    download by hash). A claim takes the first pending job, or one whose lease has
+    expired, inside one write transaction, so two workers never hold the same job.
+    """
+
+    def __init__(self, path=JOBS_DB, lease=LEASE_SECONDS):
+        self.lease = lease
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        # The rollback journal rather than WAL: WAL needs memory shared between the
+        # processes, which workers on other hosts (jobs.db on NFS) don't have
+        self.conn.execute('PRAGMA journal_mode=DELETE')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            ' name TEXT PRIMARY KEY,'
+            ' kind TEXT NOT NULL,'
+            ' by TEXT NOT NULL,'
+            ' first INTEGER NOT NULL,'
+            ' last INTEGER NOT NULL,'
+            ' status TEXT NOT NULL,'
+            ' owner TEXT,'
+            ' lease_until REAL,'
+            ' attempts INTEGER NOT NULL DEFAULT 0,'
+            ' error TEXT,'
+            ' updated REAL NOT NULL)'
+        )
+
+    def add(self, kind, by, ranges):
+        """Add a job per (first, last) range; returns how many were new"""
+        added = 0
+        for first, last in ranges:
+            cursor = self.conn.execute(
+                'INSERT OR IGNORE INTO jobs (name, kind, by, first, last, status, updated) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (f"{kind}-{by}-{first:05d}-{last:05d}", kind, by, first, last, PENDING, time.time()),
+            )
+            added += cursor.rowcount
+        return added
+
+    def plan_pages(self, first, last, per_shard=PAGES_PER_SHARD):
+        return self.add('crawl', PAGES, [(page, min(page + per_shard - 1, last))
+                                         for page in range(first, last + 1, per_shard)])
+
+    def plan_hash(self, kind, shards):
+        return self.add(kind, HASH, split_range(0, HASH_BUCKETS - 1, shards))
+
+    def claim(self, owner, kinds=KINDS):
+        """Lease the next free job of one of `kinds` to `owner`; the job as a dict, or None"""
+        now = time.time()
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = self.conn.execute(
+                f"SELECT * FROM jobs WHERE kind IN ({', '.join('?' * len(kinds))}) AND attempts < ? "
+                'AND (status = ? OR (status = ? AND lease_until < ?)) ORDER BY kind, by, first LIMIT 1',
+                (*kinds, MAX_JOB_ATTEMPTS, PENDING, LEASED, now),
+            ).fetchone()
+            if row is not None:
+                self.conn.execute(
+                    'UPDATE jobs SET status = ?, owner = ?, lease_until = ?, attempts = attempts + 1, '
+                    'updated = ? WHERE name = ?',
+                    (LEASED, owner, now + self.lease, now, row['name']),
+                )
+            self.conn.execute('COMMIT')
+        except BaseException:
+            self.conn.execute('ROLLBACK')
+            raise
+        return dict(row, status=LEASED, owner=owner, attempts=row['attempts'] + 1) if row else None
+
+    def _update_leased(self, name, owner, assignments, values):
+        # Only the current holder of a live lease may touch its job
+        cursor = self.conn.execute(
+            f'UPDATE jobs SET {assignments}, updated = ? WHERE name = ? AND owner = ? AND status = ?',
+            (*values, time.time(), name, owner, LEASED),
+        )
+        return cursor.rowcount == 1
+
+    def renew(self, name, owner):
+        """Extend `owner`'s lease on a job; False if it has lost it"""
+        return self._update_leased(name, owner, 'lease_until = ?', (time.time() + self.lease,))
+
+    def complete(self, name, owner):
+        return self._update_leased(name, owner, 'status = ?, lease_until = NULL, error = NULL', (DONE,))
+
+    def release(self, name, owner, error):
+        """Give a failed job back: pending for another attempt, or failed after MAX_JOB_ATTEMPTS"""
+        return self._update_leased(
+            name, owner,
+            'status = CASE WHEN attempts < ? THEN ? ELSE ? END, owner = NULL, lease_until = NULL, error = ?',
+            (MAX_JOB_ATTEMPTS, PENDING, FAILED, error),
+        )
+
+    def mark_merged(self, name):
+        self.conn.execute('UPDATE jobs SET status = ?, updated = ? WHERE name = ?', (MERGED, time.time(), name))
+
+    def reset(self, kind):
+        """Make every `kind` job not under a live lease pending again, for a new pass; returns them"""
+        now = time.time()
+        jobs = [job for job in self.jobs(kind) if not (job['status'] == LEASED and job['lease_until'] >= now)]
+        for job in jobs:
+            self.conn.execute(
+                'UPDATE jobs SET status = ?, owner = NULL, lease_until = NULL, attempts = 0, error = NULL, '
+                'updated = ? WHERE name = ?',
+                (PENDING, now, job['name']),
+            )
+        return jobs
+
+    def jobs(self, kind=None, status=None):
+        query, args = 'SELECT * FROM jobs WHERE 1', []
+        if kind:
+            query, args = query + ' AND kind = ?', args + [kind]
+        if status:
+            query, args = query + ' AND status = ?', args + [status]
+        return [dict(row) for row in self.conn.execute(query + ' ORDER BY kind, by, first', args)]
+
+    def unfinished(self, kind):
+        """Jobs of `kind` still to run or running; not the failed ones, nor an expired last attempt"""
+        now = time.time()
+        return [job for job in self.jobs(kind) if job['status'] == PENDING or (
+            job['status'] == LEASED and (job['lease_until'] >= now or job['attempts'] < MAX_JOB_ATTEMPTS))]
+
+    def summary(self):
+        counts = self.conn.execute('SELECT kind, status, COUNT(*) FROM jobs GROUP BY kind, status ORDER BY kind')
+        lines = {}
+        for kind, status, count in counts:
+            lines.setdefault(kind, []).append(f"{count} {status}")
+        return '; '.join(f"{kind}: {', '.join(parts)}" for kind, parts in lines.items()) or 'no jobs'
+
+    def close(self):
+        self.conn.close()
+
+
+def shard_path(job, suffix):
+    return SHARD_DIR / f"{job['name']}{suffix}"
+
+
+def in_shard(job):
+    buckets = range(job['first'], job['last'] + 1)
+    return lambda key: bucket(key) in buckets
+
+
+def crawler_options(args):
+    return dict(detail_workers=args.workers, listing_workers=args.listing_workers, per_host=args.per_host,
+                rate=args.rate, parser=args.parser, parse_workers=args.parse_workers)
+
+
+async def crawl_shard(job, args):
+    """Scrape the books of a crawl job into its own store; a re-claimed job resumes from its page cursor"""
+    store = open_store(str(shard_path(job, '.jsonl')), import_from=None)
+    progress = shard_path(job, '.page')
+    first = job['first'] if job['by'] == PAGES else 1
+    try:
+        start = max(first, int(progress.read_text().strip()) + 1)
+    except (FileNotFoundError, ValueError):
+        start = first
+    try:
+        if job['by'] == PAGES:
+            crawler = Crawler(store, start_page=start, end_page=job['last'], progress_path=str(progress),
+                              **crawler_options(args))
+        else:
+            # Every worker finds all the books (cheaply, from the sitemap) and scrapes its own;
+            # without a sitemap or API they all walk the listing pages instead
+            crawler = Crawler(store, start_page=start, progress_path=str(progress), key_filter=in_shard(job),
+                              discover=args.discover, discovery_state_path=str(shard_path(job, '.discovery.json')),
+                              **crawler_options(args))
+        await crawler.run()
+    finally:
+        store.close()
+
+
+async def download_shard(job, args):
+    """Download the files of the catalogue's books in the job's hash buckets"""
+    import pdfs  # sets up the download log, which crawl-only workers don't need
+
+    store = open_store(str(shard_path(job, '.jsonl')), import_from=None)
+    wanted = in_shard(job)
+    # The shard store has the books an earlier attempt already finished
+    books = [(key, store.get(key, data)) for key, data in iter_json_books(args.catalogue) if wanted(key)]
+    # Start from the shared content index, so files downloaded before are still deduplicated against
+    content_index = shard_path(job, '.content.json')
+    if not content_index.exists() and CONTENT_INDEX.exists():
+        shutil.copyfile(CONTENT_INDEX, content_index)
+    await pdfs.main(segments=args.segments, store=store, books=books,
+                    manifest_path=shard_path(job, '.manifest.db'), content_index=content_index, export=None)
+
+
+async def hold_lease(jobs, job, owner, work):
+    """Run the `work` coroutine while renewing `owner`'s lease on `job`; cancel it if the lease is lost"""
+    task = asyncio.ensure_future(work)
+    while True:
+        done, _ = await asyncio.wait({task}, timeout=jobs.lease / 3)
+        if done:
+            return task.result()
+        if not jobs.renew(job['name'], owner):
+            task.cancel()
+            with suppress(asyncio.CancelledError):
+                await task
+            raise LeaseLost(f"lease on {job['name']} expired and was taken over")
+
+
+def work(jobs, args):
+    """Claim and run jobs until none are left; returns how many this worker finished"""
+    SHARD_DIR.mkdir(exist_ok=True)
+    owner = owner_id()
+    kinds = (args.kind,) if args.kind else KINDS
+    finished = 0
+    while True:
+        job = jobs.claim(owner, kinds)
+        if job is None:
+            print(f"No {' or '.join(kinds)} jobs left to claim; {owner} finished {finished}")
+            return finished
+        print(f"{owner} claimed {job['name']} (attempt {job['attempts']})")
+        run = crawl_shard if job['kind'] == 'crawl' else download_shard
+        try:
+            asyncio.run(hold_lease(jobs, job, owner, run(job, args)))
+        except Exception as e:
+            print(f"Job {job['name']} failed: {e}")
+            jobs.release(job['name'], owner, str(e))
+            continue
+        if jobs.complete(job['name'], owner):
+            finished += 1
+            print(f"Finished {job['name']}")
+        else:
+            print(f"Finished {job['name']} after losing its lease, another worker has it")
+
+
+def merge(jobs, kind, store):
+    """Fold the output of every finished `kind` job into `store`, in shard order; returns the books merged.
+
+    Download jobs also bring their manifest and content index into the shared ones, and
+    only their download flags: metadata scraped since the shard's snapshot is kept.
+    Each job is merged once; a merged crawl doesn't clear the flags of books
+    already downloaded.
+    """
+    merged = 0
+    manifest = content_store = None
+    if kind == 'download':
+        manifest = DownloadManifest(MANIFEST_PATH)
+        content_store = ContentStore(CONTENT_INDEX)
+
+    for job in jobs.jobs(kind, DONE):
+        path = shard_path(job, '.jsonl')
+        if path.exists():
+            shard = JsonlStore(str(path))
+            for key, data in shard.items():
+                previous = store.get(key)
+                if previous and kind == 'download':
+                    # The shard's copy is a snapshot from before it ran, only its flags are news
+                    previous.update((flag, data[flag]) for flag in DOWNLOAD_FLAGS if flag in data)
+                    data = previous
+                elif previous:
+                    data.update((flag, previous[flag]) for flag in DOWNLOAD_FLAGS if flag in previous)
+                store.upsert(key, data)
+                merged += 1
+            shard.close()
+        if manifest is not None:
+            if shard_path(job, '.manifest.db').exists():
+                manifest.merge(shard_path(job, '.manifest.db'))
+            if shard_path(job, '.content.json').exists():
+                content_store.merge(ContentStore(shard_path(job, '.content.json')))
+        store.flush()  # before the job is marked, so a crash can only merge it twice
+        jobs.mark_merged(job['name'])
+        print(f"Merged {job['name']}")
+
+    if manifest is not None:
+        content_store.save()
+        manifest.close()
+    return merged
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Split crawling and downloading into shard jobs that several processes or hosts work through')
+    parser.add_argument('--jobs', default=JOBS_DB, help='shared job table (SQLite)')
+    parser.add_argument('--lease', type=float, default=LEASE_SECONDS,
+                        help='seconds a claim lasts without being renewed')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    plan = commands.add_parser('plan', help='add shard jobs (jobs that exist already are left alone)')
+    plan.add_argument('kind', choices=KINDS)
+    plan.add_argument('--pages', help='crawl by listing page range FIRST-LAST')
+    plan.add_argument('--per-shard', type=int, default=PAGES_PER_SHARD, help='listing pages per crawl job')
+    plan.add_argument('--hash', type=int, default=0, help='this many jobs, each a share of the book key hashes')
+
+    worker = commands.add_parser('work', help='claim and run jobs until none are left')
+    worker.add_argument('--kind', choices=KINDS, help='only claim jobs of this kind')
+    worker.add_argument('--workers', type=int, default=8, help='concurrent book page fetches')
+    worker.add_argument('--listing-workers', type=int, default=2, help='concurrent listing page fetches')
+    worker.add_argument('--per-host', type=int, default=4, help='max open requests per host')
+    worker.add_argument('--rate', type=float, default=5.0, help='starting requests per second per host (0 = unlimited)')
+    worker.add_argument('--parser', choices=BACKENDS, default=DEFAULT_BACKEND, help='HTML parser backend')
+    worker.add_argument('--parse-workers', type=int, default=0, help='parse book pages in this many processes')
+    worker.add_argument('--discover', choices=[mode for mode in MODES if mode != 'listing'], default='auto',
+                        help='where a crawl-by-hash job finds the books')
+    worker.add_argument('--segments', type=int, default=1, help='parallel ranges per large file')
+    worker.add_argument('--catalogue', default=BOOKS_JSON, help='books.json the download jobs read')
+
+    merger = commands.add_parser('merge', help='fold finished jobs into the store and export books.json')
+    merger.add_argument('kind', choices=KINDS)
+    merger.add_argument('--wait', action='store_true', help='first wait until no job of the kind is left to run')
+    merger.add_argument('--store', default=BOOKS_STORE, help='book store the shards are merged into')
+    merger.add_argument('--export', default=BOOKS_JSON, help='write the books.json layout here (empty to skip)')
+
+    reset = commands.add_parser('reset', help='make the jobs of a kind pending again for a new pass')
+    reset.add_argument('kind', choices=KINDS)
+
+    commands.add_parser('status', help='show every job')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    jobs = JobTable(args.jobs, lease=args.lease)
+    try:
+        if args.command == 'plan':
+            if args.pages:
+                if args.kind != 'crawl':
+                    raise SystemExit('Download jobs are split by --hash, page contents are known after the crawl')
+                first, last = (int(page) for page in args.pages.split('-'))
+                added = jobs.plan_pages(first, last, args.per_shard)
+            elif args.hash:
+                added = jobs.plan_hash(args.kind, args.hash)
+            else:
+                raise SystemExit('Give --pages FIRST-LAST or --hash JOBS')
+            print(f"Added {added} {args.kind} jobs; {jobs.summary()}")
+        elif args.command == 'work':
+            work(jobs, args)
+        elif args.command == 'merge':
+            while args.wait and jobs.unfinished(args.kind):
+                print(f"Waiting for {len(jobs.unfinished(args.kind))} {args.kind} jobs; {jobs.summary()}")
+                time.sleep(POLL_SECONDS)
+            with open_store(args.store) as store:
+                print(f"Merged {merge(jobs, args.kind, store)} books into {args.store}")
+                if args.export and args.export != args.store:
+                    print(f"Exported {export_json(store, args.export)} books to {args.export}")
+        elif args.command == 'reset':
+            for job in jobs.reset(args.kind):
+                # Forget the crawl cursors so the pages are walked again; stores and manifests are kept
+                for suffix in ('.page', '.discovery.json'):
+                    with suppress(FileNotFoundError):
+                        shard_path(job, suffix).unlink()
+            print(jobs.summary())
+        else:
+            now = time.time()
+            for job in jobs.jobs():
+                lease = f", lease {job['lease_until'] - now:.0f}s" if job['status'] == LEASED else ''
+                owner = f" by {job['owner']}" if job['owner'] else ''
+                error = f" ({job['error']})" if job['error'] else ''
+                print(f"{job['name']:<32} {job['status']:<8} attempts {job['attempts']}{owner}{lease}{error}")
+            print(jobs.summary())
+    finally:
+        jobs.close()
+
+
+if __name__ == "__main__":
+    main()